@@ -0,0 +1,352 @@
+"""
+Jeu de données synthétique de grande taille pour les bancs d'essai
+
+Génère des utilisateurs, leurs répertoires (groupes et contacts), des appels
+avec participants et messages de chat, et des messages de signalisation
+(dont une part en attente). Tout est tiré d'un générateur pseudo-aléatoire
+initialisé par --seed : mêmes options sur une base fraîche, même jeu de
+données (les dates sont relatives au jour du lancement, minuit UTC).
+
+Les lois des tailles et durées s'écrivent loi:paramètres :
+  const:N   uniform:A,B   normal:MOYENNE,ÉCART   lognormal:MU,SIGMA   exp:MOYENNE
+(lognormal : paramètres du logarithme, comme random.lognormvariate).
+
+Les lignes sont insérées par lots de --batch-size avec un INSERT préparé une
+fois par table (executemany) et des identifiants attribués d'avance : ni
+compilation SQL par ligne ni relecture des clés, dans une seule transaction.
+Exemple, après migrate sur une base vide :
+  python manage.py seed_dataset --users 300000 --calls 2000000
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from calls.models import Call, CallParticipant, CallMessage
+from contacts.models import Contact, ContactGroup
+from signaling.models import SignalingMessage
+from users.models import User, normalize_phone, normalize_search
+
+DEFAULT_PASSWORD = 'seed-pass-1'
+DAY = 86400
+
+FIRST_NAMES = ['Alice', 'Bruno', 'Camille', 'David', 'Emma', 'François', 'Gabriel', 'Hugo', 'Inès', 'Jules',
+               'Karima', 'Louis', 'Manon', 'Nathan', 'Océane', 'Paul', 'Quentin', 'Rose', 'Sarah', 'Théo']
+LAST_NAMES = ['Martin', 'Bernard', 'Dubois', 'Thomas', 'Robert', 'Richard', 'Petit', 'Durand', 'Leroy',
+              'Moreau', 'Simon', 'Laurent', 'Lefebvre', 'Michel', 'Garcia', 'David', 'Bertrand', 'Roux']
+GROUP_NAMES = ['Famille', 'Travail', 'Amis', 'Équipe', 'Clients', 'Fournisseurs', 'Sport', 'Voisins']
+CALL_TITLES = ['Point hebdomadaire', 'Revue de projet', 'Réunion d\'équipe', 'Démo client', 'Rétrospective']
+CHAT_LINES = ['Vous m\'entendez ?', 'Je partage mon écran', 'Le lien est dans le chat', 'Je dois couper, à plus tard',
+              'Ma caméra ne marche pas', 'On reprend dans 5 minutes', 'Merci à tous']
+
+# Appels à venir et en cours ; les autres sont passés, avec ces statuts et ces poids
+PLANNED_SHARE = 0.05
+IN_PROGRESS_SHARE = 0.01
+PAST_STATUSES = ['completed', 'missed', 'cancelled']
+PAST_WEIGHTS = [80, 14, 6]
+# Sonnerie d'un appel manqué ou annulé (secondes)
+RING_SECONDS = (5, 45)
+
+
+class Distribution:
+    """Loi de tirage décrite par loi:paramètres (voir l'en-tête du module)"""
+
+    LAWS = {
+        'const': (1, lambda rng, value: value),
+        'uniform': (2, lambda rng, low, high: rng.uniform(low, high)),
+        'normal': (2, lambda rng, mu, sigma: rng.gauss(mu, sigma)),
+        'lognormal': (2, lambda rng, mu, sigma: rng.lognormvariate(mu, sigma)),
+        'exp': (1, lambda rng, mean: rng.expovariate(1 / mean) if mean > 0 else 0.0),
+    }
+
+    def __init__(self, spec):
+        law, _, params = spec.partition(':')
+        if law not in self.LAWS:
+            raise argparse.ArgumentTypeError(f"loi inconnue : {law} (lois : {', '.join(self.LAWS)})")
+        arity, self._draw = self.LAWS[law]
+        try:
+            self.params = [float(param) for param in params.split(',')] if params else []
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"paramètres invalides : {spec}")
+        if len(self.params) != arity:
+            raise argparse.ArgumentTypeError(f"{law} attend {arity} paramètre(s) : {spec}")
+        self.spec = spec
+
+    def __repr__(self):
+        return self.spec
+
+    def sample(self, rng):
+        return self._draw(rng, *self.params)
+
+    def count(self, rng, minimum=0, maximum=None):
+        value = max(minimum, int(round(self.sample(rng))))
+        return value if maximum is None else min(value, maximum)
+
+
+class BulkInserter:
+    """INSERT préparé une fois pour une table, exécuté par lots de batch_size lignes"""
+
+    def __init__(self, cursor, table, columns, batch_size):
+        quote = connection.ops.quote_name
+        self.sql = (f"INSERT INTO {quote(table)} ({', '.join(quote(column) for column in columns)}) "
+                    f"VALUES ({', '.join(['%s'] * len(columns))})")
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.cursor.executemany(self.sql, self.rows)
+            self.count += len(self.rows)
+            self.rows = []
+
+
+def next_id(model):
+    return (model.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+
+
+class Command(BaseCommand):
+    help = "Remplit la base d'un jeu de données synthétique déterministe (utilisateurs, contacts, appels, signalisation)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--prefix', default='seed_', help="préfixe des usernames générés")
+        parser.add_argument('--password', default=DEFAULT_PASSWORD, help="mot de passe de tous les utilisateurs")
+        parser.add_argument('--contacts-per-user', type=Distribution, default=Distribution('lognormal:3.4,0.8'))
+        parser.add_argument('--groups-per-user', type=Distribution, default=Distribution('uniform:0,6'))
+        parser.add_argument('--grouped', type=float, default=0.5, help="part des contacts rangés dans un groupe")
+        parser.add_argument('--calls', type=int, default=500000)
+        parser.add_argument('--group-calls', type=float, default=0.15, help="part des appels de groupe")
+        parser.add_argument('--group-size', type=Distribution, default=Distribution('uniform:3,8'),
+                            help="participants d'un appel de groupe, initiateur compris")
+        parser.add_argument('--call-duration', type=Distribution, default=Distribution('lognormal:5.5,1.0'),
+                            help="durée des appels aboutis (secondes)")
+        parser.add_argument('--messages-per-call', type=Distribution, default=Distribution('exp:2'))
+        parser.add_argument('--signaling-per-call', type=Distribution, default=Distribution('uniform:4,12'),
+                            help="offre, réponse et candidats ICE par appel commencé")
+        parser.add_argument('--pending', type=float, default=0.02,
+                            help="part des messages de signalisation non traités (appels terminés)")
+        parser.add_argument('--days', type=int, default=365, help="profondeur de l'historique des appels")
+        parser.add_argument('--batch-size', type=int, default=50000)
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError("--users doit valoir au moins 2")
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError(f"Des utilisateurs {options['prefix']}* existent déjà : partir d'une base vide "
+                               "(manage.py flush) ou changer --prefix")
+
+        self.rng = random.Random(options['seed'])
+        anchor = datetime.now(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        # Dates naïves dans le fuseau de la connexion si la base ne stocke pas le fuseau :
+        # l'adaptateur n'a alors plus de conversion à faire pour chaque ligne
+        if not connection.features.supports_timezones:
+            anchor = timezone.make_naive(anchor, connection.timezone)
+        self.anchor = anchor
+        self.adapt_datetime = connection.ops.adapt_datetimefield_value
+        self.options = options
+        stages = [
+            ('utilisateurs', self.seed_users),
+            ('répertoires', self.seed_contacts),
+            ('appels', self.seed_calls),
+        ]
+
+        report = []
+        started = time.perf_counter()
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.cursor = cursor
+            for label, stage in stages:
+                stage_started = time.perf_counter()
+                inserters = stage()
+                for inserter in inserters:
+                    inserter.flush()
+                report.append((label, inserters, time.perf_counter() - stage_started))
+            # PostgreSQL : les séquences doivent dépasser les identifiants attribués ici
+            models = [User, ContactGroup, Contact, Contact.groups.through, Call, CallParticipant, CallMessage,
+                      SignalingMessage]
+            for statement in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(statement)
+        elapsed = time.perf_counter() - started
+
+        total = 0
+        self.stdout.write("étape          lignes      secondes   lignes/s   détail")
+        for label, inserters, seconds in report:
+            rows = sum(inserter.count for inserter in inserters)
+            total += rows
+            detail = ', '.join(f"{inserter.label} {inserter.count}" for inserter in inserters)
+            self.stdout.write(f"{label:<14} {rows:<11} {seconds:8.1f} {rows / seconds:10.0f}   {detail}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{total} lignes en {elapsed:.1f} s ({total / elapsed:.0f} lignes/s), graine {options['seed']}"))
+
+    def inserter(self, model, columns, label, table=None):
+        inserter = BulkInserter(self.cursor, table or model._meta.db_table, columns, self.options['batch_size'])
+        inserter.label = label
+        return inserter
+
+    def when(self, seconds):
+        """Date à seconds secondes de l'ancre (négatif : passé), au format attendu par la base"""
+        if seconds is None:
+            return None
+        return self.adapt_datetime(self.anchor + timedelta(seconds=seconds))
+
+    def seed_users(self):
+        rng, options = self.rng, self.options
+        users = self.inserter(User, [
+            'id', 'password', 'is_superuser', 'username', 'first_name', 'last_name', 'email', 'is_staff',
+            'is_active', 'date_joined', 'phone_number', 'phone_normalized', 'username_normalized',
+            'first_name_normalized', 'last_name_normalized', 'email_normalized', 'profile_image',
+            'profile_image_variants', 'online_status', 'last_seen',
+        ], 'utilisateurs')
+        password = make_password(options['password'])
+        no_variants = User._meta.get_field('profile_image_variants').get_db_prep_save({}, connection)
+        self.first_user = next_id(User)
+        for index in range(options['users']):
+            username = f"{options['prefix']}{index}"
+            phone = f"+33 6 {rng.randrange(10 ** 8):08d}"
+            online = rng.random() < 0.1
+            first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            email = f'{username}@example.com'
+            users.add((
+                self.first_user + index, password, False, username, first_name, last_name,
+                email, False, True, self.when(-rng.uniform(0, 3 * options['days']) * DAY),
+                phone, normalize_phone(phone), normalize_search(username), normalize_search(first_name),
+                normalize_search(last_name), normalize_search(email), '', no_variants, online,
+                self.when(-rng.uniform(0, 30 * DAY)),
+            ))
+        return [users]
+
+    def seed_contacts(self):
+        rng, options = self.rng, self.options
+        groups = self.inserter(ContactGroup, ['id', 'name', 'owner_id', 'created_at'], 'groupes')
+        contacts = self.inserter(Contact, [
+            'id', 'owner_id', 'contact_user_id', 'nickname', 'is_favorite', 'notes', 'created_at', 'phone',
+            'last_contact', 'call_count',
+        ], 'contacts')
+        memberships = self.inserter(None, ['contact_id', 'contactgroup_id'], 'appartenances',
+                                    table=Contact.groups.through._meta.db_table)
+        count = options['users']
+        group_id, contact_id = next_id(ContactGroup), next_id(Contact)
+        for owner in range(count):
+            owner_id = self.first_user + owner
+            owner_groups = []
+            for _ in range(options['groups_per_user'].count(rng)):
+                groups.add((group_id, rng.choice(GROUP_NAMES), owner_id, self.when(-rng.uniform(0, 365) * DAY)))
+                owner_groups.append(group_id)
+                group_id += 1
+
+            wanted = options['contacts_per_user'].count(rng, 0, count - 1)
+            targets = [target for target in rng.sample(range(count), min(wanted + 1, count)) if target != owner]
+            for target in targets[:wanted]:
+                call_count = int(rng.expovariate(0.5))
+                last_contact = self.when(-rng.uniform(0, options['days']) * DAY) if call_count else None
+                contacts.add((
+                    contact_id, owner_id, self.first_user + target, None, rng.random() < 0.05, None,
+                    self.when(-rng.uniform(0, 365) * DAY), None, last_contact, call_count,
+                ))
+                if owner_groups and rng.random() < options['grouped']:
+                    memberships.add((contact_id, rng.choice(owner_groups)))
+                contact_id += 1
+        return [groups, contacts, memberships]
+
+    def seed_calls(self):
+        rng, options = self.rng, self.options
+        calls = self.inserter(Call, [
+            'id', 'initiator_id', 'call_type', 'is_group_call', 'title', 'status', 'scheduled_time', 'start_time',
+            'end_time', 'recording_path', 'created_at', 'updated_at',
+        ], 'appels')
+        participants = self.inserter(CallParticipant, ['call_id', 'user_id', 'joined_at', 'left_at', 'has_accepted'],
+                                     'participants')
+        messages = self.inserter(CallMessage, ['call_id', 'sender_id', 'content', 'timestamp'], 'messages')
+        signaling = self.inserter(SignalingMessage, [
+            'call_id', 'sender_id', 'receiver_id', 'message_type', 'content', 'is_processed', 'created_at',
+        ], 'signalisation')
+
+        content_field = SignalingMessage._meta.get_field('content')
+        offer = content_field.get_db_prep_save({'sdp': {'type': 'offer', 'sdp': 'v=0'}}, connection)
+        answer = content_field.get_db_prep_save({'sdp': {'type': 'answer', 'sdp': 'v=0'}}, connection)
+        candidates = [content_field.get_db_prep_save(
+            {'candidate': {'candidate': f'candidate:{index} 1 udp 2122260223 10.0.0.{index} 5{index}000 typ host',
+                           'sdpMid': '0', 'sdpMLineIndex': 0}}, connection) for index in range(8)]
+
+        count = options['users']
+        call_id = next_id(Call)
+        for _ in range(options['calls']):
+            is_group = rng.random() < options['group_calls']
+            size = options['group_size'].count(rng, 3, count) if is_group else 2
+            initiator = self.first_user + rng.randrange(count)
+            members = [initiator] + [self.first_user + index for index in rng.sample(range(count), size)
+                                     if self.first_user + index != initiator][:size - 1]
+
+            draw = rng.random()
+            scheduled = start = end = None
+            if draw < PLANNED_SHARE:
+                status = 'planned'
+                scheduled = rng.uniform(0, 30) * DAY
+                created = -rng.uniform(0, 7) * DAY
+            elif draw < PLANNED_SHARE + IN_PROGRESS_SHARE:
+                status = 'in_progress'
+                start = -rng.uniform(0, 3600)
+                created = start
+            else:
+                status = rng.choices(PAST_STATUSES, PAST_WEIGHTS)[0]
+                start = -rng.uniform(3600, options['days'] * DAY)
+                if status == 'completed':
+                    end = start + max(1.0, options['call_duration'].sample(rng))
+                else:
+                    end = start + rng.uniform(*RING_SECONDS)
+                created = start
+
+            # Dates converties une fois par appel, partagées avec ses participants
+            start_at, end_at, created_at = self.when(start), self.when(end), self.when(created)
+            calls.add((
+                call_id, initiator, 'video' if rng.random() < 0.6 else 'audio', is_group,
+                rng.choice(CALL_TITLES) if is_group else None, status, self.when(scheduled),
+                start_at, end_at, None, created_at, end_at or created_at,
+            ))
+
+            talked = status in ('completed', 'in_progress')
+            for member in members:
+                accepted = member == initiator or talked
+                participants.add((call_id, member, start_at if accepted else None, end_at if accepted else None,
+                                  accepted))
+
+            if talked:
+                last = end if end is not None else 0.0
+                for _ in range(options['messages_per_call'].count(rng)):
+                    messages.add((call_id, rng.choice(members), rng.choice(CHAT_LINES),
+                                  self.when(rng.uniform(start, last))))
+
+            if start is not None:
+                # Négociation entre l'initiateur et chaque autre participant, à tour de rôle :
+                # offres, puis réponses, puis candidats ICE dans les deux sens
+                pending = status == 'in_progress'
+                peers = len(members) - 1
+                for index in range(options['signaling_per_call'].count(rng)):
+                    step, peer = divmod(index, peers)
+                    peer = members[1 + peer]
+                    if step == 0:
+                        sender, receiver, message_type, content = initiator, peer, 'offer', offer
+                    elif step == 1:
+                        sender, receiver, message_type, content = peer, initiator, 'answer', answer
+                    else:
+                        sender, receiver = (initiator, peer) if step % 2 else (peer, initiator)
+                        message_type, content = 'ice-candidate', rng.choice(candidates)
+                    processed = not pending and rng.random() >= options['pending']
+                    signaling.add((call_id, sender, receiver, message_type, content, processed,
+                                   self.when(start + index * 0.05)))
+            call_id += 1
+        return [calls, participants, messages, signaling]
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.7 on 2026-10-19 17:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CallQualitySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('metrics', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('call', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quality_summaries', to='calls.call')),
+                ('participant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='quality_summaries', to='calls.callparticipant')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CallQualitySample',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('jitter_ms', models.FloatField(blank=True, null=True)),
+                ('packet_loss', models.FloatField(blank=True, null=True)),
+                ('rtt_ms', models.FloatField(blank=True, null=True)),
+                ('bitrate_kbps', models.FloatField(blank=True, null=True)),
+                ('call', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quality_samples', to='calls.call')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quality_samples', to='calls.callparticipant')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['call', 'bucket'], name='callquality_call_bucket_idx')],
+                'constraints': [models.UniqueConstraint(fields=('participant', 'bucket'), name='callquality_participant_bucket')],
+            },
+        ),
+    ]
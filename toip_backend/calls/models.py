@@ -60,4 +60,42 @@ class CallMessage(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
-        return f"Message from {self.sender.username} in {self.call}"
\ No newline at end of file
+        return f"Message from {self.sender.username} in {self.call}"
+
+class CallQualitySample(models.Model):
+    """
+    Statistiques WebRTC (getStats) d'un participant, agrégées par période de
+    QUALITY_BUCKET_SECONDS : moyennes des échantillons reçus sur la période
+    """
+    call = models.ForeignKey(Call, on_delete=models.CASCADE, related_name='quality_samples')
+    participant = models.ForeignKey(CallParticipant, on_delete=models.CASCADE, related_name='quality_samples')
+    bucket = models.DateTimeField()
+    samples = models.PositiveIntegerField(default=0)
+    jitter_ms = models.FloatField(blank=True, null=True)
+    packet_loss = models.FloatField(blank=True, null=True)  # Fraction de paquets perdus (0 à 1)
+    rtt_ms = models.FloatField(blank=True, null=True)
+    bitrate_kbps = models.FloatField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['participant', 'bucket'], name='callquality_participant_bucket'),
+        ]
+        indexes = [
+            models.Index(fields=['call', 'bucket'], name='callquality_call_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return f"Quality of {self.participant_id} at {self.bucket}"
+
+
+class CallQualitySummary(models.Model):
+    """Percentiles de qualité calculés à la fin de l'appel (participant vide : appel entier)"""
+    call = models.ForeignKey(Call, on_delete=models.CASCADE, related_name='quality_summaries')
+    participant = models.ForeignKey(CallParticipant, on_delete=models.CASCADE, blank=True, null=True,
+                                    related_name='quality_summaries')
+    samples = models.PositiveIntegerField(default=0)
+    metrics = models.JSONField(default=dict)  # {"jitter_ms": {"p50": ..., "p95": ..., "p99": ..., "max": ...}, ...}
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Quality summary of {self.call_id} ({self.participant_id or 'call'})"
@@ -0,0 +1,283 @@
+"""
+Statistiques de qualité des appels (gigue, pertes, RTT, débit)
+
+Les clients envoient des instantanés de getStats() par lots, en NDJSON (un
+objet par ligne) ou en binaire compact, via la WebSocket de signalisation ou
+l'API REST. Chaque lot est ramené à des périodes de QUALITY_BUCKET_SECONDS
+avant d'être écrit : une requête pour lire les périodes déjà présentes, puis
+un bulk_update et un bulk_create. Les percentiles sont calculés sur ces
+périodes à la fin de l'appel.
+
+Échantillon NDJSON / JSON :
+    {"ts": 1718000000000, "jitter_ms": 12.5, "packet_loss": 0.01,
+     "rtt_ms": 80, "bitrate_kbps": 950}
+ts en millisecondes depuis l'époque ; les métriques absentes sont ignorées.
+Un ts hors de [0, 2100[ est refusé à l'analyse, puis un lot dont un ts sort
+de la durée de l'appel (à QUALITY_CLOCK_SLACK_SECONDS près, horloges des
+clients) est refusé à l'enregistrement.
+
+Format binaire : un octet de version (1), puis des enregistrements de 24
+octets little-endian : ts (double, ms), puis jitter_ms, packet_loss, rtt_ms,
+bitrate_kbps (float32, NaN pour une métrique absente).
+"""
+import json
+import math
+import struct
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from .models import CallQualitySample, CallQualitySummary
+
+METRICS = ('jitter_ms', 'packet_loss', 'rtt_ms', 'bitrate_kbps')
+PERCENTILES = (50, 95, 99)
+BUCKET_SECONDS = getattr(settings, 'CALL_QUALITY_BUCKET_SECONDS', 10)
+MAX_BATCH_SAMPLES = 5000
+CLOCK_SLACK = timedelta(seconds=getattr(settings, 'QUALITY_CLOCK_SLACK_SECONDS', 300))
+# Bornes de ts (ms) : datetime.fromtimestamp échoue bien avant les limites d'un double
+MIN_TS_MS = 0
+MAX_TS_MS = 4102444800000  # 2100-01-01T00:00:00Z
+
+BINARY_VERSION = 1
+BINARY_RECORD = struct.Struct('<d4f')
+
+
+class QualityFormatError(ValueError):
+    pass
+
+
+def _sample(ts, values):
+    if ts is None or not math.isfinite(ts):
+        raise QualityFormatError('ts manquant ou invalide')
+    if not MIN_TS_MS <= ts < MAX_TS_MS:
+        raise QualityFormatError('ts hors limites')
+    metrics = {}
+    for name, value in zip(METRICS, values):
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise QualityFormatError(f'{name} invalide')
+        metrics[name] = float(value)
+    return ts / 1000.0, metrics
+
+
+def parse_json_samples(items):
+    """Liste d'objets JSON déjà décodés -> [(secondes, {métrique: valeur})]"""
+    if not isinstance(items, list):
+        raise QualityFormatError('une liste d\'échantillons est attendue')
+    if len(items) > MAX_BATCH_SAMPLES:
+        raise QualityFormatError(f'au plus {MAX_BATCH_SAMPLES} échantillons par lot')
+    samples = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise QualityFormatError('échantillon invalide')
+        ts = item.get('ts')
+        if isinstance(ts, bool) or not isinstance(ts, (int, float)):
+            ts = None
+        samples.append(_sample(ts, [item.get(name) for name in METRICS]))
+    return samples
+
+
+def parse_ndjson(data):
+    items = []
+    for line in data.splitlines():
+        if line.strip():
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                raise QualityFormatError('ligne NDJSON invalide')
+    return parse_json_samples(items)
+
+
+def parse_binary(data):
+    if not data or data[0] != BINARY_VERSION:
+        raise QualityFormatError('version du format binaire inconnue')
+    body = memoryview(data)[1:]
+    if len(body) % BINARY_RECORD.size:
+        raise QualityFormatError('taille du lot binaire invalide')
+    if len(body) // BINARY_RECORD.size > MAX_BATCH_SAMPLES:
+        raise QualityFormatError(f'au plus {MAX_BATCH_SAMPLES} échantillons par lot')
+    return [
+        _sample(ts, [None if math.isnan(value) else value for value in values])
+        for ts, *values in BINARY_RECORD.iter_unpack(body)
+    ]
+
+
+def _bucket_start(seconds):
+    start = seconds - seconds % BUCKET_SECONDS
+    return datetime.fromtimestamp(start, tz=dt_timezone.utc)
+
+
+def _merge(row, count, metrics):
+    """Moyennes pondérées par le nombre d'échantillons de la période"""
+    total = row.samples + count
+    for name in METRICS:
+        value = metrics.get(name)
+        if value is None:
+            continue
+        current = getattr(row, name)
+        setattr(row, name, value if current is None else (current * row.samples + value * count) / total)
+    row.samples = total
+
+
+def check_call_window(call, samples):
+    """Refuse un lot dont un échantillon sort de la durée de l'appel (appel en cours : jusqu'à maintenant)"""
+    low = (call.start_time or call.created_at) - CLOCK_SLACK
+    high = (call.end_time or timezone.now()) + CLOCK_SLACK
+    for seconds, _ in samples:
+        if not low.timestamp() <= seconds <= high.timestamp():
+            raise QualityFormatError("ts hors de la durée de l'appel")
+
+
+def _locked_rows(participant, buckets):
+    return {
+        row.bucket: row for row in CallQualitySample.objects.select_for_update().filter(
+            participant=participant, bucket__in=list(buckets))
+    }
+
+
+def ingest_samples(participant, samples):
+    """
+    Ajoute un lot d'échantillons aux séries du participant ; retourne le nombre de périodes touchées.
+    QualityFormatError si un échantillon sort de la durée de l'appel.
+    """
+    if not samples:
+        return 0
+    check_call_window(participant.call, samples)
+    buckets = {}
+    for seconds, metrics in samples:
+        entry = buckets.setdefault(_bucket_start(seconds), [0, {}, {}])
+        entry[0] += 1
+        sums, counts = entry[1], entry[2]
+        for name, value in metrics.items():
+            sums[name] = sums.get(name, 0.0) + value
+            counts[name] = counts.get(name, 0) + 1
+
+    # select_for_update ne verrouille pas une période encore absente : un lot concurrent
+    # (WebSocket et REST, deux workers) peut la créer avant nous. La contrainte d'unicité
+    # le signale et le lot est rejoué une fois, la période étant alors mise à jour.
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                existing = _locked_rows(participant, buckets)
+                created, updated = [], []
+                for bucket, (count, sums, counts) in buckets.items():
+                    metrics = {name: sums[name] / counts[name] for name in sums}
+                    row = existing.get(bucket)
+                    if row is None:
+                        row = CallQualitySample(call_id=participant.call_id, participant=participant, bucket=bucket)
+                        created.append(row)
+                    else:
+                        updated.append(row)
+                    _merge(row, count, metrics)
+                CallQualitySample.objects.bulk_create(created)
+                CallQualitySample.objects.bulk_update(updated, ['samples', *METRICS])
+            return len(buckets)
+        except IntegrityError:
+            if attempt:
+                raise
+
+
+def call_series(call):
+    """Série de l'appel entier : moyennes des participants par période, débits additionnés"""
+    series = {}
+    rows = CallQualitySample.objects.filter(call=call).order_by('bucket').values_list(
+        'bucket', 'samples', *METRICS)
+    for bucket, samples, *values in rows:
+        point = series.setdefault(bucket, {'bucket': bucket, 'samples': 0, 'participants': 0,
+                                           **{name: [] for name in METRICS}})
+        point['samples'] += samples
+        point['participants'] += 1
+        for name, value in zip(METRICS, values):
+            if value is not None:
+                point[name].append(value)
+    for point in series.values():
+        for name in METRICS:
+            values = point[name]
+            if not values:
+                point[name] = None
+            elif name == 'bitrate_kbps':
+                point[name] = sum(values)
+            else:
+                point[name] = sum(values) / len(values)
+    return list(series.values())
+
+
+def participant_series(call):
+    """{participant_id: [périodes]}"""
+    series = {}
+    rows = CallQualitySample.objects.filter(call=call).order_by('participant_id', 'bucket').values(
+        'participant_id', 'bucket', 'samples', *METRICS)
+    for row in rows:
+        series.setdefault(row.pop('participant_id'), []).append(row)
+    return series
+
+
+def percentile(ordered, p):
+    """Percentile par interpolation linéaire sur une liste triée"""
+    position = (len(ordered) - 1) * p / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _summarize(rows):
+    metrics = {}
+    for index, name in enumerate(METRICS):
+        values = sorted(row[index + 2] for row in rows if row[index + 2] is not None)
+        if values:
+            metrics[name] = {f'p{p}': round(percentile(values, p), 3) for p in PERCENTILES}
+            metrics[name]['max'] = round(values[-1], 3)
+    return metrics
+
+
+def summarize_call(call):
+    """
+    (Re)calcule les percentiles par participant et pour l'appel entier, sur
+    les moyennes de période, et remplace les résumés existants
+    """
+    rows = list(CallQualitySample.objects.filter(call=call).values_list(
+        'participant_id', 'samples', *METRICS))
+    by_participant = {}
+    for row in rows:
+        by_participant.setdefault(row[0], []).append(row)
+
+    summaries = [
+        CallQualitySummary(call=call, participant_id=participant_id,
+                           samples=sum(row[1] for row in participant_rows),
+                           metrics=_summarize(participant_rows))
+        for participant_id, participant_rows in by_participant.items()
+    ]
+    if rows:
+        summaries.append(CallQualitySummary(call=call, samples=sum(row[1] for row in rows),
+                                            metrics=_summarize(rows)))
+    with transaction.atomic():
+        CallQualitySummary.objects.filter(call=call).delete()
+        CallQualitySummary.objects.bulk_create(summaries)
+    return summaries
+
+
+class NdjsonParser(BaseParser):
+    """Lot d'échantillons NDJSON (un objet JSON par ligne)"""
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return parse_ndjson(stream.read().decode('utf-8'))
+        except (QualityFormatError, UnicodeDecodeError) as e:
+            raise ParseError(str(e))
+
+
+class QualityBinaryParser(BaseParser):
+    """Lot d'échantillons au format binaire compact (voir en tête du module)"""
+    media_type = 'application/octet-stream'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return parse_binary(stream.read())
+        except QualityFormatError as e:
+            raise ParseError(str(e))
@@ -1,6 +1,9 @@
 from rest_framework import serializers
-from .models import Call, CallParticipant, CallMessage
+from .models import Call, CallParticipant, CallMessage, CallQualitySummary
 from users.serializers import UserSerializer
+from monitoring.logs import get_logger
+
+logger = get_logger('calls')
 
 class CallParticipantSerializer(serializers.ModelSerializer):
     user_details = UserSerializer(source='user', read_only=True)
@@ -18,6 +21,11 @@ class CallMessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'sender', 'sender_details', 'content', 'timestamp']
         read_only_fields = ['id', 'timestamp']
 
+class CallQualitySummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CallQualitySummary
+        fields = ['participant', 'samples', 'metrics', 'created_at']
+
 class CallSerializer(serializers.ModelSerializer):
     initiator_details = UserSerializer(source='initiator', read_only=True)
     participants_details = CallParticipantSerializer(source='call_participants', many=True, read_only=True)
@@ -34,7 +42,6 @@ class CallSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         participants_data = self.context.get('participants', [])
         call = Call.objects.create(**validated_data)
-        print(f"Participants reçus dans le sérialiseur: {participants_data}")
 
         # Ajouter l'initiateur comme participant
         CallParticipant.objects.create(
@@ -45,8 +52,6 @@ class CallSerializer(serializers.ModelSerializer):
         
         # Ajouter les autres participants
         for participant_id in participants_data:
-            print(f"Tentative d'ajout du participant: {participant_id}")
-
             try:
                 from users.models import User
                 user = User.objects.get(id=participant_id)
@@ -55,8 +60,7 @@ class CallSerializer(serializers.ModelSerializer):
                     user=user,
                     has_accepted=False
                 )
-                print(f"Participant {user.username} ajouté avec succès à l'appel {call.id}")
             except User.DoesNotExist:
-                pass
+                logger.warning('call.unknown_participant', call_id=call.id, user_id=participant_id)
                 
         return call
\ No newline at end of file
@@ -1,3 +1,237 @@
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+import redis
+from django.core.management import call_command
+from django.db import connections
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from toip_backend import routers
+from . import quality
+from toip_backend.budgets import EndpointBudgetTestCase, seed_users
+from contacts.models import Contact
+from users.models import User
+from .models import Call, CallParticipant, CallMessage
+
+CALLS = 240            # appels où l'utilisateur mesuré est initiateur ou participant
+PARTICIPANTS = 4       # participants par appel, initiateur compris
+MESSAGES = 6           # messages de chat par appel
+
+
+class CallEndpointBudgetTests(EndpointBudgetTestCase):
+    """Listes d'appels : CallSerializer imbrique initiateur, participants et messages"""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = seed_users('budget_call_', 60)
+        cls.user, others = users[0], users[1:]
+        now = timezone.now()
+        statuses = ['completed', 'missed', 'cancelled', 'planned', 'in_progress']
+
+        calls = []
+        for index in range(CALLS):
+            status = statuses[index % len(statuses)]
+            start = now - timedelta(hours=index)
+            calls.append(Call(
+                # Un appel sur deux est initié par un autre utilisateur : le filtre passe par les participants
+                initiator=cls.user if index % 2 else others[index % len(others)],
+                call_type='video' if index % 3 else 'audio', is_group_call=True, title=f'Appel {index}',
+                status=status,
+                scheduled_time=now + timedelta(days=index + 1) if status == 'planned' else None,
+                start_time=start if status != 'planned' else None,
+                end_time=start + timedelta(minutes=20) if status in ('completed', 'missed', 'cancelled') else None,
+            ))
+        Call.objects.bulk_create(calls)
+
+        participants, messages = [], []
+        for index, call in enumerate(calls):
+            members = {call.initiator, cls.user}
+            offset = index
+            while len(members) < PARTICIPANTS:
+                members.add(others[offset % len(others)])
+                offset += 7
+            participants += [CallParticipant(call=call, user=member, has_accepted=True) for member in members]
+            members = list(members)
+            messages += [CallMessage(call=call, sender=members[number % len(members)], content=f'Message {number}')
+                         for number in range(MESSAGES)]
+        CallParticipant.objects.bulk_create(participants)
+        CallMessage.objects.bulk_create(messages)
+
+    def setUp(self):
+        self.authenticate(self.user)
+
+    def test_list(self):
+        response = self.assertWithinBudget('get', '/api/calls/me/', queries=4, latency_ms=450)
+        self.assertEqual(len(response.data), CALLS)
+        self.assertEqual(len(response.data[0]['participants_details']), PARTICIPANTS)
+        self.assertEqual(len(response.data[0]['messages']), MESSAGES)
+
+    def test_history(self):
+        response = self.assertWithinBudget('get', '/api/calls/me/history/', queries=4, latency_ms=300)
+        self.assertEqual(len(response.data), CALLS * 3 // 5)
+        self.assertTrue(all(call['initiator_details'] for call in response.data))
+
+    def test_scheduled(self):
+        response = self.assertWithinBudget('get', '/api/calls/me/scheduled/', queries=4, latency_ms=150)
+        self.assertEqual(len(response.data), CALLS // 5)
+        times = [call['scheduled_time'] for call in response.data]
+        self.assertEqual(times, sorted(times))
+
+
+REPLICA = 'replica_test'
+
+
+class FakePins:
+    """Clés d'épinglage en mémoire, à la place de Redis"""
+
+    def __init__(self):
+        self.keys = {}
+
+    def exists(self, key):
+        return int(key in self.keys)
+
+    def set(self, key, value, ex=None):
+        self.keys[key] = ex
+
+
+class ReplicaRoutingTests(TestCase):
+    """Historique lu sur une réplique (fichier SQLite local migré), sauf juste après une écriture"""
+    @classmethod
+    def setUpClass(cls):
+        # Alias déclaré ici plutôt qu'en attribut : le lanceur ne prépare ni ne vérifie une base qu'il ne connaît pas
+        cls.databases = {'default', REPLICA}
+        cls.directory = tempfile.mkdtemp(prefix='replica_')
+        connections.settings[REPLICA] = {**connections.settings['default'], 'ENGINE': 'django.db.backends.sqlite3',
+                                         'NAME': f'{cls.directory}/replica.sqlite3', 'OPTIONS': {}}
+        call_command('migrate', database=REPLICA, verbosity=0, interactive=False)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='replica_reader', password='replica-pass-1')
+        # Même utilisateur sur la réplique ; un appel différent de chaque côté pour savoir où la lecture a eu lieu
+        User.objects.using(REPLICA).bulk_create([User(id=cls.user.id, username=cls.user.username, password='!')])
+        for alias, title in (('default', 'principale'), (REPLICA, 'réplique')):
+            call = Call.objects.using(alias).create(initiator_id=cls.user.id, call_type='audio', title=title,
+                                                    status='completed', end_time=timezone.now())
+            CallParticipant.objects.using(alias).create(call=call, user_id=cls.user.id, has_accepted=True)
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.pins = FakePins()
+        for patcher in (mock.patch.object(routers, 'REPLICAS', [REPLICA]),
+                        mock.patch.object(routers, 'get_sync_client', return_value=self.pins)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def history_titles(self):
+        response = self.client.get('/api/calls/me/history/')
+        self.assertEqual(response.status_code, 200)
+        return [call['title'] for call in response.data]
+
+    def test_history_read_on_replica(self):
+        self.assertEqual(self.history_titles(), ['réplique'])
+
+    def test_reads_own_writes_after_update(self):
+        response = self.client.patch('/api/users/users/update_profile/', {'first_name': 'Ada'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.pins.keys, {routers.pin_key(self.user.id): routers.STICKY_SECONDS})
+        self.assertEqual(self.history_titles(), ['principale'])
+
+    def test_other_actions_stay_on_primary(self):
+        response = self.client.get('/api/calls/me/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([call['title'] for call in response.data], ['réplique'])
+        call = Call.objects.get(title='principale')
+        response = self.client.get(f'/api/calls/me/{call.id}/')
+        self.assertEqual(response.data['title'], 'principale')
+
+    def test_primary_when_redis_unavailable(self):
+        with mock.patch.object(self.pins, 'exists', side_effect=redis.ConnectionError), \
+                self.assertLogs('toip_backend', 'WARNING'):
+            self.assertEqual(self.history_titles(), ['principale'])
+
+
+class QualityIngestTests(TestCase):
+    """Échantillons getStats() : bornes de ts et création concurrente d'une période"""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username='quality_user', password='quality-pass-1')
+        cls.call = Call.objects.create(initiator=user, call_type='audio', status='in_progress',
+                                       start_time=timezone.now() - timedelta(minutes=10))
+        cls.participant = CallParticipant.objects.create(call=cls.call, user=user, has_accepted=True)
+
+    def test_out_of_range_ts_rejected(self):
+        for ts in (1e20, -1e15, quality.MAX_TS_MS):
+            with self.assertRaises(quality.QualityFormatError):
+                quality.parse_json_samples([{'ts': ts, 'jitter_ms': 5}])
+
+    def test_ts_outside_call_rejected(self):
+        samples = quality.parse_json_samples([{'ts': 1_000_000_000_000, 'jitter_ms': 5}])
+        with self.assertRaises(quality.QualityFormatError):
+            quality.ingest_samples(self.participant, samples)
+        self.assertFalse(quality.CallQualitySample.objects.exists())
+
+    def test_bucket_created_concurrently_is_merged(self):
+        now_ms = timezone.now().timestamp() * 1000
+        quality.ingest_samples(self.participant, quality.parse_json_samples([{'ts': now_ms, 'jitter_ms': 10}]))
+        # Période créée par un autre lot entre la lecture verrouillée et l'insertion : pas vue au premier essai
+        real = quality._locked_rows
+        attempts = []
+
+        def racing(participant, buckets):
+            attempts.append(buckets)
+            return {} if len(attempts) == 1 else real(participant, buckets)
+
+        with mock.patch.object(quality, '_locked_rows', side_effect=racing):
+            quality.ingest_samples(self.participant, quality.parse_json_samples([{'ts': now_ms, 'jitter_ms': 20}]))
+        self.assertEqual(len(attempts), 2)
+        row = quality.CallQualitySample.objects.get()
+        self.assertEqual(row.samples, 2)
+        self.assertAlmostEqual(row.jitter_ms, 15)
+
+
+class CallContactHistoryTests(TestCase):
+    """Fin d'appel : last_contact et call_count entre les seuls participants qui ont rejoint"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.initiator, cls.joined, cls.invited = seed_users('history_call_', 3)
+        users = (cls.initiator, cls.joined, cls.invited)
+        Contact.objects.bulk_create([Contact(owner=owner, contact_user=other)
+                                     for owner in users for other in users if owner != other])
+        cls.token = Token.objects.create(user=cls.initiator)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.call = Call.objects.create(initiator=self.initiator, call_type='audio', status='in_progress',
+                                        start_time=timezone.now())
+        CallParticipant.objects.bulk_create([
+            CallParticipant(call=self.call, user=self.initiator, has_accepted=True),
+            CallParticipant(call=self.call, user=self.joined, has_accepted=True, joined_at=timezone.now()),
+            CallParticipant(call=self.call, user=self.invited),
+        ])
 
-# Create your tests here.
+    def test_end_skips_unanswered_invitees(self):
+        response = self.client.post(f'/api/calls/me/{self.call.id}/end/')
+        self.assertEqual(response.status_code, 200)
+        counted = set(Contact.objects.filter(call_count=1).values_list('owner_id', 'contact_user_id'))
+        self.assertEqual(counted, {(self.initiator.id, self.joined.id), (self.joined.id, self.initiator.id)})
+        self.assertFalse(Contact.objects.filter(contact_user=self.invited, last_contact__isnull=False).exists())
@@ -1,17 +1,38 @@
 from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 from django.utils import timezone
-from django.db.models import Q
+from django.db.models import Prefetch, Q
 from django.shortcuts import get_object_or_404
 
 from .models import Call, CallParticipant, CallMessage
-from .serializers import CallSerializer, CallParticipantSerializer, CallMessageSerializer
+from .serializers import (CallSerializer, CallParticipantSerializer, CallMessageSerializer,
+                          CallQualitySummarySerializer)
+from .quality import (BUCKET_SECONDS, NdjsonParser, QualityBinaryParser, QualityFormatError,
+                      call_series, ingest_samples, parse_json_samples, participant_series,
+                      summarize_call)
 from users.models import User, UserStatus
+from contacts.models import Contact
 from signaling.views import notify_incoming_call  # Nouvelle importation
+from signaling import replay, rooms
+from monitoring.logs import get_logger
+from toip_backend.routers import ReplicaReadMixin
 
-class CallViewSet(viewsets.ModelViewSet):
+logger = get_logger('calls')
+
+def with_details(queryset):
+    """Précharge l'initiateur, les participants et les messages sérialisés par CallSerializer"""
+    return queryset.select_related('initiator').prefetch_related(
+        Prefetch('call_participants', queryset=CallParticipant.objects.select_related('user')),
+        Prefetch('messages', queryset=CallMessage.objects.select_related('sender')),
+    )
+
+
+class CallViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     serializer_class = CallSerializer
+    # Listes et historiques lus sur une réplique (voir toip_backend.routers)
+    replica_actions = ('list', 'history', 'scheduled')
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [filters.OrderingFilter]
     ordering_fields = ['created_at', 'scheduled_time', 'start_time']
@@ -20,22 +41,23 @@ class CallViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         user = self.request.user
         # Récupérer tous les appels où l'utilisateur est initiateur ou participant
-        return Call.objects.filter(
+        queryset = Call.objects.filter(
             Q(initiator=user) | Q(participants=user)
         ).distinct()
+        # Les actions sur un appel modifient ses participants avant de le sérialiser : pas de cache préchargé
+        if self.action == 'list':
+            queryset = with_details(queryset)
+        return queryset
     
     def create(self, request, *args, **kwargs):
         # Récupérer les participants de request.data
         participants = request.data.get('participants', [])
         
-        print(f"Request data received: {request.data}")
-        print(f"Participants extracted: {participants}")
-        
         # Créer le serializer avec le contexte incluant les participants
         serializer = self.get_serializer(data=request.data, context={'participants': participants})
         
         if not serializer.is_valid():
-            print(f"Serializer validation errors: {serializer.errors}")
+            logger.info('call.invalid', user_id=request.user.id, errors=serializer.errors)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         self.perform_create(serializer)
@@ -46,7 +68,8 @@ class CallViewSet(viewsets.ModelViewSet):
             for participant_id in participants:
                 # Notifier chaque participant via WebSocket
                 notify_incoming_call(call, participant_id)
-                print(f"Notification d'appel entrant envoyée à l'utilisateur {participant_id}")
+        logger.info('call.created', call_id=call.id, user_id=request.user.id, participants=len(participants),
+                    status=call.status)
         
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
@@ -111,6 +134,11 @@ class CallViewSet(viewsets.ModelViewSet):
         call.status = 'completed'
         call.end_time = timezone.now()
         call.save()
+
+        # Mettre à jour last_contact entre tous les participants de l'appel
+        Contact.record_call(self._call_user_ids(call), call.end_time)
+        summarize_call(call)
+        replay.clear_call(call.id)
         
         # Mettre à jour le statut de tous les participants
         for participant in call.call_participants.filter(left_at__isnull=True):
@@ -192,16 +220,80 @@ class CallViewSet(viewsets.ModelViewSet):
             call.status = 'completed'
             call.end_time = timezone.now()
             call.save()
+            Contact.record_call(self._call_user_ids(call), call.end_time)
+            summarize_call(call)
+            replay.clear_call(call.id)
+        else:
+            # Mettre à jour last_contact entre l'utilisateur (s'il a rejoint) et les autres participants
+            user_ids = self._call_user_ids(call)
+            if request.user.id in user_ids:
+                Contact.touch_last_contact(request.user.id, user_ids)
         
         serializer = self.get_serializer(call)
         return Response(serializer.data)
     
+    def _call_user_ids(self, call):
+        """Identifiants de l'initiateur et des participants qui ont rejoint l'appel (invités sans réponse exclus)"""
+        user_ids = set(call.call_participants.filter(joined_at__isnull=False).values_list('user_id', flat=True))
+        user_ids.add(call.initiator_id)
+        return user_ids
+
+    @action(detail=True, methods=['get'])
+    def presence(self, request, pk=None):
+        """Participants connectés à la signalisation de l'appel, d'après le registre partagé des salles"""
+        call = self.get_object()
+        state = rooms.room_state_sync(call.id)
+        if state is None:
+            return Response({"detail": "Registre des salles indisponible."},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({'call': call.id, 'members': state['members'], 'connections': len(state['connections'])})
+
+    @action(detail=True, methods=['get', 'post'],
+            parser_classes=[JSONParser, NdjsonParser, QualityBinaryParser])
+    def quality(self, request, pk=None):
+        """
+        POST : lot d'échantillons getStats() du participant (JSON, NDJSON ou binaire, voir calls.quality)
+        GET : séries par période de l'appel et des participants, et percentiles calculés à la fin de l'appel
+        """
+        call = self.get_object()
+
+        if request.method == 'GET':
+            return Response({
+                'bucket_seconds': BUCKET_SECONDS,
+                'call': call_series(call),
+                'participants': participant_series(call),
+                'summaries': CallQualitySummarySerializer(call.quality_summaries.all(), many=True).data,
+            })
+
+        participant = call.call_participants.filter(user=request.user).first()
+        if participant is None:
+            return Response({"detail": "Vous n'êtes pas participant de cet appel."},
+                            status=status.HTTP_403_FORBIDDEN)
+        if call.status != 'in_progress':
+            return Response({"detail": "L'appel n'est pas en cours."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        samples = request.data
+        if request.content_type.startswith('application/json'):
+            # Corps JSON : liste d'échantillons ou {"samples": [...]}
+            if isinstance(samples, dict):
+                samples = samples.get('samples')
+            try:
+                samples = parse_json_samples(samples)
+            except QualityFormatError as e:
+                return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            buckets = ingest_samples(participant, samples)
+        except QualityFormatError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'buckets': buckets}, status=status.HTTP_201_CREATED)
+
     @action(detail=False, methods=['get'])
     def scheduled(self, request):
         # Récupérer les appels planifiés à venir
         user = request.user
         now = timezone.now()
-        scheduled_calls = Call.objects.filter(
+        scheduled_calls = with_details(Call.objects).filter(
             (Q(initiator=user) | Q(participants=user)),
             status='planned',
             scheduled_time__gt=now
@@ -214,7 +306,7 @@ class CallViewSet(viewsets.ModelViewSet):
     def history(self, request):
         # Récupérer l'historique des appels
         user = request.user
-        completed_calls = Call.objects.filter(
+        completed_calls = with_details(Call.objects).filter(
             (Q(initiator=user) | Q(participants=user)),
             status__in=['completed', 'missed', 'cancelled']
         ).distinct().order_by('-end_time')
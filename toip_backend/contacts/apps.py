@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_delete
 
 
 class ContactsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'contacts'
+
+    def ready(self):
+        from users.models import User
+        from .models import record_removed_contacts
+        pre_delete.connect(record_removed_contacts, sender=User, dispatch_uid='contacts.removed_contacts')
@@ -0,0 +1,294 @@
+"""
+Import et export en masse du répertoire (CSV et vCard)
+
+Les lignes sont lues en flux et traitées par lots : les utilisateurs sont
+résolus par email / téléphone en une requête par lot, puis les contacts sont
+insérés avec bulk_create(ignore_conflicts=True) sur la contrainte
+unique_together (owner, contact_user).
+
+Les exports sont des générateurs de lignes ; sous ASGI, aiter_export les
+adapte en itérateur asynchrone (StreamingHttpResponse lirait sinon tout
+l'itérateur synchrone en mémoire avant d'envoyer la réponse).
+"""
+import csv
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from django.db.models import Q
+
+from users.models import User, normalize_phone, normalize_search
+from .models import Contact, ContactChange
+
+CSV_FIELDS = ['email', 'phone', 'nickname', 'notes', 'favorite', 'username']
+DEFAULT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+# Lignes lues par requête SQL à l'export, et par passage dans un thread sous ASGI
+EXPORT_CHUNK_SIZE = 2000
+
+_TRUE_VALUES = {'1', 'true', 'yes', 'oui', 'y', 'x'}
+
+
+def iter_csv_rows(stream):
+    """Lit un CSV avec en-tête (colonnes de CSV_FIELDS, insensibles à la casse)"""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield {(key or '').strip().lower(): (value or '').strip() for key, value in row.items()}
+
+
+def _unfold_vcard_lines(stream):
+    """Déplie les lignes vCard repliées (RFC 6350, section 3.2)"""
+    current = None
+    for raw in stream:
+        line = raw.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def _unescape_vcard(value):
+    return (value.replace('\\n', '\n').replace('\\N', '\n')
+            .replace('\\,', ',').replace('\\;', ';').replace('\\\\', '\\'))
+
+
+def iter_vcard_rows(stream):
+    """Lit une suite de vCards et renvoie une ligne par carte (premier EMAIL et TEL)"""
+    card = None
+    for line in _unfold_vcard_lines(stream):
+        if not line.strip():
+            continue
+        name, _, value = line.partition(':')
+        prop = name.split(';', 1)[0].split('.')[-1].upper()
+        if prop == 'BEGIN' and value.strip().upper() == 'VCARD':
+            card = {}
+        elif prop == 'END' and value.strip().upper() == 'VCARD':
+            if card is not None:
+                yield card
+            card = None
+        elif card is not None:
+            value = _unescape_vcard(value.strip())
+            if prop == 'EMAIL':
+                card.setdefault('email', value)
+            elif prop == 'TEL':
+                card.setdefault('phone', value)
+            elif prop == 'NICKNAME':
+                card['nickname'] = value
+            elif prop == 'FN':
+                card.setdefault('nickname', value)
+            elif prop == 'NOTE':
+                card['notes'] = value
+
+
+ROW_READERS = {
+    'csv': iter_csv_rows,
+    'vcard': iter_vcard_rows,
+}
+
+
+def detect_format(filename, default='csv'):
+    filename = (filename or '').lower()
+    if filename.endswith(('.vcf', '.vcard')):
+        return 'vcard'
+    if filename.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+class ImportReport:
+    """Résultat d'un import : compteurs et erreurs ligne par ligne"""
+
+    def __init__(self):
+        self.total = 0
+        self.created = 0
+        self.skipped = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, row_number, error):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row_number, 'error': error})
+
+    def as_dict(self):
+        return {
+            'total': self.total,
+            'created': self.created,
+            'skipped': self.skipped,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+
+def _resolve_users(batch):
+    """Résout email / téléphone vers les utilisateurs en une requête pour tout le lot"""
+    emails = {normalize_search(row['email']) for _, row in batch if row.get('email')}
+    phones = {normalize_phone(row['phone']) for _, row in batch if row.get('phone')}
+    if not emails and not phones:
+        return {}, {}
+
+    by_email, by_phone = {}, {}
+    users = User.objects.filter(
+        Q(email_normalized__in=emails) | Q(phone_normalized__in=phones)
+    ).values_list('id', 'email_normalized', 'phone_normalized')
+    for user_id, email, phone_normalized in users:
+        if email:
+            by_email.setdefault(email, user_id)
+        if phone_normalized:
+            by_phone.setdefault(phone_normalized, user_id)
+    return by_email, by_phone
+
+
+def _import_batch(owner, batch, report):
+    by_email, by_phone = _resolve_users(batch)
+
+    pending = {}
+    for row_number, row in batch:
+        email = normalize_search(row.get('email'))
+        phone = row.get('phone') or ''
+        if not email and not phone:
+            report.add_error(row_number, "email ou téléphone requis")
+            continue
+
+        user_id = by_email.get(email) if email else None
+        if user_id is None and phone:
+            user_id = by_phone.get(normalize_phone(phone))
+        if user_id is None:
+            report.add_error(row_number, "utilisateur introuvable")
+            continue
+        if user_id == owner.id:
+            report.add_error(row_number, "impossible de s'ajouter soi-même comme contact")
+            continue
+
+        nickname = row.get('nickname') or None
+        if nickname and len(nickname) > Contact._meta.get_field('nickname').max_length:
+            report.add_error(row_number, "surnom trop long")
+            continue
+        if phone and len(phone) > Contact._meta.get_field('phone').max_length:
+            report.add_error(row_number, "numéro de téléphone trop long")
+            continue
+        if user_id in pending:
+            report.skipped += 1
+            continue
+
+        pending[user_id] = Contact(
+            owner=owner,
+            contact_user_id=user_id,
+            nickname=nickname,
+            notes=row.get('notes') or None,
+            phone=phone or None,
+            is_favorite=(row.get('favorite') or '').lower() in _TRUE_VALUES,
+        )
+
+    if not pending:
+        return
+
+    existing = set(Contact.objects.filter(
+        owner=owner, contact_user_id__in=pending.keys()
+    ).values_list('contact_user_id', flat=True))
+    to_create = [contact for user_id, contact in pending.items() if user_id not in existing]
+    report.skipped += len(existing)
+    if not to_create:
+        return
+
+    Contact.objects.bulk_create(to_create, ignore_conflicts=True)
+    # Lignes réellement insérées : un contact ajouté entre-temps par une autre requête (conflit
+    # ignoré) porte un autre created_at que celui attribué ici par bulk_create
+    stamps = {contact.contact_user_id: contact.created_at for contact in to_create}
+    created_ids = [
+        contact_id for contact_id, user_id, created_at in Contact.objects.filter(
+            owner=owner, contact_user_id__in=stamps.keys()
+        ).values_list('id', 'contact_user_id', 'created_at')
+        if created_at == stamps[user_id]
+    ]
+    ContactChange.record(owner.id, 'contact', created_ids)
+    report.created += len(created_ids)
+    report.skipped += len(to_create) - len(created_ids)
+
+
+def import_contacts(owner, rows, batch_size=DEFAULT_BATCH_SIZE):
+    """Importe un itérable de lignes (dicts) dans le répertoire de owner"""
+    report = ImportReport()
+    batch = []
+    for row_number, row in enumerate(rows, start=1):
+        report.total += 1
+        batch.append((row_number, row))
+        if len(batch) >= batch_size:
+            _import_batch(owner, batch, report)
+            batch = []
+    if batch:
+        _import_batch(owner, batch, report)
+    return report
+
+
+class _Echo:
+    """Pseudo-buffer pour csv.writer : renvoie la ligne au lieu de l'écrire"""
+
+    def write(self, value):
+        return value
+
+
+def _export_rows(owner):
+    return Contact.objects.filter(owner=owner).order_by('id').values_list(
+        'contact_user__email', 'phone', 'contact_user__phone_number', 'nickname',
+        'notes', 'is_favorite', 'contact_user__username',
+        'contact_user__first_name', 'contact_user__last_name',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def iter_csv_export(owner):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_FIELDS)
+    for email, phone, user_phone, nickname, notes, favorite, username, _, _ in _export_rows(owner):
+        yield writer.writerow([
+            email or '', phone or user_phone or '', nickname or '', notes or '',
+            'true' if favorite else 'false', username,
+        ])
+
+
+def _escape_vcard(value):
+    return (value.replace('\\', '\\\\').replace('\n', '\\n')
+            .replace(',', '\\,').replace(';', '\\;'))
+
+
+def iter_vcard_export(owner):
+    for email, phone, user_phone, nickname, notes, _, username, first_name, last_name in _export_rows(owner):
+        full_name = f"{first_name} {last_name}".strip() or username
+        lines = [
+            'BEGIN:VCARD',
+            'VERSION:3.0',
+            f'FN:{_escape_vcard(full_name)}',
+            f'N:{_escape_vcard(last_name)};{_escape_vcard(first_name)};;;',
+        ]
+        if nickname:
+            lines.append(f'NICKNAME:{_escape_vcard(nickname)}')
+        if email:
+            lines.append(f'EMAIL:{_escape_vcard(email)}')
+        if phone or user_phone:
+            lines.append(f'TEL:{_escape_vcard(phone or user_phone)}')
+        if notes:
+            lines.append(f'NOTE:{_escape_vcard(notes)}')
+        lines.append('END:VCARD')
+        yield '\r\n'.join(lines) + '\r\n'
+
+
+async def aiter_export(exporter, owner):
+    """Itérateur asynchrone d'un export : chaque lot de lignes est produit dans le thread de la requête"""
+    lines = exporter(owner)
+    next_chunk = sync_to_async(lambda: ''.join(islice(lines, EXPORT_CHUNK_SIZE)))
+    try:
+        while chunk := await next_chunk():
+            yield chunk
+    finally:
+        # Client déconnecté : fermer le générateur (et son curseur) dans le même thread
+        await sync_to_async(lines.close)()
+
+
+EXPORTERS = {
+    'csv': (iter_csv_export, 'text/csv', 'contacts.csv'),
+    'vcard': (iter_vcard_export, 'text/vcard', 'contacts.vcf'),
+}
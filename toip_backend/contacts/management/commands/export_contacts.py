@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.models import User
+from contacts.bulk import EXPORTERS
+
+
+class Command(BaseCommand):
+    help = "Exporte en flux le répertoire d'un utilisateur (CSV ou vCard) sur la sortie standard"
+
+    def add_arguments(self, parser):
+        parser.add_argument('owner', help="username du propriétaire du répertoire")
+        parser.add_argument('--type', choices=sorted(EXPORTERS), default='csv')
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(username=options['owner'])
+        except User.DoesNotExist:
+            raise CommandError(f"Utilisateur introuvable: {options['owner']}")
+
+        exporter = EXPORTERS[options['type']][0]
+        for chunk in exporter(owner):
+            self.stdout.write(chunk, ending='')
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.models import User
+from contacts.bulk import ROW_READERS, DEFAULT_BATCH_SIZE, detect_format, import_contacts
+
+
+class Command(BaseCommand):
+    help = "Importe en masse des contacts (CSV ou vCard) dans le répertoire d'un utilisateur"
+
+    def add_arguments(self, parser):
+        parser.add_argument('owner', help="username du propriétaire du répertoire")
+        parser.add_argument('path', help="fichier CSV ou vCard")
+        parser.add_argument('--type', choices=sorted(ROW_READERS), help="format du fichier (déduit de l'extension par défaut)")
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(username=options['owner'])
+        except User.DoesNotExist:
+            raise CommandError(f"Utilisateur introuvable: {options['owner']}")
+
+        file_format = options['type'] or detect_format(options['path'])
+        with open(options['path'], encoding='utf-8-sig', newline='') as stream:
+            report = import_contacts(owner, ROW_READERS[file_format](stream), batch_size=options['batch_size'])
+
+        for error in report.errors:
+            self.stderr.write(f"ligne {error['row']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{report.total} lignes, {report.created} créés, {report.skipped} ignorés, {report.error_count} erreurs"
+        ))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from contacts.models import CHANGE_RETENTION_DAYS, ContactChange
+
+
+class Command(BaseCommand):
+    help = ("Purge le journal de synchronisation des répertoires au-delà de la rétention "
+            "(les clients aux jetons plus anciens refont une synchronisation complète)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=CHANGE_RETENTION_DAYS,
+                            help=f"rétention en jours (défaut : {CHANGE_RETENTION_DAYS})")
+
+    def handle(self, *args, **options):
+        deleted = ContactChange.prune(options['days'])
+        self.stdout.write(self.style.SUCCESS(f"{deleted} modifications supprimées"))
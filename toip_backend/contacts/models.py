@@ -1,7 +1,16 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
 from users.models import User
 from django.utils import timezone
 
+# Synchronisation incrémentale (ContactChange) : jetons plus anciens que la
+# rétention à renouveler par une synchronisation complète, et délai au-delà
+# duquel une modification est supposée validée (transactions plus courtes)
+CHANGE_RETENTION_DAYS = getattr(settings, 'CONTACT_CHANGE_RETENTION_DAYS', 30)
+SYNC_SAFETY_SECONDS = getattr(settings, 'CONTACT_SYNC_SAFETY_SECONDS', 60)
+
 
 class ContactGroup(models.Model):
     """Groupe de contacts pour organiser les contacts"""
@@ -25,15 +34,60 @@ class Contact(models.Model):
     # New fields
     phone = models.CharField(max_length=20, blank=True, null=True)
     last_contact = models.DateTimeField(blank=True, null=True)
+    call_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         # Assurer qu'un utilisateur ne peut pas ajouter le même contact plusieurs fois
         unique_together = ('owner', 'contact_user')
+        # Index servant les listes "récents" et "fréquents" sans trier tout le répertoire
+        indexes = [
+            models.Index(fields=['owner', '-last_contact'], name='contact_owner_recent_idx'),
+            models.Index(fields=['owner', '-call_count'], name='contact_owner_frequent_idx'),
+        ]
 
     def __str__(self):
         nickname = self.nickname or self.contact_user.username
         return f"{self.owner.username}'s contact: {nickname}"
 
+    @classmethod
+    def record_call(cls, user_ids, when=None):
+        """
+        Met à jour last_contact et call_count pour toutes les paires
+        (owner, contact_user) parmi les utilisateurs d'un appel, en une seule requête
+        """
+        user_ids = set(user_ids)
+        if len(user_ids) < 2:
+            return 0
+        queryset = cls.objects.filter(
+            owner_id__in=user_ids,
+            contact_user_id__in=user_ids,
+        ).exclude(owner_id=models.F('contact_user_id'))
+        updated = queryset.update(
+            last_contact=when or timezone.now(),
+            call_count=models.F('call_count') + 1,
+        )
+        if updated:
+            ContactChange.record_contacts(queryset)
+        return updated
+
+    @classmethod
+    def touch_last_contact(cls, user_id, other_ids, when=None):
+        """
+        Met à jour last_contact entre un utilisateur et les autres participants
+        (dans les deux sens), en une seule requête
+        """
+        other_ids = set(other_ids) - {user_id}
+        if not other_ids:
+            return 0
+        queryset = cls.objects.filter(
+            models.Q(owner_id=user_id, contact_user_id__in=other_ids) |
+            models.Q(owner_id__in=other_ids, contact_user_id=user_id)
+        )
+        updated = queryset.update(last_contact=when or timezone.now())
+        if updated:
+            ContactChange.record_contacts(queryset)
+        return updated
+
     @property
     def online(self):
         """Return online status from the contact_user"""
@@ -42,4 +96,122 @@ class Contact(models.Model):
     @property
     def tags(self):
         """Return group names as tags"""
-        return [group.name for group in self.groups.all()]
\ No newline at end of file
+        return [group.name for group in self.groups.all()]
+
+
+class ContactChange(models.Model):
+    """
+    Journal des modifications du répertoire d'un utilisateur, utilisé pour la
+    synchronisation incrémentale. Le jeton est un id du journal (tous
+    propriétaires confondus) : toutes les modifications d'id inférieur ou égal
+    ont été vues par le client.
+
+    Les ids sont attribués à l'insertion, pas à la validation : sous
+    PostgreSQL, une transaction plus lente peut valider un id inférieur à un
+    id déjà lu. Le jeton rendu est donc le dernier id âgé d'au moins
+    SYNC_SAFETY_SECONDS ; les modifications plus récentes sont renvoyées mais
+    le seront à nouveau à la synchronisation suivante.
+
+    Le journal est purgé après CHANGE_RETENTION_DAYS (prune) : un jeton
+    antérieur au plus ancien id conservé impose une synchronisation complète.
+    """
+    OBJECT_TYPES = (
+        ('contact', 'Contact'),
+        ('group', 'Contact group'),
+    )
+    ACTIONS = (
+        ('upsert', 'Created or updated'),
+        ('delete', 'Deleted'),
+    )
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contact_changes')
+    object_type = models.CharField(max_length=10, choices=OBJECT_TYPES)
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTIONS, default='upsert')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'id'], name='contactchange_owner_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.action} {self.object_type} {self.object_id} for {self.owner_id}"
+
+    @classmethod
+    def record(cls, owner_id, object_type, object_ids, action='upsert'):
+        """Enregistre une modification pour chaque objet d'un même propriétaire"""
+        cls.objects.bulk_create([
+            cls(owner_id=owner_id, object_type=object_type, object_id=object_id, action=action)
+            for object_id in object_ids
+        ])
+
+    @classmethod
+    def record_contacts(cls, queryset, action='upsert'):
+        """Enregistre une modification pour chaque contact d'un queryset, tous propriétaires confondus"""
+        cls.objects.bulk_create([
+            cls(owner_id=owner_id, object_type='contact', object_id=contact_id, action=action)
+            for owner_id, contact_id in queryset.values_list('owner_id', 'id')
+        ])
+
+    @classmethod
+    def latest_token(cls):
+        """Dernier id du journal assez ancien pour qu'aucun id inférieur ne soit encore en cours d'insertion"""
+        settled = timezone.now() - timedelta(seconds=SYNC_SAFETY_SECONDS)
+        return cls.objects.filter(created_at__lte=settled).order_by('-id').values_list(
+            'id', flat=True).first() or 0
+
+    @classmethod
+    def is_valid_token(cls, since, latest):
+        """Faux si le jeton est inconnu ou si des modifications postérieures ont été purgées"""
+        if not 0 <= since <= latest:
+            return False
+        oldest = cls.objects.aggregate(oldest=models.Min('id'))['oldest']
+        return oldest is None or since >= oldest - 1
+
+    @classmethod
+    def changes_since(cls, owner, since):
+        """
+        Retourne (upserts, deletes) : les ids modifiés ou supprimés depuis
+        le jeton, par type d'objet, en ne gardant que la dernière action de chaque objet
+        """
+        last_actions = {}
+        changes = cls.objects.filter(owner=owner, id__gt=since).order_by('id').values_list(
+            'object_type', 'object_id', 'action')
+        for object_type, object_id, action in changes:
+            last_actions[(object_type, object_id)] = action
+
+        upserts = {'contact': set(), 'group': set()}
+        deletes = {'contact': set(), 'group': set()}
+        for (object_type, object_id), action in last_actions.items():
+            target = deletes if action == 'delete' else upserts
+            target[object_type].add(object_id)
+        return upserts, deletes
+
+    @classmethod
+    def prune(cls, days=None):
+        """
+        Supprime les modifications plus anciennes que la rétention ; la plus
+        récente est toujours conservée pour que l'horizon de purge reste connu.
+        Retourne le nombre de lignes supprimées
+        """
+        cutoff = timezone.now() - timedelta(days=CHANGE_RETENTION_DAYS if days is None else days)
+        kept = cls.objects.filter(created_at__gte=cutoff).order_by('id').values_list('id', flat=True).first()
+        if kept is None:
+            kept = cls.objects.aggregate(latest=models.Max('id'))['latest']
+        if kept is None:
+            return 0
+        deleted, _ = cls.objects.filter(id__lt=kept).delete()
+        return deleted
+
+
+def record_removed_contacts(sender, instance, origin=None, **kwargs):
+    """
+    Utilisateur supprimé (pre_delete) : ses fiches dans les répertoires des
+    autres disparaissent en cascade, sans passer par les vues qui journalisent
+    les suppressions. Les propriétaires supprimés en même temps sont exclus.
+    """
+    contacts = Contact.objects.filter(contact_user=instance).exclude(owner=instance)
+    if isinstance(origin, models.QuerySet) and origin.model is User:
+        contacts = contacts.exclude(owner__in=origin.values('pk'))
+    ContactChange.record_contacts(contacts, action='delete')
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from .models import Contact, ContactGroup
 from users.serializers import UserSerializer
+from users.images import avatar_url
 from django.utils import timezone
 import humanize
 from datetime import datetime
@@ -33,9 +34,9 @@ class ContactSerializer(serializers.ModelSerializer):
             'groups', 'is_favorite', 'notes', 'created_at',
             # New fields for frontend
             'name', 'email', 'avatar', 'phone', 'online',
-            'favorite', 'lastContact', 'tags'
+            'favorite', 'lastContact', 'tags', 'call_count'
         ]
-        read_only_fields = ['id', 'created_at']
+        read_only_fields = ['id', 'created_at', 'call_count']
 
     def get_name(self, obj):
         """Return either nickname or full name from contact_user"""
@@ -51,7 +52,7 @@ class ContactSerializer(serializers.ModelSerializer):
         return obj.contact_user.email
 
     def get_avatar(self, obj):
-        return obj.contact_user.profile_image.url if obj.contact_user.profile_image else ""
+        return avatar_url(obj.contact_user, 'small')
 
     def get_online(self, obj):
         return obj.online
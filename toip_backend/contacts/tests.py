@@ -1,3 +1,354 @@
+import functools
+from datetime import timedelta
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from toip_backend.budgets import EndpointBudgetTestCase, seed_users
+from users.models import User
+from . import bulk, models, views
+from .models import Contact, ContactChange, ContactGroup
+
+CONTACTS = 500         # taille du répertoire de l'utilisateur mesuré
+GROUPS = 12
+
+
+class ContactEndpointBudgetTests(EndpointBudgetTestCase):
+    """Répertoire : ContactSerializer imbrique l'utilisateur du contact et ses groupes (deux fois, via tags)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = seed_users('budget_contact_', CONTACTS + 1)
+        cls.user = users[0]
+        groups = ContactGroup.objects.bulk_create([
+            ContactGroup(owner=cls.user, name=f'Groupe {index}') for index in range(GROUPS)
+        ])
+        cls.group = groups[0]
+        contacts = Contact.objects.bulk_create([
+            Contact(owner=cls.user, contact_user=contact_user, nickname=f'Surnom {index}' if index % 4 == 0 else None,
+                    is_favorite=index % 10 == 0, call_count=index % 17)
+            for index, contact_user in enumerate(users[1:])
+        ])
+        # Chaque contact appartient à 0 à 2 groupes
+        Membership = Contact.groups.through
+        Membership.objects.bulk_create([
+            Membership(contact_id=contact.id, contactgroup_id=groups[(index + offset) % GROUPS].id)
+            for index, contact in enumerate(contacts)
+            for offset in range(index % 3)
+        ])
+        cls.group_size = Membership.objects.filter(contactgroup=cls.group).count()
+
+    def setUp(self):
+        self.authenticate(self.user)
+
+    def test_list(self):
+        response = self.assertWithinBudget('get', '/api/contacts/me/', queries=3, latency_ms=250)
+        self.assertEqual(len(response.data), CONTACTS)
+        tagged = next(contact for contact in response.data if contact['groups'])
+        self.assertEqual(tagged['tags'], [group['name'] for group in tagged['groups']])
+
+    def test_search(self):
+        # Prénom1x : les prénoms Prénom1 et Prénom10 à Prénom19
+        response = self.assertWithinBudget('get', '/api/contacts/me/', data={'search': 'Prénom1'},
+                                           queries=3, latency_ms=60)
+        self.assertTrue(response.data)
+        self.assertTrue(all(contact['contact_user_details']['first_name'].startswith('Prénom1')
+                            for contact in response.data))
+
+    def test_by_group(self):
+        response = self.assertWithinBudget('get', '/api/contacts/me/by_group/', data={'group_id': self.group.id},
+                                           queries=4, latency_ms=60)
+        self.assertEqual(len(response.data), self.group_size)
+
+
+class ContactImportExportTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, *cls.others = seed_users('bulk_contact_', 4)
+        cls.token = Token.objects.create(user=cls.owner)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def upload(self, content):
+        return self.client.post('/api/contacts/me/import/', {
+            'file': SimpleUploadedFile('contacts.csv', content, content_type='text/csv'),
+        }, format='multipart')
+
+    @mock.patch('contacts.views.import_contacts', functools.partial(bulk.import_contacts, batch_size=1))
+    def test_import_is_all_or_nothing(self):
+        lines = ['email,nickname'] + [f'{user.email},Surnom' for user in self.others]
+        content = '\n'.join(lines).encode() + b'\n\xff\xfe,invalide\n'
+        response = self.upload(content)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Contact.objects.filter(owner=self.owner).exists())
+
+        response = self.upload('\n'.join(lines).encode())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['created'], len(self.others))
+
+    def test_concurrently_added_contact_not_counted_as_created(self):
+        bulk_create = Contact.objects.bulk_create
+
+        def added_meanwhile(contacts, **kwargs):
+            # Une autre requête ajoute le même contact entre la lecture des existants et l'insertion
+            Contact.objects.create(owner=self.owner, contact_user=self.others[0])
+            return bulk_create(contacts, **kwargs)
+
+        rows = [{'email': user.email} for user in self.others]
+        with mock.patch.object(Contact.objects, 'bulk_create', added_meanwhile):
+            report = bulk.import_contacts(self.owner, rows)
+        self.assertEqual((report.created, report.skipped), (len(self.others) - 1, 1))
+        self.assertEqual(Contact.objects.filter(owner=self.owner).count(), len(self.others))
+        self.assertEqual(
+            sorted(ContactChange.objects.filter(owner_id=self.owner.id).values_list('object_id', flat=True)),
+            sorted(Contact.objects.filter(owner=self.owner).exclude(contact_user=self.others[0])
+                   .values_list('id', flat=True)))
+
+    def expected_csv(self):
+        Contact.objects.bulk_create([Contact(owner=self.owner, contact_user=user) for user in self.others])
+        return ''.join(bulk.iter_csv_export(self.owner))
+
+    def test_export_wsgi_streams_sync_iterator(self):
+        expected = self.expected_csv()
+        response = self.client.get('/api/contacts/me/export/')
+        self.assertFalse(response.is_async)
+        self.assertEqual(b''.join(response.streaming_content).decode(), expected)
+
+    async def test_export_asgi_streams_async_iterator(self):
+        expected = await bulk.sync_to_async(self.expected_csv)()
+        response = await self.async_client.get('/api/contacts/me/export/', {'type': 'csv'},
+                                               headers={'authorization': f'Token {self.token.key}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(content.decode(), expected)
+        self.assertEqual(expected.count('\r\n'), len(self.others) + 1)
+
+
+@mock.patch.object(models, 'SYNC_SAFETY_SECONDS', 0)
+class ContactSyncTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, *cls.others = seed_users('sync_contact_', 4)
+        cls.token = Token.objects.create(user=cls.owner)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def sync(self, since=None):
+        response = self.client.get('/api/contacts/me/sync/', {'since': since} if since is not None else None)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def add_contact(self, user):
+        contact = Contact.objects.create(owner=self.owner, contact_user=user)
+        ContactChange.record(self.owner.id, 'contact', [contact.id])
+        return contact
+
+    def test_incremental_sync(self):
+        first = self.add_contact(self.others[0])
+        full = self.sync()
+        self.assertTrue(full['full'])
+        self.assertEqual([c['id'] for c in full['contacts']], [first.id])
+
+        second = self.add_contact(self.others[1])
+        delta = self.sync(full['token'])
+        self.assertFalse(delta['full'])
+        self.assertEqual([c['id'] for c in delta['contacts']], [second.id])
+        self.assertEqual(self.sync(delta['token'])['contacts'], [])
+
+    def test_recent_changes_not_covered_by_token(self):
+        first = self.add_contact(self.others[0])
+        with mock.patch.object(models, 'SYNC_SAFETY_SECONDS', 3600):
+            self.assertEqual(ContactChange.latest_token(), 0)
+            # Renvoyée, mais le jeton ne la couvre pas : elle le sera encore au prochain appel
+            data = self.sync(0)
+        self.assertEqual(data['token'], '0')
+        self.assertEqual([c['id'] for c in data['contacts']], [first.id])
+
+    def test_pruned_token_requires_full_sync(self):
+        self.add_contact(self.others[0])
+        old_token = self.sync()['token']
+        self.add_contact(self.others[1])
+        self.add_contact(self.others[2])
+        ContactChange.objects.exclude(id=ContactChange.objects.latest('id').id).update(
+            created_at=timezone.now() - timedelta(days=models.CHANGE_RETENTION_DAYS + 1))
+        self.assertEqual(ContactChange.prune(), 2)
+
+        data = self.sync(old_token)
+        self.assertTrue(data['full'])
+        self.assertEqual(len(data['contacts']), 3)
+        self.assertFalse(self.sync(data['token'])['full'])
+
+    def test_deleted_user_leaves_tombstone(self):
+        removed = self.add_contact(self.others[0])
+        token = self.sync()['token']
+        # Le propriétaire d'un autre répertoire supprimé en même temps : rien à journaliser pour lui
+        Contact.objects.create(owner=self.others[1], contact_user=self.others[0])
+        User.objects.filter(id__in=[self.others[0].id, self.others[1].id]).delete()
+
+        data = self.sync(token)
+        self.assertEqual(data['deleted']['contacts'], [removed.id])
+        self.assertFalse(ContactChange.objects.filter(owner_id=self.others[1].id).exists())
+
+
+class ContactBulkActionTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, cls.other, *users = seed_users('bulk_contact_', 42)
+        cls.contacts = Contact.objects.bulk_create([Contact(owner=cls.owner, contact_user=user) for user in users])
+        cls.ids = [contact.id for contact in cls.contacts]
+        cls.group = ContactGroup.objects.create(owner=cls.owner, name='Équipe')
+        cls.foreign = Contact.objects.create(owner=cls.other, contact_user=cls.owner)
+        cls.foreign_group = ContactGroup.objects.create(owner=cls.other, name='Autre')
+        cls.token = Token.objects.create(user=cls.owner)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def post(self, action, data, status=200):
+        response = self.client.post(f'/api/contacts/me/{action}/', data, format='json')
+        self.assertEqual(response.status_code, status, response.content[:300])
+        return response.data
+
+    def members(self):
+        return sorted(self.group.contacts.values_list('id', flat=True))
+
+    def changed_contacts(self):
+        return sorted(ContactChange.objects.filter(owner_id=self.owner.id, object_type='contact')
+                      .values_list('object_id', flat=True))
+
+    def test_add_to_group_filters_ownership_and_is_idempotent(self):
+        data = self.post('bulk_add_to_group', {'group_id': self.group.id,
+                                               'contact_ids': self.ids[:3] + [self.foreign.id, 999999]})
+        self.assertEqual(data, {'matched': 3, 'changed': 3, 'not_found': sorted([self.foreign.id, 999999])})
+        self.assertEqual(self.members(), self.ids[:3])
+        self.assertEqual(self.changed_contacts(), self.ids[:3])
+
+        data = self.post('bulk_add_to_group', {'group_id': self.group.id, 'contact_ids': self.ids[:4]})
+        self.assertEqual(data, {'matched': 4, 'changed': 1, 'not_found': []})
+        self.assertEqual(self.members(), self.ids[:4])
+        self.assertFalse(self.foreign.groups.exists())
+
+    def test_remove_from_group(self):
+        self.group.contacts.add(*self.contacts[:3])
+        data = self.post('bulk_remove_from_group', {'group_id': self.group.id, 'contact_ids': self.ids[1:5]})
+        self.assertEqual(data, {'matched': 4, 'changed': 2, 'not_found': []})
+        self.assertEqual(self.members(), self.ids[:1])
+        self.assertEqual(self.changed_contacts(), self.ids[1:3])
+
+    def test_other_users_group_not_found(self):
+        self.post('bulk_add_to_group', {'group_id': self.foreign_group.id, 'contact_ids': self.ids[:2]}, status=404)
+        self.assertFalse(self.foreign_group.contacts.exists())
+
+    def test_favorite(self):
+        Contact.objects.filter(id=self.ids[0]).update(is_favorite=True)
+        data = self.post('bulk_favorite', {'favorite': True, 'contact_ids': self.ids[:3] + [self.foreign.id]})
+        self.assertEqual(data, {'matched': 3, 'changed': 2, 'not_found': [self.foreign.id]})
+        self.assertEqual(sorted(Contact.objects.filter(is_favorite=True).values_list('id', flat=True)), self.ids[:3])
+
+        data = self.post('bulk_favorite', {'favorite': False, 'contact_ids': self.ids[:2]})
+        self.assertEqual(data, {'matched': 2, 'changed': 2, 'not_found': []})
+        self.assertEqual(list(Contact.objects.filter(is_favorite=True).values_list('id', flat=True)), [self.ids[2]])
+
+    def test_bad_payloads(self):
+        for contact_ids in (None, [], 'x', [True], [1.9], ['1'], [self.ids[0], None],
+                            list(range(1, views.BULK_MAX_CONTACTS + 2))):
+            with self.subTest(contact_ids=contact_ids if not isinstance(contact_ids, list) else contact_ids[:3]):
+                self.post('bulk_favorite', {'favorite': True, 'contact_ids': contact_ids}, status=400)
+        self.post('bulk_favorite', {'favorite': 'yes', 'contact_ids': self.ids[:1]}, status=400)
+        self.post('bulk_add_to_group', {'contact_ids': self.ids[:1]}, status=400)
+        self.post('bulk_remove_from_group', {'group_id': self.group.id, 'contact_ids': [False]}, status=400)
+        self.assertFalse(Contact.objects.filter(is_favorite=True).exists())
+        self.assertFalse(ContactChange.objects.exists())
+
+    def test_query_count_independent_of_size(self):
+        for action, data in [('bulk_add_to_group', {'group_id': self.group.id}),
+                             ('bulk_remove_from_group', {'group_id': self.group.id}),
+                             ('bulk_favorite', {'favorite': True})]:
+            counts = []
+            for contact_ids in (self.ids[:2], self.ids):
+                with CaptureQueriesContext(connection) as captured:
+                    self.post(action, {**data, 'contact_ids': contact_ids})
+                counts.append(len(captured))
+            with self.subTest(action=action):
+                self.assertEqual(counts[0], counts[1])
+
+
+class ContactHistoryTests(TestCase):
+    """Contacts récents et fréquents : ordre et paramètre limit (défaut 20, borné à 1..100)"""
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner, *users = seed_users('history_contact_', 131)
+        now = timezone.now()
+        # Contact d'indice i : appelé il y a i minutes, (i * 7) % 130 fois ; les 10 derniers jamais appelés
+        Contact.objects.bulk_create([
+            Contact(owner=cls.owner, contact_user=user,
+                    last_contact=now - timedelta(minutes=index) if index < 120 else None,
+                    call_count=(index * 7) % 130 if index < 120 else 0)
+            for index, user in enumerate(users)
+        ])
+        other = users[0]
+        Contact.objects.create(owner=other, contact_user=cls.owner, last_contact=now, call_count=1000)
+        cls.token = Token.objects.create(user=cls.owner)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def history(self, action, limit=None):
+        response = self.client.get(f'/api/contacts/me/{action}/', {'limit': limit} if limit is not None else None)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def uncalled_from(self, index, **fields):
+        Contact.objects.filter(owner=self.owner, contact_user__username__gte=f'history_contact_{index:05d}').update(
+            **fields)
+
+    def test_recent_ordering(self):
+        self.uncalled_from(41, last_contact=None)
+        data = self.history('recent', 100)
+        # Plus récent d'abord ; jamais appelés et contacts des autres utilisateurs exclus
+        self.assertEqual([contact['contact_user_details']['username'] for contact in data],
+                         [f'history_contact_{index:05d}' for index in range(1, 41)])
+
+    def test_frequent_ordering(self):
+        self.uncalled_from(41, call_count=0)
+        data = self.history('frequent', 100)
+        expected = Contact.objects.filter(owner=self.owner, call_count__gt=0).order_by('-call_count')
+        self.assertEqual([contact['id'] for contact in data], [contact.id for contact in expected])
+        counts = [contact['call_count'] for contact in data]
+        # Indices 1 à 39 (l'indice 0 n'a jamais été appelé), nombres d'appels distincts
+        self.assertEqual(len(counts), 39)
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertEqual(counts[0], max((index * 7) % 130 for index in range(1, 40)))
+
+    def test_limit_default_and_maximum(self):
+        for action in ('recent', 'frequent'):
+            with self.subTest(action=action):
+                self.assertEqual(len(self.history(action)), 20)
+                self.assertEqual(len(self.history(action, 100)), 100)
+                self.assertEqual(len(self.history(action, 500)), 100)
 
-# Create your tests here.
+    def test_invalid_limit(self):
+        for action in ('recent', 'frequent'):
+            with self.subTest(action=action):
+                # Valeur non numérique : limite par défaut ; nulle ou négative : au moins un contact
+                self.assertEqual(len(self.history(action, 'abc')), 20)
+                self.assertEqual(len(self.history(action, '')), 20)
+                self.assertEqual(len(self.history(action, 0)), 1)
+                self.assertEqual(len(self.history(action, -5)), 1)
@@ -1,12 +1,23 @@
+import codecs
+
 from rest_framework import viewsets, permissions, filters
 from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 
-from .models import Contact, ContactGroup
+from .models import Contact, ContactGroup, ContactChange
 from .serializers import ContactSerializer, ContactGroupSerializer
+from .bulk import ROW_READERS, EXPORTERS, aiter_export, detect_format, import_contacts
 from users.models import User
+from toip_backend.routers import ReplicaReadMixin
+
+# Nombre maximal d'identifiants d'une action groupée (bulk_*)
+BULK_MAX_CONTACTS = 1000
 
 
 class ContactGroupViewSet(viewsets.ModelViewSet):
@@ -17,21 +28,128 @@ class ContactGroupViewSet(viewsets.ModelViewSet):
         return ContactGroup.objects.filter(owner=self.request.user)
 
     def perform_create(self, serializer):
-        serializer.save(owner=self.request.user)
+        group = serializer.save(owner=self.request.user)
+        ContactChange.record(self.request.user.id, 'group', [group.id])
+
+    def perform_update(self, serializer):
+        group = serializer.save()
+        ContactChange.record(self.request.user.id, 'group', [group.id])
+        # Le nom du groupe apparaît dans les tags des contacts
+        ContactChange.record_contacts(group.contacts.all())
 
+    def perform_destroy(self, instance):
+        contact_ids = list(instance.contacts.values_list('id', flat=True))
+        group_id = instance.id
+        instance.delete()
+        ContactChange.record(self.request.user.id, 'group', [group_id], action='delete')
+        ContactChange.record(self.request.user.id, 'contact', contact_ids)
 
-class ContactViewSet(viewsets.ModelViewSet):
+
+class ContactViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     serializer_class = ContactSerializer
+    # Liste et recherche (?search=) lues sur une réplique ; sync reste sur la base principale (curseur)
+    replica_actions = ('list', 'by_group')
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [filters.SearchFilter]
     search_fields = ['nickname', 'contact_user__username', 'contact_user__email',
                      'contact_user__first_name', 'contact_user__last_name', 'phone']
 
     def get_queryset(self):
-        return Contact.objects.filter(owner=self.request.user)
+        # Utilisateur du contact et groupes (champs groups et tags) lus en deux requêtes pour toute la liste
+        return Contact.objects.filter(owner=self.request.user).select_related(
+            'contact_user').prefetch_related('groups')
 
     def perform_create(self, serializer):
-        serializer.save(owner=self.request.user)
+        contact = serializer.save(owner=self.request.user)
+        self._record_change(contact)
+
+    def perform_update(self, serializer):
+        contact = serializer.save()
+        self._record_change(contact)
+
+    def perform_destroy(self, instance):
+        contact_id = instance.id
+        instance.delete()
+        ContactChange.record(self.request.user.id, 'contact', [contact_id], action='delete')
+
+    def _record_change(self, contact):
+        ContactChange.record(self.request.user.id, 'contact', [contact.id])
+
+    @action(detail=False, methods=['post'], url_path='import', parser_classes=[MultiPartParser])
+    def import_file(self, request):
+        """
+        Import en masse d'un fichier CSV ou vCard (champ 'file', type optionnel).
+        Tout ou rien : une erreur de décodage en cours de fichier annule aussi
+        les lots déjà insérés
+        """
+        upload = request.FILES.get('file')
+        if not upload:
+            return Response({'error': 'file est requis'}, status=400)
+
+        file_format = request.data.get('type') or detect_format(upload.name)
+        if file_format not in ROW_READERS:
+            return Response({'error': f'type invalide: {file_format}'}, status=400)
+
+        rows = ROW_READERS[file_format](codecs.iterdecode(upload, 'utf-8-sig'))
+        try:
+            with transaction.atomic():
+                report = import_contacts(request.user, rows)
+        except UnicodeDecodeError:
+            return Response({'error': 'le fichier doit être encodé en UTF-8'}, status=400)
+        return Response(report.as_dict())
+
+    @action(detail=False, methods=['get'], url_path='export')
+    def export_file(self, request):
+        """Export en flux du répertoire (?type=csv ou ?type=vcard)"""
+        file_format = request.query_params.get('type', 'csv')
+        if file_format not in EXPORTERS:
+            return Response({'error': f'type invalide: {file_format}'}, status=400)
+
+        exporter, content_type, filename = EXPORTERS[file_format]
+        if isinstance(request._request, ASGIRequest):
+            content = aiter_export(exporter, request.user)
+        else:
+            content = exporter(request.user)
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    @action(detail=False, methods=['get'])
+    def sync(self, request):
+        """
+        Synchronisation incrémentale : sans jeton (ou jeton invalide ou antérieur à
+        la rétention du journal), renvoie tout le répertoire avec full=true : le
+        client remplace sa copie locale ; avec ?since=<token>, uniquement les
+        contacts et groupes modifiés depuis, plus les identifiants supprimés et
+        un nouveau jeton
+        """
+        user = request.user
+        # Jeton lu avant les données : rien de ce qu'il couvre ne peut manquer à la réponse
+        latest = ContactChange.latest_token()
+        try:
+            since = int(request.query_params.get('since', ''))
+        except ValueError:
+            since = None
+        if since is not None and not ContactChange.is_valid_token(since, latest):
+            since = None
+
+        if since is None:
+            contacts = self.get_queryset()
+            groups = ContactGroup.objects.filter(owner=user)
+            deleted = {'contact': [], 'group': []}
+        else:
+            upserts, deletes = ContactChange.changes_since(user, since)
+            contacts = self.get_queryset().filter(id__in=upserts['contact'])
+            groups = ContactGroup.objects.filter(owner=user, id__in=upserts['group'])
+            deleted = {object_type: sorted(ids) for object_type, ids in deletes.items()}
+
+        return Response({
+            'token': str(latest),
+            'full': since is None,
+            'contacts': self.get_serializer(contacts, many=True).data,
+            'groups': ContactGroupSerializer(groups, many=True).data,
+            'deleted': {'contacts': deleted['contact'], 'groups': deleted['group']},
+        })
 
     @action(detail=False, methods=['get'])
     def favorites(self, request):
@@ -39,11 +157,37 @@ class ContactViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(favorites, many=True)
         return Response(serializer.data)
 
+    def _limit(self, request, default=20, maximum=100):
+        try:
+            limit = int(request.query_params.get('limit', default))
+        except (TypeError, ValueError):
+            limit = default
+        return max(1, min(limit, maximum))
+
+    @action(detail=False, methods=['get'])
+    def recent(self, request):
+        """Contacts les plus récemment appelés (index owner, -last_contact)"""
+        contacts = self.get_queryset().filter(
+            last_contact__isnull=False
+        ).order_by('-last_contact')[:self._limit(request)]
+        serializer = self.get_serializer(contacts, many=True)
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def frequent(self, request):
+        """Contacts les plus souvent appelés (index owner, -call_count)"""
+        contacts = self.get_queryset().filter(
+            call_count__gt=0
+        ).order_by('-call_count')[:self._limit(request)]
+        serializer = self.get_serializer(contacts, many=True)
+        return Response(serializer.data)
+
     @action(detail=True, methods=['post'])
     def toggle_favorite(self, request, pk=None):
         contact = self.get_object()
         contact.is_favorite = not contact.is_favorite
         contact.save()
+        self._record_change(contact)
         serializer = self.get_serializer(contact)
         return Response(serializer.data)
 
@@ -56,6 +200,7 @@ class ContactViewSet(viewsets.ModelViewSet):
 
         group = get_object_or_404(ContactGroup, id=group_id, owner=request.user)
         contact.groups.add(group)
+        self._record_change(contact)
         serializer = self.get_serializer(contact)
         return Response(serializer.data)
 
@@ -68,9 +213,106 @@ class ContactViewSet(viewsets.ModelViewSet):
 
         group = get_object_or_404(ContactGroup, id=group_id, owner=request.user)
         contact.groups.remove(group)
+        self._record_change(contact)
         serializer = self.get_serializer(contact)
         return Response(serializer.data)
 
+    def _bulk_contact_ids(self, request):
+        """
+        Valide la liste contact_ids et la restreint aux contacts de l'utilisateur
+        en une seule requête. Retourne ((ids trouvés, ids inconnus), None) ou
+        (None, réponse 400) si la liste est invalide.
+        """
+        contact_ids = request.data.get('contact_ids')
+        # bool est une sous-classe d'int : True n'est pas un identifiant
+        if (not isinstance(contact_ids, list) or not contact_ids
+                or not all(isinstance(contact_id, int) and not isinstance(contact_id, bool)
+                           for contact_id in contact_ids)):
+            return None, Response({'error': 'contact_ids doit être une liste non vide d\'identifiants entiers'},
+                                  status=400)
+        if len(contact_ids) > BULK_MAX_CONTACTS:
+            return None, Response({'error': f'contact_ids est limité à {BULK_MAX_CONTACTS} identifiants'},
+                                  status=400)
+        requested = set(contact_ids)
+        found = set(self.get_queryset().filter(id__in=requested).values_list('id', flat=True))
+        return (found, sorted(requested - found)), None
+
+    def _bulk_summary(self, found, not_found, changed_ids):
+        if changed_ids:
+            ContactChange.record(self.request.user.id, 'contact', changed_ids)
+        return Response({
+            'matched': len(found),
+            'changed': len(changed_ids),
+            'not_found': not_found,
+        })
+
+    def _bulk_group_request(self, request):
+        """
+        Contacts et groupe d'une action groupée sur un groupe. Le groupe est
+        verrouillé (à appeler dans une transaction) : deux actions groupées sur
+        le même groupe s'exécutent l'une après l'autre.
+        """
+        resolved, error = self._bulk_contact_ids(request)
+        if error:
+            return None, None, error
+        group_id = request.data.get('group_id')
+        if not group_id:
+            return None, None, Response({'error': 'group_id est requis'}, status=400)
+        group = get_object_or_404(ContactGroup.objects.select_for_update(), id=group_id, owner=request.user)
+        return resolved, group, None
+
+    @action(detail=False, methods=['post'])
+    @transaction.atomic
+    def bulk_add_to_group(self, request):
+        """Ajoute une liste de contacts à un groupe (un INSERT groupé)"""
+        resolved, group, error = self._bulk_group_request(request)
+        if error:
+            return error
+        found, not_found = resolved
+
+        Membership = Contact.groups.through
+        already = set(Membership.objects.filter(
+            contactgroup_id=group.id, contact_id__in=found
+        ).values_list('contact_id', flat=True))
+        changed_ids = sorted(found - already)
+        Membership.objects.bulk_create(
+            [Membership(contact_id=contact_id, contactgroup_id=group.id) for contact_id in changed_ids],
+            ignore_conflicts=True,
+        )
+        return self._bulk_summary(found, not_found, changed_ids)
+
+    @action(detail=False, methods=['post'])
+    @transaction.atomic
+    def bulk_remove_from_group(self, request):
+        """Retire une liste de contacts d'un groupe (un DELETE groupé)"""
+        resolved, group, error = self._bulk_group_request(request)
+        if error:
+            return error
+        found, not_found = resolved
+
+        memberships = Contact.groups.through.objects.filter(contactgroup_id=group.id, contact_id__in=found)
+        changed_ids = sorted(memberships.values_list('contact_id', flat=True))
+        memberships.delete()
+        return self._bulk_summary(found, not_found, changed_ids)
+
+    @action(detail=False, methods=['post'])
+    @transaction.atomic
+    def bulk_favorite(self, request):
+        """Définit is_favorite pour une liste de contacts (un UPDATE groupé)"""
+        resolved, error = self._bulk_contact_ids(request)
+        if error:
+            return error
+        favorite = request.data.get('favorite')
+        if not isinstance(favorite, bool):
+            return Response({'error': 'favorite doit être un booléen'}, status=400)
+        found, not_found = resolved
+
+        # Lignes verrouillées : une action concurrente attend et ne les compte pas une seconde fois
+        to_change = Contact.objects.select_for_update().filter(id__in=found).exclude(is_favorite=favorite)
+        changed_ids = sorted(to_change.values_list('id', flat=True))
+        Contact.objects.filter(id__in=changed_ids).update(is_favorite=favorite)
+        return self._bulk_summary(found, not_found, changed_ids)
+
     @action(detail=False, methods=['get'])
     def by_group(self, request):
         group_id = request.query_params.get('group_id')
@@ -88,5 +330,6 @@ class ContactViewSet(viewsets.ModelViewSet):
         contact = self.get_object()
         contact.last_contact = timezone.now()
         contact.save()
+        self._record_change(contact)
         serializer = self.get_serializer(contact)
         return Response(serializer.data)
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+Banc d'essai du mixage audio (mode MCU)
+
+Mesure, pour différents nombres de participants, le temps CPU d'une trame de
+20 ms (décodage de toutes les entrées, mixage, encodages) et en déduit le
+nombre de participants mixables par cœur en temps réel. La même charge est
+mesurée sans détection d'orateurs (tout le monde mixé et encodé
+individuellement) pour comparaison. --webrtc ajoute un essai de bout en bout
+avec des clients aiortc synthétiques.
+"""
+import asyncio
+import math
+import time
+from fractions import Fraction
+
+import av
+import numpy as np
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.codecs.opus import OpusEncoder
+from django.core.management.base import BaseCommand
+
+from mediaserver.mcu import FRAME_DURATION, FRAME_SAMPLES, SAMPLE_RATE, AudioMixer, McuRoom
+from mediaserver.sfu import EncodedFrameTap
+from .bench_sfu import FrameCounter, PrerecordedTrack
+
+
+def encode_voice(seconds, frequency, amplitude):
+    """Paquets Opus d'une voix synthétique (salves sinusoïdales) ; amplitude 0 pour un participant muet"""
+    encoder = OpusEncoder()
+    payloads = []
+    t = np.arange(FRAME_SAMPLES) / SAMPLE_RATE
+    for index in range(int(seconds / FRAME_DURATION)):
+        talking = amplitude and (index // 25) % 4 != 3
+        wave = np.sin(2 * math.pi * frequency * (t + index * FRAME_DURATION)) * (amplitude if talking else 0)
+        samples = np.repeat(wave.astype(np.int16), 2)
+        frame = av.AudioFrame.from_ndarray(samples.reshape(1, -1), format='s16', layout='stereo')
+        frame.sample_rate = SAMPLE_RATE
+        frame.pts = index * FRAME_SAMPLES
+        frame.time_base = Fraction(1, SAMPLE_RATE)
+        encoded, _ = encoder.encode(frame)
+        payloads.extend(encoded)
+    return payloads
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class Command(BaseCommand):
+    help = "Mesure le nombre de participants mixables par cœur en mode MCU"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', type=int, nargs='+', default=[10, 25, 50, 100])
+        parser.add_argument('--speakers', type=int, default=3, help="participants qui parlent")
+        parser.add_argument('--frames', type=int, default=500, help="trames de 20 ms par mesure")
+        parser.add_argument('--webrtc', type=int, default=0,
+                            help="nombre de clients aiortc pour un essai de bout en bout (0 : aucun)")
+        parser.add_argument('--duration', type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        voices = [encode_voice(2, 220 + 110 * index, 6000) for index in range(options['speakers'])]
+        silence = encode_voice(2, 0, 0)
+
+        self.stdout.write("participants  mode              ms/trame p50   p99    participants/cœur")
+        for count in options['participants']:
+            sources = [voices[i] if i < len(voices) else silence for i in range(count)]
+            for label, mixer in (('orateurs actifs', AudioMixer()),
+                                 ('tous mixés', AudioMixer(max_speakers=count, silence_level=-1))):
+                for index in range(options['frames']):
+                    mixer.tick({member: source[index % len(source)] for member, source in enumerate(sources)})
+                times = list(mixer.tick_times)[len(mixer.tick_times) // 5:]
+                mean = sum(times) / len(times)
+                self.stdout.write(
+                    f"{count:<13} {label:<17} {percentile(times, 50) * 1000:6.2f}   "
+                    f"{percentile(times, 99) * 1000:6.2f} {count * FRAME_DURATION / mean:8.0f}")
+
+        if options['webrtc']:
+            asyncio.run(self.run_webrtc(options['webrtc'], options['duration'], voices, silence))
+
+    async def run_webrtc(self, count, duration, voices, silence):
+        clients = {}
+
+        async def send(user_id, message):
+            if user_id is None:
+                return  # événements diffusés (orateurs actifs)
+            pc = clients[user_id][0]
+            sdp = message['sdp']
+            await pc.setRemoteDescription(RTCSessionDescription(sdp=sdp['sdp'], type=sdp['type']))
+
+        room = McuRoom('bench', send)
+        for user_id in range(1, count + 1):
+            pc = RTCPeerConnection()
+            counter = FrameCounter()
+            payloads = voices[user_id - 1] if user_id <= len(voices) else silence
+            pc.addTransceiver(PrerecordedTrack('audio', payloads, 50, SAMPLE_RATE), direction='sendrecv')
+
+            @pc.on('track')
+            def on_track(track, pc=pc, counter=counter):
+                transceiver = next(t for t in pc.getTransceivers() if t.receiver.track is track)
+                EncodedFrameTap.install(transceiver.receiver, 'audio').subscribers.add(counter)
+
+            clients[user_id] = (pc, counter)
+            await pc.setLocalDescription(await pc.createOffer())
+            local = pc.localDescription
+            await room.handle_offer(user_id, {'type': local.type, 'sdp': local.sdp})
+
+        await asyncio.sleep(2)
+        received_before = sum(counter.frames for _, counter in clients.values())
+        room.mixer.tick_times.clear()
+        cpu_start, wall_start = time.process_time(), time.monotonic()
+        await asyncio.sleep(duration)
+        cpu = time.process_time() - cpu_start
+        wall = time.monotonic() - wall_start
+        received = sum(counter.frames for _, counter in clients.values()) - received_before
+        times = list(room.mixer.tick_times)
+
+        self.stdout.write(f"\nbout en bout : {count} clients aiortc")
+        self.stdout.write(f"CPU (processus, clients compris)  {100 * cpu / wall:.1f} % d'un cœur")
+        self.stdout.write(f"trames mixées                     {len(times)} ({len(times) / wall:.0f}/s)")
+        self.stdout.write(f"paquets reçus par client          {received / count / wall:.0f}/s")
+        self.stdout.write(f"orateurs actifs                   {room.active_speakers}")
+        if times:
+            self.stdout.write(f"mixage p50/p99                    {percentile(times, 50) * 1000:.2f} / "
+                              f"{percentile(times, 99) * 1000:.2f} ms")
+
+        await room.close()
+        for pc, _ in clients.values():
+            await pc.close()
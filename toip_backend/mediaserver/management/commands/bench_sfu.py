@@ -0,0 +1,274 @@
+"""
+Banc d'essai du SFU sans navigateur
+
+Des clients aiortc synthétiques (dans le même processus, sur l'interface
+locale) publient des flux pré-encodés en boucle, si bien que les clients ne
+coûtent presque rien en CPU. Le banc mesure le temps CPU du processus par
+appel et la latence de retransmission interne du SFU (réception de la trame
+encodée -> prise en charge par l'émetteur RTP).
+
+Avec --simulcast, chaque client publie trois couches vidéo et le premier
+client parle (son audio porte un niveau RFC 6464) : le banc rapporte le
+débit retransmis par couche et les changements de couche signalés.
+"""
+import asyncio
+import time
+from fractions import Fraction
+
+import av
+import numpy as np
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.codecs.opus import OpusEncoder
+from aiortc.mediastreams import MediaStreamTrack
+from django.core.management.base import BaseCommand
+
+from mediaserver.sfu import EncodedFrameTap, SfuRoom
+
+VIDEO_CLOCK_RATE = 90000
+AUDIO_CLOCK_RATE = 48000
+
+
+def encode_video(width, height, fps, seconds, bitrate):
+    codec = av.CodecContext.create('libvpx', 'w')
+    codec.width = width
+    codec.height = height
+    codec.pix_fmt = 'yuv420p'
+    codec.framerate = Fraction(fps, 1)
+    codec.time_base = Fraction(1, fps)
+    codec.bit_rate = bitrate
+    codec.gop_size = fps
+    codec.options = {'deadline': 'realtime', 'cpu-used': '8', 'lag-in-frames': '0'}
+
+    packets = []
+    for index in range(fps * seconds):
+        frame = av.VideoFrame(width, height, 'yuv420p')
+        for plane, value in zip(frame.planes, ((index * 7) % 256, 128, (index * 3) % 256)):
+            plane.update(bytes([value]) * plane.buffer_size)
+        frame.pts = index
+        packets.extend(bytes(packet) for packet in codec.encode(frame))
+    packets.extend(bytes(packet) for packet in codec.encode(None))
+    return packets
+
+
+def encode_audio(seconds):
+    # L'encodeur Opus d'aiortc renvoie des paquets Opus bruts (un par trame de 20 ms)
+    encoder = OpusEncoder()
+    packets = []
+    samples = 960
+    for index in range(seconds * AUDIO_CLOCK_RATE // samples):
+        frame = av.AudioFrame(format='s16', layout='stereo', samples=samples)
+        frame.planes[0].update(bytes(frame.planes[0].buffer_size))
+        frame.sample_rate = AUDIO_CLOCK_RATE
+        frame.pts = index * samples
+        frame.time_base = Fraction(1, AUDIO_CLOCK_RATE)
+        payloads, _ = encoder.encode(frame)
+        packets.extend(payloads)
+    return packets
+
+
+class PrerecordedTrack(MediaStreamTrack):
+    """Rejoue en boucle, au rythme réel, une liste de trames déjà encodées"""
+
+    def __init__(self, kind, payloads, rate, clock_rate):
+        super().__init__()
+        self.kind = kind
+        self._payloads = payloads
+        self._interval = 1 / rate
+        self._clock_step = clock_rate // rate
+        self._clock_rate = clock_rate
+        self._index = 0
+        self._start = None
+
+    async def recv(self):
+        if self._start is None:
+            self._start = time.monotonic()
+        due = self._start + self._index * self._interval
+        delay = due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        packet = av.Packet(self._payloads[self._index % len(self._payloads)])
+        packet.pts = self._index * self._clock_step
+        packet.time_base = Fraction(1, self._clock_rate)
+        self._index += 1
+        return packet
+
+
+class ToneTrack(MediaStreamTrack):
+    """Audio brut (sinusoïde) encodé par aiortc, qui renseigne alors le niveau audio des paquets"""
+
+    kind = 'audio'
+
+    def __init__(self, amplitude=8000, frequency=440):
+        super().__init__()
+        samples = 960
+        t = np.arange(samples) / AUDIO_CLOCK_RATE
+        wave = (np.sin(2 * np.pi * frequency * t) * amplitude).astype(np.int16)
+        self._samples = np.repeat(wave, 2).reshape(1, -1)
+        self._index = 0
+        self._start = None
+
+    async def recv(self):
+        if self._start is None:
+            self._start = time.monotonic()
+        delay = self._start + self._index * 0.02 - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        frame = av.AudioFrame.from_ndarray(self._samples, format='s16', layout='stereo')
+        frame.sample_rate = AUDIO_CLOCK_RATE
+        frame.pts = self._index * 960
+        frame.time_base = Fraction(1, AUDIO_CLOCK_RATE)
+        self._index += 1
+        return frame
+
+
+class FrameCounter:
+    """Abonné d'un EncodedFrameTap côté client : compte les trames sans les décoder"""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def push(self, codec, frame):
+        self.frames += 1
+        self.bytes += len(frame.data)
+
+    def end(self):
+        pass
+
+
+class SyntheticClient:
+    """tracks : pistes publiées, ou couples (piste, couche simulcast)"""
+
+    def __init__(self, user_id, room, tracks):
+        self.user_id = user_id
+        self.room = room
+        self.pc = RTCPeerConnection()
+        self.counter = FrameCounter()
+        self.events = []
+        self.layers = []
+        self.connected = asyncio.Event()
+        self.lock = asyncio.Lock()
+        for track in tracks:
+            track, layer = track if isinstance(track, tuple) else (track, None)
+            self.layers.append((self.pc.addTransceiver(track, direction='sendonly'), layer))
+
+        @self.pc.on('track')
+        def on_track(track):
+            transceiver = next(t for t in self.pc.getTransceivers() if t.receiver.track is track)
+            EncodedFrameTap.install(transceiver.receiver, track.kind).subscribers.add(self.counter)
+
+        @self.pc.on('connectionstatechange')
+        def on_connectionstatechange():
+            if self.pc.connectionState == 'connected':
+                self.connected.set()
+
+    async def join(self):
+        offer = await self.pc.createOffer()
+        await self.pc.setLocalDescription(offer)
+        local = self.pc.localDescription
+        simulcast = {transceiver.mid: layer for transceiver, layer in self.layers if layer}
+        await self.room.handle_offer(self.user_id, {'type': local.type, 'sdp': local.sdp}, simulcast)
+
+    async def on_message(self, message):
+        if message['type'] not in ('offer', 'answer'):
+            self.events.append(message)
+            return
+        if message['type'] == 'offer':
+            # aiortc supporte mal une renégociation avant la fin de sa propre poignée de main DTLS
+            await self.connected.wait()
+        sdp = message['sdp']
+        async with self.lock:
+            await self.pc.setRemoteDescription(RTCSessionDescription(sdp=sdp['sdp'], type=sdp['type']))
+            if message['type'] != 'offer':
+                return
+            answer = await self.pc.createAnswer()
+            await self.pc.setLocalDescription(answer)
+            local = self.pc.localDescription
+        await self.room.handle_answer(self.user_id, {'type': local.type, 'sdp': local.sdp})
+
+
+class Command(BaseCommand):
+    help = "Mesure le CPU et la latence de retransmission du SFU avec des clients synthétiques"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', type=int, default=4)
+        parser.add_argument('--duration', type=float, default=10.0, help="durée de mesure en secondes")
+        parser.add_argument('--warmup', type=float, default=3.0)
+        parser.add_argument('--audio-only', action='store_true')
+        parser.add_argument('--width', type=int, default=640)
+        parser.add_argument('--height', type=int, default=360)
+        parser.add_argument('--fps', type=int, default=30)
+        parser.add_argument('--bitrate', type=int, default=500000)
+        parser.add_argument('--simulcast', action='store_true',
+                            help="trois couches vidéo par client, le premier client parle")
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        audio = encode_audio(2)
+        width, height, fps, bitrate = options['width'], options['height'], options['fps'], options['bitrate']
+        if options['audio_only']:
+            layers = {}
+        elif options['simulcast']:
+            layers = {
+                'low': encode_video(width // 4, height // 4, fps, 2, bitrate // 8),
+                'medium': encode_video(width // 2, height // 2, fps, 2, bitrate // 3),
+                'high': encode_video(width, height, fps, 2, bitrate),
+            }
+        else:
+            layers = {None: encode_video(width, height, fps, 2, bitrate)}
+
+        clients = {}
+        pending = set()
+
+        async def send(user_id, message):
+            if user_id is None:
+                return  # événements diffusés à toute la salle (orateur actif)
+            task = asyncio.ensure_future(clients[user_id].on_message(message))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        room = SfuRoom('bench', send)
+        for user_id in range(1, options['participants'] + 1):
+            if options['simulcast'] and user_id == 1:
+                tracks = [ToneTrack()]
+            else:
+                tracks = [PrerecordedTrack('audio', audio, 50, AUDIO_CLOCK_RATE)]
+            for layer, payloads in layers.items():
+                tracks.append((PrerecordedTrack('video', payloads, fps, VIDEO_CLOCK_RATE), layer))
+            clients[user_id] = SyntheticClient(user_id, room, tracks)
+            await clients[user_id].join()
+
+        await asyncio.sleep(options['warmup'])
+        while pending:
+            await asyncio.gather(*list(pending))
+
+        room.stats.reset()
+        received_before = sum(client.counter.frames for client in clients.values())
+        cpu_start, wall_start = time.process_time(), time.monotonic()
+        await asyncio.sleep(options['duration'])
+        cpu = time.process_time() - cpu_start
+        wall = time.monotonic() - wall_start
+        received = sum(client.counter.frames for client in clients.values()) - received_before
+
+        stats = room.stats
+        p50, p99 = stats.percentile(50), stats.percentile(99)
+        self.stdout.write(f"participants           {options['participants']}")
+        self.stdout.write(f"CPU (processus)        {100 * cpu / wall:.1f} % d'un cœur")
+        self.stdout.write(f"trames retransmises    {stats.frames} ({stats.frames / wall:.0f}/s), abandonnées {stats.dropped}")
+        self.stdout.write(f"débit retransmis       {stats.bitrate() / 1000:.0f} kbit/s")
+        if options['simulcast']:
+            for layer in ('low', 'medium', 'high'):
+                self.stdout.write(f"  couche {layer:<14} {8 * stats.layer_bytes.get(layer, 0) / wall / 1000:.0f} kbit/s")
+            switches = sum(1 for client in clients.values() for event in client.events
+                           if event['type'] == 'layer-switched')
+            self.stdout.write(f"orateur actif          {room.speakers.dominant}")
+            self.stdout.write(f"changements de couche  {switches}")
+        self.stdout.write(f"trames reçues clients  {received}")
+        if p50 is not None:
+            self.stdout.write(f"latence SFU p50/p99    {p50 * 1000:.2f} / {p99 * 1000:.2f} ms")
+
+        await room.close()
+        for client in clients.values():
+            await client.pc.close()
@@ -0,0 +1,316 @@
+"""
+Mode MCU (mixage audio côté serveur) pour les grands appels de groupe audio
+
+Avec un SFU, chaque client reçoit et décode un flux par participant. Ici le
+serveur décode l'audio de chacun, le mixe et renvoie un seul flux Opus par
+participant : le mixage de tous les orateurs actifs, moins sa propre voix.
+
+Le mixage travaille sur des trames fixes de 20 ms, une ligne NumPy par
+participant. Seuls les orateurs actifs (niveau au-dessus du seuil, au plus
+MAX_ACTIVE_SPEAKERS) sont additionnés. Les auditeurs silencieux reçoivent
+tous le même mixage, encodé une seule fois ; seuls les orateurs actifs ont
+un encodage personnalisé (le mixage sans leur voix). Le coût d'encodage
+reste donc à MAX_ACTIVE_SPEAKERS + 1 par trame quel que soit le nombre de
+participants. Chaque tick (décodage, mixage, encodage) s'exécute hors de la
+boucle asyncio ; les appels Opus (cffi) et NumPy libèrent le GIL.
+"""
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+
+import av
+import numpy as np
+from aiortc import RTCPeerConnection
+from aiortc.codecs._opus import ffi, lib
+from aiortc.codecs.opus import OpusDecoder, OpusEncoder
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+
+from monitoring.logs import get_logger
+from .sfu import SFU_PEER, EncodedFrameTap, forget_room, parse_candidate, parse_description
+
+logger = get_logger('signaling')
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_SAMPLES = 960  # 20 ms
+FRAME_DURATION = FRAME_SAMPLES / SAMPLE_RATE
+FRAME_VALUES = FRAME_SAMPLES * CHANNELS
+TIME_BASE = Fraction(1, SAMPLE_RATE)
+
+MAX_ACTIVE_SPEAKERS = 3
+# Niveau RMS (échelle int16) en dessous duquel un participant est considéré silencieux (~ -50 dBov)
+SILENCE_LEVEL = 100.0
+# Décroissance par trame du niveau retenu : un orateur reste actif ~1 s après s'être tu
+LEVEL_DECAY = 0.95
+# Trames d'avance tolérées par participant avant d'abandonner les plus anciennes
+JITTER_FRAMES = 5
+# Paquets perdus consécutifs dissimulés par le décodeur (PLC) ; au-delà, le participant est silencieux
+PLC_FRAMES = 5
+OUTPUT_QUEUE_SIZE = 10
+TICK_SAMPLES = 3000
+
+_executor = ThreadPoolExecutor(thread_name_prefix='mcu')
+
+
+def opus_decode(decoder, payload, out):
+    """
+    Décode un paquet Opus directement dans une ligne du tableau de mixage.
+    payload None : paquet perdu, dissimulation (PLC) du décodeur. Paquet
+    corrompu ou trame plus courte que FRAME_SAMPLES : la ligne (ou sa fin)
+    est remise à zéro, sans quoi la trame précédente serait mixée à nouveau.
+    Retourne le nombre d'échantillons décodés par canal.
+    """
+    data, length = (ffi.NULL, 0) if payload is None else (payload, len(payload))
+    decoded = lib.opus_decode(decoder.decoder, data, length,
+                              ffi.cast('int16_t *', ffi.from_buffer(out)), FRAME_SAMPLES, 0)
+    if decoded < 0:
+        out[:] = 0
+        return 0
+    out[decoded * CHANNELS:] = 0
+    return decoded
+
+
+def opus_encode(encoder, samples):
+    """Encode une trame int16 entrelacée (sans passer par av.AudioFrame ni rééchantillonnage)"""
+    length = lib.opus_encode(encoder.encoder, ffi.cast('int16_t *', ffi.from_buffer(samples)),
+                             FRAME_SAMPLES, encoder.cdata, len(encoder.cdata))
+    return encoder.buffer[0:length]
+
+
+class AudioMixer:
+    """
+    Mixeur vectorisé, indépendant de WebRTC. tick() reçoit le paquet Opus de
+    chaque participant pour la trame courante (None si rien n'est arrivé) et
+    retourne (paquet commun, {participant: paquet personnalisé}, orateurs actifs).
+    Il n'est appelé que depuis un seul thread à la fois.
+    """
+
+    def __init__(self, max_speakers=MAX_ACTIVE_SPEAKERS, silence_level=SILENCE_LEVEL):
+        self.max_speakers = max_speakers
+        self.silence_level = silence_level
+        self.members = []
+        self.decoders = []
+        self.frames = np.zeros((0, FRAME_VALUES), dtype=np.int16)
+        self.levels = np.zeros(0, dtype=np.float32)
+        # Trames consécutives sans paquet, par ligne
+        self.missing = []
+        self.shared_encoder = OpusEncoder()
+        self.encoders = {}
+        self.tick_times = deque(maxlen=TICK_SAMPLES)
+
+    def _sync_members(self, members):
+        """Réaligne les lignes sur les participants présents (arrivées et départs)"""
+        rows = {member: row for row, member in enumerate(self.members)}
+        decoders, missing, levels = [], [], np.zeros(len(members), dtype=np.float32)
+        for index, member in enumerate(members):
+            row = rows.get(member)
+            decoders.append(OpusDecoder() if row is None else self.decoders[row])
+            # Nouveau participant : rien à dissimuler avant son premier paquet
+            missing.append(PLC_FRAMES if row is None else self.missing[row])
+            if row is not None:
+                levels[index] = self.levels[row]
+        for member in set(self.encoders) - set(members):
+            del self.encoders[member]
+        self.members = list(members)
+        self.decoders = decoders
+        self.missing = missing
+        self.levels = levels
+        self.frames = np.zeros((len(members), FRAME_VALUES), dtype=np.int16)
+
+    def tick(self, inputs):
+        started = time.thread_time()
+        if list(inputs) != self.members:
+            self._sync_members(list(inputs))
+        frames = self.frames
+
+        for row, payload in enumerate(inputs.values()):
+            if payload is None:
+                self.missing[row] += 1
+                if self.missing[row] > PLC_FRAMES:
+                    frames[row] = 0
+                    continue
+            else:
+                self.missing[row] = 0
+            opus_decode(self.decoders[row], payload, frames[row])
+
+        # Détection des orateurs : niveau RMS de la trame, maintenu avec décroissance
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1))
+        self.levels = np.maximum(rms, self.levels * LEVEL_DECAY)
+        active = np.flatnonzero(self.levels > self.silence_level)
+        if len(active) > self.max_speakers:
+            active = active[np.argsort(self.levels[active])[-self.max_speakers:]]
+
+        # Les participants silencieux ne sont pas additionnés
+        total = frames[active].sum(axis=0, dtype=np.int32)
+        shared = opus_encode(self.shared_encoder, np.clip(total, -32768, 32767).astype(np.int16))
+        personal = {}
+        for row in active:
+            member = self.members[row]
+            encoder = self.encoders.get(member)
+            if encoder is None:
+                encoder = self.encoders[member] = OpusEncoder()
+            own_mix = np.clip(total - frames[row], -32768, 32767).astype(np.int16)
+            personal[member] = opus_encode(encoder, own_mix)
+
+        self.tick_times.append(time.thread_time() - started)
+        return shared, personal, [self.members[row] for row in active]
+
+
+class MixedAudioTrack(MediaStreamTrack):
+    """Piste sortante d'un participant : paquets Opus déjà encodés par le mixeur"""
+
+    kind = 'audio'
+
+    def __init__(self):
+        super().__init__()
+        self._queue = asyncio.Queue(maxsize=OUTPUT_QUEUE_SIZE)
+
+    def push(self, payload, index):
+        if self.readyState != 'live':
+            return
+        if self._queue.full():
+            self._queue.get_nowait()
+        packet = av.Packet(payload)
+        packet.pts = index * FRAME_SAMPLES
+        packet.time_base = TIME_BASE
+        self._queue.put_nowait(packet)
+
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+        return await self._queue.get()
+
+
+class McuParticipant:
+    def __init__(self, room, user_id):
+        self.room = room
+        self.user_id = user_id
+        self.pc = RTCPeerConnection()
+        self.output = MixedAudioTrack()
+        self.inputs = deque(maxlen=JITTER_FRAMES)
+        self.lock = asyncio.Lock()
+
+        @self.pc.on('connectionstatechange')
+        async def on_connectionstatechange():
+            if self.pc.connectionState in ('failed', 'closed'):
+                await self.room.leave(self.user_id)
+
+    def attach(self):
+        """
+        Après l'offre du client : branche la réception sur le mixeur et la piste
+        mixée sur le même transceiver. Opus seul est retenu car le mixeur
+        produit des paquets Opus que l'émetteur se contente de re-paquetiser.
+        """
+        for transceiver in self.pc.getTransceivers():
+            if transceiver.kind != 'audio' or transceiver.sender.track is not None:
+                continue
+            transceiver._codecs = [c for c in transceiver._codecs if c.mimeType.lower() == 'audio/opus']
+            if not transceiver._codecs:
+                logger.warning('mcu.no_opus', call_id=self.room.call_id, user_id=self.user_id)
+                return
+            if transceiver.receiver.track is not None:
+                EncodedFrameTap.install(transceiver.receiver, 'audio').subscribers.add(self)
+            self.pc.addTrack(self.output)
+            return
+
+    # Abonné de l'EncodedFrameTap
+    def push(self, codec, frame):
+        self.inputs.append(frame.data)
+
+    def end(self):
+        self.inputs.clear()
+
+    async def close(self):
+        self.output.stop()
+        await self.pc.close()
+
+
+class McuRoom:
+    """Salle en mode MCU ; même interface et même signalisation que SfuRoom"""
+
+    supports_recording = False
+
+    def __init__(self, call_id, send):
+        self.call_id = call_id
+        self.send = send
+        self.participants = {}
+        self.mixer = AudioMixer()
+        self.active_speakers = []
+        self._task = None
+
+    def _message(self, message_type, user_id, **payload):
+        return {
+            'type': message_type,
+            'sender': SFU_PEER,
+            'receiver': user_id,
+            'callId': self.call_id,
+            **payload,
+        }
+
+    async def handle_offer(self, user_id, sdp):
+        participant = self.participants.get(user_id)
+        if participant is None:
+            participant = self.participants[user_id] = McuParticipant(self, user_id)
+        async with participant.lock:
+            await participant.pc.setRemoteDescription(parse_description(sdp, 'offer'))
+            participant.attach()
+            answer = await participant.pc.createAnswer()
+            await participant.pc.setLocalDescription(answer)
+            local = participant.pc.localDescription
+            await self.send(user_id, self._message(
+                'answer', user_id, sdp={'type': local.type, 'sdp': local.sdp}))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def handle_candidate(self, user_id, candidate):
+        participant = self.participants.get(user_id)
+        ice_candidate = parse_candidate(candidate)
+        if participant is None or ice_candidate is None:
+            return
+        await participant.pc.addIceCandidate(ice_candidate)
+
+    async def handle_message(self, user_id, data):
+        message_type = data.get('type')
+        if message_type == 'offer':
+            await self.handle_offer(user_id, data.get('sdp'))
+        elif message_type == 'ice-candidate':
+            await self.handle_candidate(user_id, data.get('candidate'))
+
+    async def _run(self):
+        """Horloge du mixage : une trame toutes les 20 ms, rattrapée si la boucle prend du retard"""
+        loop = asyncio.get_running_loop()
+        index = 0
+        start = time.monotonic()
+        while self.participants:
+            participants = list(self.participants.values())
+            inputs = {p.user_id: (p.inputs.popleft() if p.inputs else None) for p in participants}
+            shared, personal, active = await loop.run_in_executor(_executor, self.mixer.tick, inputs)
+            for participant in participants:
+                participant.output.push(personal.get(participant.user_id, shared), index)
+
+            if active != self.active_speakers:
+                self.active_speakers = active
+                await self.send(None, self._message('active-speakers', None, speakers=active))
+
+            index += 1
+            delay = start + index * FRAME_DURATION - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -10 * FRAME_DURATION:
+                start = time.monotonic() - index * FRAME_DURATION
+        self._task = None
+
+    async def leave(self, user_id):
+        participant = self.participants.pop(user_id, None)
+        if participant is None:
+            return
+        await participant.close()
+        if not self.participants:
+            forget_room(self.call_id)
+
+    async def close(self):
+        for user_id in list(self.participants):
+            await self.leave(user_id)
+        forget_room(self.call_id)
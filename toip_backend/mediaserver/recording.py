@@ -0,0 +1,226 @@
+"""
+Enregistrement des appels côté serveur
+
+L'enregistreur rejoint la salle SFU comme un participant en réception seule
+(pair aiortc local, sans navigateur). Les trames encodées reçues sont
+conservées par piste pendant SEGMENT_SECONDS, puis confiées à un pool de
+processus qui décode, mixe l'audio, compose la vidéo et écrit un segment
+WebM (voir mediaserver.segments) : la mémoire reste bornée quelle que soit
+la durée de l'appel et l'encodage ne partage pas la boucle asyncio de la
+signalisation. À la fin de l'appel, les segments sont concaténés sans
+ré-encodage et Call.recording_path est renseigné.
+"""
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from calls.models import Call
+from monitoring.logs import get_logger
+from .segments import concat_segments, encode_segment
+from .sfu import EncodedFrameTap, is_keyframe
+
+logger = get_logger('signaling')
+
+# Identifiant de l'enregistreur parmi les participants de la salle SFU
+RECORDER_PEER = 'recorder'
+RECORDINGS_DIR = 'recordings'
+SEGMENT_SECONDS = getattr(settings, 'RECORDING_SEGMENT_SECONDS', 10)
+RECORDING_WORKERS = getattr(settings, 'RECORDING_WORKERS', 2)
+# Au-delà, l'image clé suivante est demandée à l'émetteur plutôt que d'accumuler le GOP
+MAX_GOP_FRAMES = 300
+
+_pool = None
+_recorders = {}
+
+
+def get_pool():
+    """Pool de processus partagé ; 'spawn' évite de dupliquer la boucle asyncio et les sockets du serveur"""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=RECORDING_WORKERS,
+                                    mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+class TrackBuffer:
+    """
+    Abonné d'un EncodedFrameTap : accumule les trames du segment en cours,
+    horodatées sur l'horloge de l'enregistreur à partir du timestamp RTP.
+    """
+
+    def __init__(self, recorder, receiver, kind):
+        self.recorder = recorder
+        self.receiver = receiver
+        self.kind = kind
+        self.codec = None
+        self.frames = []
+        # Trames depuis la dernière image clé, rejouées en tête du segment suivant
+        self.since_keyframe = []
+        self._anchor = None
+        self._last_timestamp = None
+        self._elapsed = 0
+
+    def push(self, codec, frame):
+        self.codec = codec
+        if self._anchor is None:
+            self._anchor = self.recorder.clock()
+        else:
+            # Différence modulo 2^32 : le timestamp RTP peut reboucler
+            delta = (frame.timestamp - self._last_timestamp) & 0xFFFFFFFF
+            if delta >= 0x80000000:
+                delta -= 0x100000000
+            self._elapsed += delta
+        self._last_timestamp = frame.timestamp
+        item = (self._anchor + self._elapsed / codec.clockRate, bytes(frame.data))
+        self.frames.append(item)
+
+        if self.kind == 'video':
+            if is_keyframe(codec.mimeType, item[1]):
+                self.since_keyframe = [item]
+            elif self.since_keyframe:
+                self.since_keyframe.append(item)
+                if len(self.since_keyframe) > MAX_GOP_FRAMES:
+                    self.since_keyframe = []
+                    self.request_keyframe()
+
+    def end(self):
+        pass
+
+    def request_keyframe(self):
+        for source in self.receiver.getSynchronizationSources():
+            asyncio.ensure_future(self.receiver._send_rtcp_pli(source.source))
+
+    def take(self):
+        frames = self.frames
+        self.frames = list(self.since_keyframe)
+        return frames
+
+
+class CallRecorder:
+    def __init__(self, room, video=True, segment_seconds=SEGMENT_SECONDS):
+        self.room = room
+        self.call_id = room.call_id
+        self.video = video
+        self.segment_seconds = segment_seconds
+        self.relative_dir = f'{RECORDINGS_DIR}/call_{self.call_id}'
+        self.directory = os.path.join(settings.MEDIA_ROOT, self.relative_dir)
+        self.buffers = []
+        self.pending = []
+        self.segment_index = 0
+        self.segment_start = 0.0
+        self.finished = None
+        self._origin = None
+        self._rotation = None
+
+        self.pc = RTCPeerConnection()
+        # Une offre sans média n'est pas valide : le canal de données porte la session
+        self.pc.createDataChannel('recorder')
+
+        @self.pc.on('track')
+        def on_track(track):
+            transceiver = next(t for t in self.pc.getTransceivers() if t.receiver.track is track)
+            buffer = TrackBuffer(self, transceiver.receiver, track.kind)
+            EncodedFrameTap.install(transceiver.receiver, track.kind).subscribers.add(buffer)
+            self.buffers.append(buffer)
+
+    def clock(self):
+        return time.monotonic() - self._origin
+
+    async def start(self):
+        self._origin = time.monotonic()
+        self.room.local_peers[RECORDER_PEER] = self
+        offer = await self.pc.createOffer()
+        await self.pc.setLocalDescription(offer)
+        local = self.pc.localDescription
+        await self.room.handle_offer(RECORDER_PEER, {'type': local.type, 'sdp': local.sdp})
+        self._rotation = asyncio.ensure_future(self._rotate())
+
+    async def on_signaling(self, message):
+        if message['type'] not in ('offer', 'answer'):
+            return  # événements destinés à un affichage (changement de couche...)
+        sdp = message['sdp']
+        await self.pc.setRemoteDescription(RTCSessionDescription(sdp=sdp['sdp'], type=sdp['type']))
+        if message['type'] == 'offer':
+            answer = await self.pc.createAnswer()
+            await self.pc.setLocalDescription(answer)
+            local = self.pc.localDescription
+            await self.room.handle_answer(RECORDER_PEER, {'type': local.type, 'sdp': local.sdp})
+
+    async def _rotate(self):
+        while True:
+            await asyncio.sleep(self.segment_seconds)
+            self.cut_segment()
+
+    def cut_segment(self):
+        """Ferme le segment en cours et l'envoie au pool d'encodage"""
+        end = self.clock()
+        tracks = []
+        for buffer in self.buffers:
+            frames = buffer.take()
+            if buffer.codec is not None and frames:
+                tracks.append({'kind': buffer.kind, 'codec': buffer.codec.mimeType, 'frames': frames})
+        job = {
+            'path': os.path.join(self.directory, f'segment_{self.segment_index:05d}.webm'),
+            'start': self.segment_start,
+            'duration': end - self.segment_start,
+            'video': self.video,
+            'tracks': tracks,
+        }
+        self.segment_index += 1
+        self.segment_start = end
+        loop = asyncio.get_running_loop()
+        self.pending.append(loop.run_in_executor(get_pool(), encode_segment, job))
+
+    async def stop(self):
+        """Quitte la salle ; la finalisation se poursuit en tâche de fond (voir on_leave)"""
+        if RECORDER_PEER in self.room.local_peers:
+            await self.room.leave(RECORDER_PEER)
+        return self.finished
+
+    async def on_leave(self):
+        if self.finished is None:
+            self.finished = asyncio.ensure_future(self._finish())
+
+    async def _finish(self):
+        self._rotation.cancel()
+        await self.pc.close()
+        _recorders.pop(self.call_id, None)
+        if self.clock() - self.segment_start >= 0.1:
+            self.cut_segment()
+        try:
+            paths = await asyncio.gather(*self.pending)
+            if not paths:
+                return None
+            name = f'{self.relative_dir}/recording.webm'
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                get_pool(), concat_segments, paths, os.path.join(settings.MEDIA_ROOT, name))
+        except Exception:
+            logger.exception('recording.failed', call_id=self.call_id)
+            return None
+        await save_recording_path(self.call_id, name)
+        logger.info('recording.saved', call_id=self.call_id, path=name)
+        return name
+
+
+@database_sync_to_async
+def save_recording_path(call_id, name):
+    Call.objects.filter(pk=call_id).update(recording_path=name)
+
+
+async def start_recording(room, video=True):
+    recorder = _recorders.get(room.call_id)
+    if recorder is None:
+        recorder = _recorders[room.call_id] = CallRecorder(room, video=video)
+        await recorder.start()
+    return recorder
+
+
+def find_recorder(call_id):
+    return _recorders.get(call_id)
@@ -0,0 +1,175 @@
+"""
+Encodage des segments d'enregistrement (exécuté dans un pool de processus)
+
+Ce module ne dépend ni de Django ni d'aiortc : il est importé par les
+processus du pool. Un segment reçoit les trames encodées de chaque piste
+(instant d'arrivée en secondes, octets) ; l'audio des participants est
+décodé et mixé, la vidéo est décodée et composée en mosaïque, puis le tout
+est ré-encodé (VP8 + Opus) dans un fichier WebM. Les segments sont ensuite
+concaténés sans ré-encodage.
+"""
+import math
+import os
+
+import av
+import numpy as np
+
+OUTPUT_WIDTH = 640
+OUTPUT_HEIGHT = 360
+OUTPUT_FPS = 15
+VIDEO_BITRATE = 800000
+AUDIO_RATE = 48000
+AUDIO_FRAME_SAMPLES = 960
+
+DECODERS = {
+    'video/vp8': 'vp8',
+    'video/h264': 'h264',
+    'audio/opus': 'opus',
+    'audio/pcmu': 'pcm_mulaw',
+    'audio/pcma': 'pcm_alaw',
+}
+
+
+def _decoder(mime_type):
+    return av.CodecContext.create(DECODERS[mime_type.lower()], 'r')
+
+
+def _decode(decoder, data):
+    try:
+        return decoder.decode(av.Packet(data))
+    except av.error.FFmpegError:
+        # Trame non décodable (image de référence manquante en début de segment...)
+        return []
+
+
+def _open_output(path, with_video):
+    container = av.open(path, 'w', format='webm')
+    video = None
+    if with_video:
+        video = container.add_stream('libvpx', rate=OUTPUT_FPS)
+        video.width = OUTPUT_WIDTH
+        video.height = OUTPUT_HEIGHT
+        video.pix_fmt = 'yuv420p'
+        video.bit_rate = VIDEO_BITRATE
+        video.options = {'deadline': 'realtime', 'cpu-used': '8', 'lag-in-frames': '0'}
+    audio = container.add_stream('libopus', rate=AUDIO_RATE)
+    audio.layout = 'stereo'
+    return container, video, audio
+
+
+def mix_audio(tracks, start, duration):
+    """Décode et additionne les pistes audio sur une ligne de temps (2, échantillons) en float32"""
+    total = int(round(duration * AUDIO_RATE))
+    mix = np.zeros((2, total), dtype=np.float32)
+    for track in tracks:
+        decoder = _decoder(track['codec'])
+        resampler = av.AudioResampler(format='fltp', layout='stereo', rate=AUDIO_RATE)
+        for arrival, data in track['frames']:
+            offset = int(round((arrival - start) * AUDIO_RATE))
+            for frame in _decode(decoder, data):
+                for resampled in resampler.resample(frame):
+                    samples = resampled.to_ndarray()
+                    begin, end = max(offset, 0), min(offset + samples.shape[1], total)
+                    if end > begin:
+                        mix[:, begin:end] += samples[:, begin - offset:end - offset]
+                    offset += samples.shape[1]
+    np.clip(mix, -1.0, 1.0, out=mix)
+    return mix
+
+
+def _encode_audio(container, stream, mix):
+    interleaved = (mix.T * 32767).astype(np.int16)
+    for index in range(0, interleaved.shape[0], AUDIO_FRAME_SAMPLES):
+        chunk = interleaved[index:index + AUDIO_FRAME_SAMPLES]
+        frame = av.AudioFrame.from_ndarray(chunk.reshape(1, -1), format='s16', layout='stereo')
+        frame.sample_rate = AUDIO_RATE
+        frame.pts = index
+        for packet in stream.encode(frame):
+            container.mux(packet)
+
+
+def mosaic_layout(count):
+    """(colonnes, lignes, largeur, hauteur) des vignettes, dimensions paires"""
+    columns = max(1, math.ceil(math.sqrt(count)))
+    rows = max(1, math.ceil(count / columns))
+    return columns, rows, (OUTPUT_WIDTH // columns) & ~1, (OUTPUT_HEIGHT // rows) & ~1
+
+
+def _encode_video(container, stream, tracks, start, duration):
+    """Décode les pistes au fil de l'eau (une vignette en mémoire par piste) et compose la mosaïque"""
+    columns, _, tile_width, tile_height = mosaic_layout(len(tracks))
+    states = []
+    for track in tracks:
+        frames = iter(track['frames'])
+        states.append({'decoder': _decoder(track['codec']), 'frames': frames,
+                       'next': next(frames, None), 'tile': None})
+
+    for index in range(int(round(duration * OUTPUT_FPS))):
+        now = start + index / OUTPUT_FPS
+        canvas = np.zeros((OUTPUT_HEIGHT, OUTPUT_WIDTH, 3), dtype=np.uint8)
+        for position, state in enumerate(states):
+            while state['next'] is not None and state['next'][0] <= now:
+                for frame in _decode(state['decoder'], state['next'][1]):
+                    state['tile'] = frame.to_ndarray(width=tile_width, height=tile_height, format='rgb24')
+                state['next'] = next(state['frames'], None)
+            if state['tile'] is not None:
+                top = (position // columns) * tile_height
+                left = (position % columns) * tile_width
+                canvas[top:top + tile_height, left:left + tile_width] = state['tile']
+        frame = av.VideoFrame.from_ndarray(canvas, format='rgb24')
+        frame.pts = index
+        for packet in stream.encode(frame):
+            container.mux(packet)
+
+
+def encode_segment(job):
+    """
+    job = {'path', 'start', 'duration', 'video': bool,
+           'tracks': [{'kind', 'codec', 'frames': [(arrivée, octets), ...]}]}
+    """
+    os.makedirs(os.path.dirname(job['path']), exist_ok=True)
+    audio_tracks = [track for track in job['tracks'] if track['kind'] == 'audio']
+    video_tracks = [track for track in job['tracks'] if track['kind'] == 'video']
+
+    container, video, audio = _open_output(job['path'], job['video'])
+    try:
+        if video is not None:
+            _encode_video(container, video, video_tracks, job['start'], job['duration'])
+        _encode_audio(container, audio, mix_audio(audio_tracks, job['start'], job['duration']))
+        for stream in (video, audio):
+            if stream is not None:
+                for packet in stream.encode(None):
+                    container.mux(packet)
+    finally:
+        container.close()
+    return job['path']
+
+
+def concat_segments(paths, output_path, remove=True):
+    """Concatène des segments de même structure sans ré-encodage, en flux (mémoire constante)"""
+    output = None
+    out_streams = []
+    offsets = []
+    for path in paths:
+        with av.open(path) as source:
+            if output is None:
+                output = av.open(output_path, 'w', format='webm')
+                out_streams = [output.add_stream(template=stream) for stream in source.streams]
+                offsets = [0] * len(out_streams)
+            ends = list(offsets)
+            for packet in source.demux():
+                if packet.dts is None:
+                    continue
+                index = packet.stream.index
+                packet.stream = out_streams[index]
+                packet.pts += offsets[index]
+                packet.dts += offsets[index]
+                ends[index] = max(ends[index], packet.pts + (packet.duration or 0))
+                output.mux(packet)
+            offsets = ends
+    if output is not None:
+        output.close()
+    if remove:
+        for path in paths:
+            os.remove(path)
+    return output_path if output is not None else None
@@ -0,0 +1,764 @@
+"""
+Unité de transfert sélectif (SFU) pour les appels de groupe
+
+Le serveur termine une connexion WebRTC par participant et retransmet les
+trames encodées reçues de chaque émetteur vers les autres participants, sans
+décodage ni ré-encodage : chaque client n'envoie qu'une copie de ses flux.
+
+aiortc décode systématiquement ce qu'il reçoit. Pour l'éviter, la file du
+thread décodeur de chaque RTCRtpReceiver est remplacée par un EncodedFrameTap
+qui distribue les trames encodées (JitterFrame) aux pistes de retransmission.
+Celles-ci renvoient des av.Packet, que RTCRtpSender se contente de
+re-paquetiser (Encoder.pack) au lieu de les encoder.
+
+Simulcast : un client peut publier plusieurs couches d'une même vidéo
+(une piste par résolution, annoncées par mid dans le champ 'simulcast' de
+son offre). Chaque récepteur ne reçoit qu'une couche par source, choisie
+d'après ses indications d'affichage (message 'viewport') et l'orateur actif,
+détecté à partir du niveau audio des paquets RTP (RFC 6464).
+
+Les salles vivent dans le processus qui reçoit la signalisation : en
+déploiement multi-processus, les WebSockets d'un même appel doivent être
+routées vers le même processus (répartition collante par call_id).
+"""
+import asyncio
+import time
+from collections import deque
+from fractions import Fraction
+
+import av
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.codecs import get_capabilities
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+from aiortc.sdp import candidate_from_sdp
+
+from monitoring.logs import get_logger
+
+logger = get_logger('signaling')
+
+# Valeur de "receiver" désignant le serveur média dans les messages de signalisation
+SFU_PEER = 'sfu'
+
+# Trames en attente par piste retransmise avant d'abandonner les plus anciennes
+FORWARD_QUEUE_SIZE = {'audio': 50, 'video': 30}
+# Intervalle minimal entre deux demandes d'image clé (PLI) à un émetteur
+KEYFRAME_INTERVAL = 1.0
+LATENCY_SAMPLES = 10000
+
+# Couches simulcast, de la plus légère à la plus lourde
+LAYERS = ('low', 'medium', 'high')
+# Hauteur d'affichage maximale (pixels) servie par une couche
+LAYER_MAX_HEIGHT = {'low': 180, 'medium': 360}
+
+# Détection de l'orateur actif : moyenne glissante du volume (dB au-dessus de
+# -127 dBov), réévaluée au plus toutes les SPEAKER_CHECK_INTERVAL secondes
+SPEAKER_SMOOTHING = 0.05
+SPEAKER_CHECK_INTERVAL = 0.3
+SPEAKER_MIN_LOUDNESS = 127 - 60
+SPEAKER_MARGIN = 6
+
+
+class ForwardingStats:
+    """Compteurs de retransmission d'une salle (trames, octets, latence interne)"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.layer_bytes = {}
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.started = time.monotonic()
+
+    def record(self, size, latency, layer=None):
+        self.frames += 1
+        self.bytes += size
+        self.layer_bytes[layer] = self.layer_bytes.get(layer, 0) + size
+        self.latencies.append(latency)
+
+    def bitrate(self):
+        """Débit retransmis moyen depuis reset(), en bit/s"""
+        elapsed = time.monotonic() - self.started
+        return 8 * self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class EncodedFrameTap:
+    """
+    Remplace la file (queue.Queue) du décodeur d'un RTCRtpReceiver aiortc.
+
+    aiortc y dépose (codec, trame encodée) depuis la boucle asyncio : les trames
+    sont distribuées aux pistes abonnées. get() est appelé par le thread
+    décodeur, qui se termine aussitôt : aucune trame n'est décodée.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.codec = None
+        self.subscribers = set()
+
+    def get(self, *args, **kwargs):
+        return None
+
+    def put(self, task, *args, **kwargs):
+        if task is None:
+            for track in list(self.subscribers):
+                track.end()
+            return
+        codec, frame = task
+        self.codec = codec
+        for track in list(self.subscribers):
+            track.push(codec, frame)
+
+    @classmethod
+    def install(cls, receiver, kind):
+        """Doit être appelé avant RTCRtpReceiver.receive(), c'est-à-dire à l'événement 'track'"""
+        tap = cls(kind)
+        receiver._RTCRtpReceiver__decoder_queue = tap
+        return tap
+
+
+def is_keyframe(mime_type, data):
+    mime_type = mime_type.lower()
+    if mime_type == 'video/vp8':
+        # Bit P de l'en-tête de trame VP8 : 0 pour une image clé
+        return bool(data) and not data[0] & 0x01
+    if mime_type == 'video/h264':
+        # Flux Annex B produit par aiortc : présence d'une NAL IDR (5) ou SPS (7)
+        index = data.find(b'\x00\x00\x01')
+        while index != -1 and index + 3 < len(data):
+            if data[index + 3] & 0x1f in (5, 7):
+                return True
+            index = data.find(b'\x00\x00\x01', index + 3)
+        return False
+    return True
+
+
+def layer_for_height(height):
+    for layer in LAYERS[:-1]:
+        if height <= LAYER_MAX_HEIGHT[layer]:
+            return layer
+    return LAYERS[-1]
+
+
+class _Feed:
+    """Abonnement d'une piste retransmise au tap d'une couche"""
+
+    def __init__(self, track, publication):
+        self.track = track
+        self.publication = publication
+
+    def push(self, codec, frame):
+        self.track.feed(self.publication, codec, frame)
+
+    def end(self):
+        self.track.feed_ended(self.publication)
+
+
+class ForwardedTrack(MediaStreamTrack):
+    """
+    Piste sortante d'une source : un flux simple ou l'ensemble des couches
+    simulcast d'un émetteur. Une seule couche est retransmise ; un changement
+    de couche prend effet à la prochaine image clé de la nouvelle couche et les
+    timestamps sont recalés pour rester continus côté récepteur.
+    """
+
+    def __init__(self, owner, kind, stats, on_switch=None):
+        super().__init__()
+        self.kind = kind
+        self.owner = owner
+        # Couche retransmise, et couche demandée en attente d'une image clé
+        self.publication = None
+        self.pending = None
+        self._stats = stats
+        self._on_switch = on_switch
+        self._feeds = {}
+        self._queue = asyncio.Queue(maxsize=FORWARD_QUEUE_SIZE.get(self.kind, 30))
+        self._offset = 0
+        self._last = None
+        self._rebase = False
+
+    @property
+    def layer(self):
+        return self.publication.layer if self.publication is not None else None
+
+    def _attach(self, publication):
+        if id(publication) not in self._feeds:
+            feed = self._feeds[id(publication)] = _Feed(self, publication)
+            publication.tap.subscribers.add(feed)
+
+    def _detach(self, publication):
+        feed = self._feeds.pop(id(publication), None)
+        if feed is not None:
+            publication.tap.subscribers.discard(feed)
+
+    def select(self, publication):
+        """Choisit la couche à retransmettre (None : pause)"""
+        if publication is None:
+            if self.pending is not None:
+                self._detach(self.pending)
+                self.pending = None
+            if self.publication is not None:
+                self._detach(self.publication)
+                self.publication = None
+                self._switched()
+            return
+        if publication is self.pending:
+            return
+        if self.pending is not None:
+            self._detach(self.pending)
+            self.pending = None
+        if publication is self.publication:
+            return
+        self.pending = publication
+        self._attach(publication)
+        if publication.kind == 'video':
+            publication.request_keyframe()
+        else:
+            self._complete_switch()
+
+    def _complete_switch(self):
+        if self.publication is not None:
+            self._detach(self.publication)
+        self.publication, self.pending = self.pending, None
+        self._rebase = True
+        self._switched()
+
+    def _switched(self):
+        if self._on_switch is not None:
+            self._on_switch(self)
+
+    def request_keyframe(self):
+        publication = self.pending or self.publication
+        if publication is not None:
+            publication.request_keyframe()
+
+    def feed(self, publication, codec, frame):
+        if publication is self.pending and is_keyframe(codec.mimeType, frame.data):
+            self._complete_switch()
+        if publication is self.publication:
+            self.push(codec, frame)
+
+    def feed_ended(self, publication):
+        if publication is self.pending:
+            self._detach(publication)
+            self.pending = None
+        elif publication is self.publication:
+            self.end()
+
+    def push(self, codec, frame):
+        if self.readyState != 'live':
+            return
+        now = time.monotonic()
+        if self._rebase:
+            # Nouvelle couche : prolonger la ligne de temps de la précédente
+            self._rebase = False
+            if self._last is not None:
+                last_pts, last_time = self._last
+                elapsed = max(1, round((now - last_time) * codec.clockRate))
+                self._offset = last_pts + elapsed - frame.timestamp
+        pts = frame.timestamp + self._offset
+        self._last = (pts, now)
+
+        if self._queue.full():
+            # Récepteur en retard : abandonner la plus ancienne trame
+            self._queue.get_nowait()
+            self._stats.dropped += 1
+            if self.kind == 'video':
+                self.request_keyframe()
+        packet = av.Packet(frame.data)
+        packet.pts = pts
+        packet.time_base = Fraction(1, codec.clockRate)
+        self._queue.put_nowait((packet, now, self.layer))
+
+    def end(self):
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+        item = await self._queue.get()
+        if item is None:
+            self.stop()
+            raise MediaStreamError
+        packet, pushed_at, layer = item
+        self._stats.record(packet.size, time.monotonic() - pushed_at, layer)
+        return packet
+
+    def stop(self):
+        for feed in list(self._feeds.values()):
+            feed.publication.tap.subscribers.discard(feed)
+        self._feeds.clear()
+        super().stop()
+
+
+class SpeakerDetector:
+    """Orateur actif d'une salle, d'après le niveau audio (RFC 6464) des paquets reçus"""
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.loudness = {}
+        self.dominant = None
+        self._checked = 0.0
+
+    def record(self, user_id, level):
+        """level : niveau en -dBov (0 = maximum, 127 = silence)"""
+        previous = self.loudness.get(user_id, 0.0)
+        self.loudness[user_id] = previous + SPEAKER_SMOOTHING * ((127 - level) - previous)
+
+        now = time.monotonic()
+        if now - self._checked < SPEAKER_CHECK_INTERVAL:
+            return
+        self._checked = now
+        candidate = max(self.loudness, key=self.loudness.get)
+        if candidate == self.dominant or self.loudness[candidate] < SPEAKER_MIN_LOUDNESS:
+            return
+        # Hystérésis : le nouvel orateur doit nettement couvrir l'actuel
+        if self.loudness[candidate] > self.loudness.get(self.dominant, 0.0) + SPEAKER_MARGIN:
+            self.dominant = candidate
+            if self.on_change is not None:
+                self.on_change(candidate)
+
+    def forget(self, user_id):
+        self.loudness.pop(user_id, None)
+        if self.dominant == user_id:
+            self.dominant = None
+
+
+class Publication:
+    """Flux (audio ou vidéo) envoyé au serveur par un participant"""
+
+    def __init__(self, owner, transceiver, layer=None):
+        self.owner = owner
+        self.kind = transceiver.kind
+        self.transceiver = transceiver
+        self.layer = layer
+        self.tap = EncodedFrameTap.install(transceiver.receiver, self.kind)
+        self._last_keyframe_request = 0.0
+        if self.kind == 'audio':
+            self._meter_audio_level()
+
+    @property
+    def source_key(self):
+        """Les couches simulcast d'un participant forment une seule source"""
+        return (self.owner.user_id, self.kind, 'simulcast') if self.layer else id(self)
+
+    def _meter_audio_level(self):
+        """Transmet le niveau audio de chaque paquet RTP (extension ssrc-audio-level) au détecteur"""
+        receiver = self.transceiver.receiver
+        handle_rtp_packet = receiver._handle_rtp_packet
+        speakers = self.owner.room.speakers
+        user_id = self.owner.user_id
+
+        async def metered(packet, arrival_time_ms):
+            level = packet.extensions.audio_level
+            if level is not None:
+                speakers.record(user_id, level[1])
+            await handle_rtp_packet(packet, arrival_time_ms)
+
+        receiver._handle_rtp_packet = metered
+
+    @property
+    def codec(self):
+        """Codec négocié avec l'émetteur (premier codec hors RTX)"""
+        for codec in self.transceiver._codecs:
+            if not codec.mimeType.lower().endswith('/rtx'):
+                return codec
+        return None
+
+    def request_keyframe(self):
+        if self.kind != 'video':
+            return
+        now = time.monotonic()
+        if now - self._last_keyframe_request < KEYFRAME_INTERVAL:
+            return
+        self._last_keyframe_request = now
+        receiver = self.transceiver.receiver
+        for source in receiver.getSynchronizationSources():
+            asyncio.ensure_future(receiver._send_rtcp_pli(source.source))
+
+    def close(self):
+        for subscriber in list(self.tap.subscribers):
+            subscriber.end()
+
+
+def codec_preferences(kind, codec):
+    """Capacités aiortc correspondant au codec de l'émetteur (plus RTX) pour un transceiver sortant"""
+    capabilities = get_capabilities(kind).codecs
+    mime_type = codec.mimeType.lower()
+    matching = [c for c in capabilities
+                if c.mimeType.lower() == mime_type and c.parameters == codec.parameters]
+    if not matching:
+        matching = [c for c in capabilities if c.mimeType.lower() == mime_type]
+    rtx = [c for c in capabilities if c.mimeType.lower().endswith('/rtx')]
+    return matching + rtx if matching else []
+
+
+def parse_description(sdp, default_type):
+    """Accepte {'type', 'sdp'} (RTCSessionDescription côté navigateur) ou le SDP brut"""
+    if isinstance(sdp, dict):
+        return RTCSessionDescription(sdp=sdp.get('sdp', ''), type=sdp.get('type') or default_type)
+    return RTCSessionDescription(sdp=sdp or '', type=default_type)
+
+
+def parse_candidate(candidate):
+    """Convertit un RTCIceCandidateInit ({'candidate', 'sdpMid', 'sdpMLineIndex'}) pour aiortc"""
+    if not candidate or not candidate.get('candidate'):
+        return None
+    line = candidate['candidate']
+    if line.startswith('candidate:'):
+        line = line[len('candidate:'):]
+    ice_candidate = candidate_from_sdp(line)
+    ice_candidate.sdpMid = candidate.get('sdpMid')
+    ice_candidate.sdpMLineIndex = candidate.get('sdpMLineIndex')
+    return ice_candidate
+
+
+class SfuParticipant:
+    def __init__(self, room, user_id):
+        self.room = room
+        self.user_id = user_id
+        self.pc = RTCPeerConnection()
+        self.publications = []
+        # mid -> couche simulcast annoncée dans l'offre en cours
+        self.layer_hints = {}
+        # clé de source -> (transceiver, piste)
+        self.subscriptions = {}
+        # Publications à ajouter à la prochaine offre du serveur
+        self.deferred = {}
+        self.lock = asyncio.Lock()
+        self.renegotiation_pending = False
+        self._watching_transport = False
+
+        @self.pc.on('track')
+        def on_track(track):
+            transceiver = next(t for t in self.pc.getTransceivers() if t.receiver.track is track)
+            layer = self.layer_hints.get(transceiver.mid)
+            self.publications.append(Publication(self, transceiver, layer if layer in LAYERS else None))
+
+        @self.pc.on('connectionstatechange')
+        async def on_connectionstatechange():
+            if self.pc.connectionState in ('failed', 'closed'):
+                await self.room.leave(self.user_id)
+
+    @property
+    def transport(self):
+        """Transport DTLS négocié (BUNDLE : partagé par tous les flux et le canal de données)"""
+        for transceiver in self.pc.getTransceivers():
+            if transceiver.mid is not None:
+                return transceiver.receiver.transport
+        return self.pc.sctp.transport if self.pc.sctp else None
+
+    @property
+    def connected(self):
+        transport = self.transport
+        return transport is not None and transport.state == 'connected'
+
+    def watch_transport(self):
+        """Relance la négociation différée dès que le transport est connecté"""
+        transport = self.transport
+        if transport is None or self._watching_transport:
+            return
+        self._watching_transport = True
+
+        @transport.on('statechange')
+        async def on_statechange():
+            if transport.state == 'connected' and self.renegotiation_pending:
+                await self.room.renegotiate(self)
+
+    def subscribe(self, publication):
+        key = publication.source_key
+        if key in self.subscriptions or key in self.deferred or publication.codec is None:
+            return False
+        if self.lock.locked() or self.pc.signalingState != 'stable':
+            # aiortc associerait le nouveau transceiver (sans mid) à une ligne m
+            # de la description en cours d'échange : ajout reporté à la prochaine offre
+            self.deferred[key] = publication
+            return True
+        self._add_subscription(key, publication)
+        return True
+
+    def apply_deferred(self):
+        deferred, self.deferred = self.deferred, {}
+        for key, publication in deferred.items():
+            if publication.owner.room is self.room and publication.owner in self.room.participants.values():
+                self._add_subscription(key, publication)
+
+    def _add_subscription(self, key, publication):
+        track = ForwardedTrack(publication.owner, publication.kind, self.room.stats,
+                               on_switch=self._layer_switched)
+        transceiver = self.pc.addTransceiver(track, direction='sendonly')
+        transceiver.setCodecPreferences(codec_preferences(publication.kind, publication.codec))
+        # Identifier l'émetteur dans le msid du SDP
+        transceiver.sender._stream_id = f'user-{publication.owner.user_id}'
+        # Les PLI du récepteur sont relayés à l'émetteur (pas d'encodeur local)
+        transceiver.sender._send_keyframe = track.request_keyframe
+        self.subscriptions[key] = (transceiver, track)
+        track.select(self.room.choose_layer(self, publication.owner, key))
+
+    def unsubscribe(self, publication):
+        if self.deferred.pop(publication.source_key, None) is not None:
+            return False
+        entry = self.subscriptions.pop(publication.source_key, None)
+        if entry is None:
+            return False
+        transceiver, track = entry
+        track.end()
+        transceiver.direction = 'inactive'
+        return True
+
+    def _layer_switched(self, track):
+        self.room.layer_switched(self, track)
+
+    def track_map(self):
+        return [
+            {'mid': transceiver.mid, 'userId': track.owner.user_id, 'kind': track.kind}
+            for transceiver, track in self.subscriptions.values()
+            if transceiver.mid is not None and transceiver.direction != 'inactive'
+        ]
+
+    async def close(self):
+        for publication in self.publications:
+            publication.close()
+        for _, track in self.subscriptions.values():
+            track.end()
+        await self.pc.close()
+
+
+class SfuRoom:
+    """
+    Salle SFU d'un appel. send(user_id, message) est une coroutine qui remet un
+    message de signalisation au participant (via le channel layer en production).
+    """
+
+    supports_recording = True
+
+    def __init__(self, call_id, send):
+        self.call_id = call_id
+        self.send = send
+        self.participants = {}
+        # Pairs hébergés dans ce processus (enregistreur...) : user_id -> objet
+        # exposant les coroutines on_signaling(message) et on_leave()
+        self.local_peers = {}
+        self.stats = ForwardingStats()
+        # Indications d'affichage : user_id -> {id de l'émetteur (str): {'width', 'height', 'visible', 'pinned'}}
+        self.viewports = {}
+        self.speakers = SpeakerDetector(on_change=self.speaker_changed)
+
+    def _message(self, message_type, user_id, **payload):
+        return {
+            'type': message_type,
+            'sender': SFU_PEER,
+            'receiver': user_id,
+            'callId': self.call_id,
+            **payload,
+        }
+
+    async def deliver(self, user_id, message):
+        local_peer = self.local_peers.get(user_id)
+        if local_peer is not None:
+            await local_peer.on_signaling(message)
+        else:
+            await self.send(user_id, message)
+
+    async def handle_offer(self, user_id, sdp, layers=None):
+        participant = self.participants.get(user_id)
+        if participant is None:
+            participant = self.participants[user_id] = SfuParticipant(self, user_id)
+            logger.info('sfu.participant.joined', call_id=self.call_id, user_id=user_id,
+                        participants=len(self.participants))
+
+        async with participant.lock:
+            known = len(participant.publications)
+            participant.layer_hints = layers if isinstance(layers, dict) else {}
+            await participant.pc.setRemoteDescription(parse_description(sdp, 'offer'))
+            answer = await participant.pc.createAnswer()
+            await participant.pc.setLocalDescription(answer)
+            participant.watch_transport()
+            local = participant.pc.localDescription
+            await self.deliver(user_id, self._message(
+                'answer', user_id, sdp={'type': local.type, 'sdp': local.sdp}))
+            new_publications = participant.publications[known:]
+
+        # Abonner le nouveau venu aux flux existants et les autres à ses flux
+        changed = set()
+        for other in self.participants.values():
+            if other is participant:
+                continue
+            for publication in other.publications:
+                if participant.subscribe(publication):
+                    changed.add(participant)
+            for publication in new_publications:
+                if other.subscribe(publication):
+                    changed.add(other)
+        for publication in new_publications:
+            publication.request_keyframe()
+        # De nouvelles couches peuvent compléter une source déjà retransmise
+        self.update_layers()
+        for target in changed:
+            await self.renegotiate(target)
+
+    def choose_layer(self, receiver, owner, key):
+        """
+        Couche d'une source à retransmettre à un récepteur (None : pause).
+        Seul l'orateur actif (ou une vue épinglée) est servi au-delà de la
+        couche basse, dans la limite de la taille d'affichage indiquée.
+        """
+        layers = [p for p in owner.publications if p.source_key == key and p.codec is not None]
+        if not layers:
+            return None
+        if layers[0].kind != 'video':
+            return layers[0]
+        view = self.viewports.get(receiver.user_id, {}).get(str(owner.user_id))
+        if view is not None and (not view.get('visible', True) or view.get('height') == 0):
+            return None
+        if layers[0].layer is None:
+            return layers[0]
+
+        target = LAYERS.index(layer_for_height(view['height'])) if view and view.get('height') else len(LAYERS) - 1
+        if owner.user_id != self.speakers.dominant and not (view and view.get('pinned')):
+            target = 0
+        by_rank = sorted(layers, key=lambda p: LAYERS.index(p.layer))
+        fitting = [p for p in by_rank if LAYERS.index(p.layer) <= target]
+        return fitting[-1] if fitting else by_rank[0]
+
+    def update_layers(self, participants=None):
+        for participant in participants or list(self.participants.values()):
+            for key, (_, track) in list(participant.subscriptions.items()):
+                track.select(self.choose_layer(participant, track.owner, key))
+
+    def layer_switched(self, participant, track):
+        """Informe le récepteur du changement effectif de couche (ou de la pause) d'une vidéo"""
+        if track.kind != 'video':
+            return
+        message = self._message(
+            'layer-switched', participant.user_id,
+            userId=track.owner.user_id, layer=track.layer, paused=track.publication is None)
+        asyncio.ensure_future(self.deliver(participant.user_id, message))
+
+    def speaker_changed(self, user_id):
+        self.update_layers()
+        asyncio.ensure_future(self.send(None, self._message('active-speaker', None, userId=user_id)))
+
+    def handle_viewport(self, user_id, views):
+        if not isinstance(views, dict):
+            return
+        self.viewports[user_id] = {str(owner): view for owner, view in views.items() if isinstance(view, dict)}
+        participant = self.participants.get(user_id)
+        if participant is not None:
+            self.update_layers([participant])
+
+    async def renegotiate(self, participant):
+        """
+        Offre émise par le serveur ; différée si une négociation est déjà en cours
+        ou si la connexion n'est pas encore établie (aiortc ne démarre les
+        nouveaux émetteurs que sur un transport DTLS connecté)
+        """
+        async with participant.lock:
+            if participant.pc.signalingState != 'stable' or not participant.connected:
+                participant.renegotiation_pending = True
+                return
+            participant.renegotiation_pending = False
+            participant.apply_deferred()
+            offer = await participant.pc.createOffer()
+            await participant.pc.setLocalDescription(offer)
+            local = participant.pc.localDescription
+            message = self._message(
+                'offer', participant.user_id,
+                sdp={'type': local.type, 'sdp': local.sdp},
+                tracks=participant.track_map(),
+            )
+        await self.deliver(participant.user_id, message)
+
+    async def handle_answer(self, user_id, sdp):
+        participant = self.participants.get(user_id)
+        if participant is None:
+            return
+        async with participant.lock:
+            if participant.pc.signalingState != 'have-local-offer':
+                return
+            await participant.pc.setRemoteDescription(parse_description(sdp, 'answer'))
+        for _, track in participant.subscriptions.values():
+            track.request_keyframe()
+        if participant.renegotiation_pending:
+            await self.renegotiate(participant)
+
+    async def handle_candidate(self, user_id, candidate):
+        participant = self.participants.get(user_id)
+        ice_candidate = parse_candidate(candidate)
+        if participant is None or ice_candidate is None:
+            return
+        await participant.pc.addIceCandidate(ice_candidate)
+
+    async def handle_message(self, user_id, data):
+        """Point d'entrée depuis SignalingConsumer pour les messages adressés au serveur média"""
+        message_type = data.get('type')
+        if message_type == 'offer':
+            await self.handle_offer(user_id, data.get('sdp'), data.get('simulcast'))
+        elif message_type == 'answer':
+            await self.handle_answer(user_id, data.get('sdp'))
+        elif message_type == 'ice-candidate':
+            await self.handle_candidate(user_id, data.get('candidate'))
+        elif message_type == 'viewport':
+            self.handle_viewport(user_id, data.get('views'))
+
+    async def leave(self, user_id):
+        participant = self.participants.pop(user_id, None)
+        if participant is None:
+            return
+        changed = []
+        for other in self.participants.values():
+            removed = [other.unsubscribe(publication) for publication in participant.publications]
+            if any(removed):
+                changed.append(other)
+        await participant.close()
+        logger.info('sfu.participant.left', call_id=self.call_id, user_id=user_id,
+                    participants=len(self.participants))
+        self.viewports.pop(user_id, None)
+        self.speakers.forget(user_id)
+        local_peer = self.local_peers.pop(user_id, None)
+        if local_peer is not None:
+            await local_peer.on_leave()
+        if self.participants and all(uid in self.local_peers for uid in self.participants):
+            # Plus aucun participant réel : les pairs locaux quittent la salle
+            for uid in list(self.participants):
+                await self.leave(uid)
+            return
+        for other in changed:
+            await self.renegotiate(other)
+        if not self.participants:
+            forget_room(self.call_id)
+
+    async def close(self):
+        for user_id in list(self.participants):
+            await self.leave(user_id)
+        forget_room(self.call_id)
+
+
+_rooms = {}
+
+
+def get_room(call_id, send, room_class=None):
+    """Salle de l'appel, créée au premier message (SfuRoom, ou McuRoom pour le mixage audio)"""
+    room = _rooms.get(call_id)
+    if room is None:
+        room = _rooms[call_id] = (room_class or SfuRoom)(call_id, send)
+    return room
+
+
+def find_room(call_id):
+    return _rooms.get(call_id)
+
+
+def forget_room(call_id):
+    _rooms.pop(call_id, None)
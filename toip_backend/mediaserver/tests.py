@@ -0,0 +1,458 @@
+import asyncio
+import fractions
+import os
+import queue
+import shutil
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+import av
+import numpy as np
+from aiortc import RTCPeerConnection, RTCRtpCodecParameters
+from aiortc.codecs import get_encoder
+from aiortc.codecs.opus import OpusDecoder, OpusEncoder
+from aiortc.jitterbuffer import JitterFrame
+from aiortc.rtcrtpparameters import RTCRtpReceiveParameters
+from aiortc.rtcrtpreceiver import RemoteStreamTrack
+from aiortc.rtp import RTCP_PSFB_PLI, RtcpPsfbPacket, RtpPacket
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from calls.models import Call
+from users.models import User
+from . import mcu, recording, segments, sfu
+
+OPUS = RTCRtpCodecParameters(mimeType='audio/opus', clockRate=48000, channels=2, payloadType=111)
+VP8 = RTCRtpCodecParameters(mimeType='video/VP8', clockRate=90000, payloadType=96)
+
+
+def tone(amplitude=8000):
+    """Trame stéréo entrelacée de 20 ms (440 Hz)"""
+    t = np.arange(mcu.FRAME_SAMPLES) / mcu.SAMPLE_RATE
+    mono = (amplitude * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+    return np.repeat(mono, mcu.CHANNELS)
+
+
+class OpusDecodeTests(SimpleTestCase):
+    """Décodage dans une ligne du tableau de mixage : jamais de trame précédente remixée"""
+
+    def setUp(self):
+        encoder = OpusEncoder()
+        self.packets = [bytes(mcu.opus_encode(encoder, tone())) for _ in range(5)]
+        self.decoder = OpusDecoder()
+        self.row = np.zeros(mcu.FRAME_VALUES, dtype=np.int16)
+
+    def test_decodes_full_frame(self):
+        for packet in self.packets:
+            self.assertEqual(mcu.opus_decode(self.decoder, packet, self.row), mcu.FRAME_SAMPLES)
+        self.assertGreater(np.abs(self.row).max(), 1000)
+
+    def test_corrupt_packet_clears_row(self):
+        mcu.opus_decode(self.decoder, self.packets[0], self.row)
+        self.assertEqual(mcu.opus_decode(self.decoder, b'\xff\xff\xff', self.row), 0)
+        self.assertFalse(self.row.any())
+
+    def test_missing_packet_concealed(self):
+        for packet in self.packets:
+            mcu.opus_decode(self.decoder, packet, self.row)
+        self.assertEqual(mcu.opus_decode(self.decoder, None, self.row), mcu.FRAME_SAMPLES)
+
+    def test_mixer_silences_member_after_plc_frames(self):
+        mixer = mcu.AudioMixer()
+        for packet in self.packets:
+            mixer.tick({'alice': packet})
+        self.assertTrue(mixer.frames[0].any())
+        for _ in range(mcu.PLC_FRAMES + 1):
+            mixer.tick({'alice': None})
+        self.assertFalse(mixer.frames[0].any())
+        self.assertEqual(mixer.missing, [mcu.PLC_FRAMES + 1])
+
+
+class SfuAiortcSmokeTests(SimpleTestCase):
+    """
+    Attributs privés d'aiortc utilisés par le SFU (file du décodeur, réception
+    RTP, PLI, émetteur) : une mise à jour d'aiortc qui les renomme doit échouer ici
+    """
+
+    def receiving(self, pc, kind, codec):
+        transceiver = pc.addTransceiver(kind, direction='recvonly')
+        transceiver._codecs = [codec]
+        transceiver.receiver._track = RemoteStreamTrack(kind=kind)
+        return transceiver
+
+    async def test_encoded_frames_bypass_decoder(self):
+        pc = RTCPeerConnection()
+        transceiver = self.receiving(pc, 'audio', OPUS)
+        receiver = transceiver.receiver
+        self.assertIsInstance(receiver._RTCRtpReceiver__decoder_queue, queue.Queue)
+
+        room = SimpleNamespace(speakers=sfu.SpeakerDetector())
+        publication = sfu.Publication(SimpleNamespace(user_id=1, room=room), transceiver)
+        self.assertIs(receiver._RTCRtpReceiver__decoder_queue, publication.tap)
+        track = sfu.ForwardedTrack(publication.owner, 'audio', sfu.ForwardingStats())
+        track.select(publication)
+
+        await receiver.receive(RTCRtpReceiveParameters(codecs=[OPUS]))
+        # Le thread décodeur lit None dans le tap et se termine sans rien décoder
+        decoder_thread = receiver._RTCRtpReceiver__decoder_thread
+        await asyncio.to_thread(decoder_thread.join, 1)
+        self.assertFalse(decoder_thread.is_alive())
+
+        payload = b'\xfc' + bytes(20)
+        for sequence in range(10):
+            packet = RtpPacket(payload_type=111, sequence_number=sequence,
+                               timestamp=960 * sequence, ssrc=1234, payload=payload)
+            packet.extensions.audio_level = (True, 10)
+            await receiver._handle_rtp_packet(packet, sequence * 20)
+        self.assertGreater(room.speakers.loudness[1], 0)
+
+        packet = await track.recv()
+        self.assertIsInstance(packet, av.Packet)
+        self.assertEqual(packet.time_base.denominator, OPUS.clockRate)
+        # RTCRtpSender re-paquetise la trame reçue sans l'encoder
+        payloads, timestamp = get_encoder(OPUS).pack(packet)
+        self.assertEqual(payloads, [payload])
+        self.assertEqual(timestamp, packet.pts)
+
+        await receiver.stop()
+        await pc.close()
+
+    async def test_keyframe_request_sends_pli(self):
+        pc = RTCPeerConnection()
+        transceiver = self.receiving(pc, 'video', VP8)
+        receiver = transceiver.receiver
+        receiver._set_rtcp_ssrc(5)
+        publication = sfu.Publication(SimpleNamespace(user_id=1), transceiver)
+        # Source active connue du récepteur (paquet d'un codec non négocié : ignoré ensuite)
+        await receiver._handle_rtp_packet(RtpPacket(payload_type=100, ssrc=4321), 0)
+
+        with mock.patch.object(receiver, '_send_rtcp', new=mock.AsyncMock()) as send_rtcp:
+            publication.request_keyframe()
+            await asyncio.sleep(0)
+        rtcp = send_rtcp.await_args.args[0]
+        self.assertIsInstance(rtcp, RtcpPsfbPacket)
+        self.assertEqual((rtcp.fmt, rtcp.media_ssrc), (RTCP_PSFB_PLI, 4321))
+        await pc.close()
+
+    async def test_subscription_relays_sender_pli(self):
+        room = sfu.SfuRoom(1, mock.AsyncMock())
+        publisher = room.participants[1] = sfu.SfuParticipant(room, 1)
+        subscriber = room.participants[2] = sfu.SfuParticipant(room, 2)
+        publication = sfu.Publication(publisher, self.receiving(publisher.pc, 'video', VP8))
+        publisher.publications.append(publication)
+
+        with mock.patch.object(publication, 'request_keyframe') as request_keyframe:
+            self.assertTrue(subscriber.subscribe(publication))
+            transceiver, track = subscriber.subscriptions[publication.source_key]
+            self.assertIs(track.pending, publication)
+            offer = await subscriber.pc.createOffer()
+            request_keyframe.reset_mock()
+            await transceiver.sender._handle_rtcp_packet(
+                RtcpPsfbPacket(fmt=RTCP_PSFB_PLI, ssrc=1, media_ssrc=transceiver.sender._ssrc))
+        request_keyframe.assert_called_once_with()
+        self.assertIn('a=msid:user-1 ', offer.sdp)
+        self.assertIn('VP8/90000', offer.sdp)
+        await room.close()
+
+
+class FakePublication:
+    """Couche publiée par un participant, sans connexion aiortc"""
+
+    def __init__(self, owner, kind='video', layer=None):
+        self.owner = owner
+        self.kind = kind
+        self.layer = layer
+        self.codec = VP8 if kind == 'video' else OPUS
+        self.tap = sfu.EncodedFrameTap(kind)
+        self.keyframe_requests = 0
+        owner.publications.append(self)
+
+    source_key = sfu.Publication.source_key
+
+    def request_keyframe(self):
+        self.keyframe_requests += 1
+
+
+def participant(user_id):
+    return SimpleNamespace(user_id=user_id, publications=[], subscriptions={})
+
+
+KEYFRAME = b'\x10' + bytes(99)
+DELTA = b'\x11' + bytes(99)
+
+
+class SimulcastTests(SimpleTestCase):
+    """Choix de couche par récepteur, bascule sur image clé et débit retransmis"""
+
+    def setUp(self):
+        self.sent = []
+
+        async def send(user_id, message):
+            self.sent.append(message)
+
+        self.room = sfu.SfuRoom(1, send)
+        self.sender = self.room.participants[1] = participant(1)
+        self.viewer = self.room.participants[2] = participant(2)
+        self.layers = {layer: FakePublication(self.sender, layer=layer) for layer in sfu.LAYERS}
+        self.key = self.layers['low'].source_key
+
+    def tearDown(self):
+        sfu.forget_room(1)
+
+    def test_layer_from_viewport_and_speaker(self):
+        choose = lambda: self.room.choose_layer(self.viewer, self.sender, self.key).layer
+        self.assertEqual(choose(), 'low')
+        self.room.speakers.dominant = 1
+        self.assertEqual(choose(), 'high')
+        self.room.handle_viewport(2, {'1': {'height': 300, 'visible': True}})
+        self.assertEqual(choose(), 'medium')
+        self.room.handle_viewport(2, {'1': {'height': 0}})
+        self.assertIsNone(self.room.choose_layer(self.viewer, self.sender, self.key))
+        self.room.speakers.dominant = None
+        self.room.handle_viewport(2, {'1': {'height': 720, 'pinned': True}})
+        self.assertEqual(choose(), 'high')
+
+    def forwarded(self):
+        track = sfu.ForwardedTrack(self.sender, 'video', self.room.stats,
+                                   on_switch=lambda t: self.room.layer_switched(self.viewer, t))
+        self.viewer.subscriptions[self.key] = (None, track)
+        self.room.update_layers()
+        return track
+
+    async def test_switch_waits_for_keyframe_and_signals(self):
+        track = self.forwarded()
+        low, high = self.layers['low'], self.layers['high']
+        self.assertIs(track.pending, low)
+        low.tap.put((VP8, JitterFrame(KEYFRAME, 1000)))
+        self.assertIs(track.publication, low)
+
+        self.room.speakers.dominant = 1
+        self.room.update_layers()
+        self.assertIs(track.pending, high)
+        self.assertEqual(high.keyframe_requests, 1)
+        # Tant que la couche haute n'a pas envoyé d'image clé, la basse est retransmise
+        high.tap.put((VP8, JitterFrame(DELTA, 50000)))
+        low.tap.put((VP8, JitterFrame(DELTA, 4000)))
+        self.assertEqual(track.layer, 'low')
+        high.tap.put((VP8, JitterFrame(KEYFRAME, 53000)))
+        self.assertEqual(track.layer, 'high')
+        self.assertFalse(low.tap.subscribers)
+
+        packets = [await track.recv() for _ in range(3)]
+        self.assertEqual([p.size for p in packets], [100, 100, 100])
+        # Timestamps continus malgré les horloges différentes des couches
+        self.assertLess(packets[1].pts, packets[2].pts)
+        self.assertLess(packets[2].pts - packets[1].pts, 90000)
+
+        await asyncio.sleep(0)
+        switches = [m for m in self.sent if m['type'] == 'layer-switched']
+        self.assertEqual([m['layer'] for m in switches], ['low', 'high'])
+        self.assertEqual(switches[-1], {
+            'type': 'layer-switched', 'sender': sfu.SFU_PEER, 'receiver': 2, 'callId': 1,
+            'userId': 1, 'layer': 'high', 'paused': False,
+        })
+
+    @mock.patch.object(sfu, 'SPEAKER_CHECK_INTERVAL', 0)
+    async def test_active_speaker_upgrades_layer(self):
+        track = self.forwarded()
+        for _ in range(100):
+            self.room.speakers.record(1, 20)
+        self.assertIs(track.pending, self.layers['high'])
+        await asyncio.sleep(0)
+        self.assertIn({'type': 'active-speaker', 'sender': sfu.SFU_PEER, 'receiver': None,
+                       'callId': 1, 'userId': 1}, self.sent)
+
+    async def test_hidden_view_pauses_source(self):
+        track = self.forwarded()
+        self.layers['low'].tap.put((VP8, JitterFrame(KEYFRAME, 0)))
+        await self.room.handle_message(2, {'type': 'viewport', 'views': {'1': {'visible': False}}})
+        self.assertIsNone(track.publication)
+        self.assertFalse(any(tap.subscribers for tap in (p.tap for p in self.layers.values())))
+        await asyncio.sleep(0)
+        self.assertTrue(self.sent[-1]['paused'])
+
+    async def test_forwarded_bitrate(self):
+        track = self.forwarded()
+        low = self.layers['low']
+        for index in range(10):
+            low.tap.put((VP8, JitterFrame(KEYFRAME if index == 0 else DELTA, index * 3000)))
+        for _ in range(10):
+            await track.recv()
+        stats = self.room.stats
+        self.assertEqual((stats.frames, stats.bytes), (10, 1000))
+        self.assertEqual(stats.layer_bytes, {'low': 1000})
+        self.assertIsNotNone(stats.percentile(95))
+        with mock.patch.object(sfu.time, 'monotonic', return_value=stats.started + 2):
+            self.assertEqual(stats.bitrate(), 4000)
+        stats.reset()
+        self.assertEqual((stats.bytes, stats.layer_bytes), (0, {}))
+
+
+@mock.patch.object(sfu, 'SPEAKER_CHECK_INTERVAL', 0)
+class SpeakerDetectorTests(SimpleTestCase):
+
+    def setUp(self):
+        self.changes = []
+        self.detector = sfu.SpeakerDetector(on_change=self.changes.append)
+
+    def speak(self, levels, rounds=100):
+        for _ in range(rounds):
+            for user_id, level in levels.items():
+                self.detector.record(user_id, level)
+
+    def test_loudest_participant_becomes_dominant(self):
+        self.speak({1: 20, 2: 127})
+        self.assertEqual(self.detector.dominant, 1)
+        self.assertEqual(self.changes, [1])
+
+    def test_silence_never_dominant(self):
+        self.speak({1: 100, 2: 127})
+        self.assertIsNone(self.detector.dominant)
+
+    def test_hysteresis(self):
+        self.speak({1: 30, 2: 127})
+        # Légèrement plus fort : l'orateur actuel est conservé
+        self.speak({1: 30, 2: 28})
+        self.assertEqual(self.detector.dominant, 1)
+        self.speak({1: 60, 2: 10})
+        self.assertEqual(self.changes, [1, 2])
+
+    def test_forget_leaver(self):
+        self.speak({1: 20})
+        self.detector.forget(1)
+        self.assertIsNone(self.detector.dominant)
+        self.assertNotIn(1, self.detector.loudness)
+
+
+def vp8_frames(count, width=160, height=120):
+    """Trames VP8 encodées (la première est une image clé), une image unie différente par trame"""
+    encoder = av.CodecContext.create('libvpx', 'w')
+    encoder.width, encoder.height, encoder.pix_fmt = width, height, 'yuv420p'
+    encoder.time_base = fractions.Fraction(1, segments.OUTPUT_FPS)
+    encoder.bit_rate = 200000
+    encoder.options = {'deadline': 'realtime', 'lag-in-frames': '0'}
+    packets = []
+    for index in range(count):
+        image = np.full((height, width, 3), index * 8 % 256, dtype=np.uint8)
+        frame = av.VideoFrame.from_ndarray(image, format='rgb24').reformat(format='yuv420p')
+        frame.pts = index
+        packets += [bytes(packet) for packet in encoder.encode(frame)]
+    return packets + [bytes(packet) for packet in encoder.encode(None)]
+
+
+def opus_frames(count):
+    encoder = OpusEncoder()
+    return [bytes(mcu.opus_encode(encoder, tone())) for _ in range(count)]
+
+
+class RecordingPipelineTests(SimpleTestCase):
+    """Segments encodés puis concaténés dans le pool de processus de l'enregistreur"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        if recording._pool is not None:
+            recording._pool.shutdown()
+            recording._pool = None
+        super().tearDownClass()
+
+    def job(self, index, start, video=True):
+        """Segment d'une seconde : 50 trames Opus de 20 ms et, en vidéo, OUTPUT_FPS trames VP8"""
+        tracks = [{'kind': 'audio', 'codec': 'audio/opus',
+                   'frames': [(start + position * 0.02, packet) for position, packet in enumerate(opus_frames(50))]}]
+        if video:
+            tracks.append({'kind': 'video', 'codec': 'video/VP8',
+                           'frames': [(start + position / segments.OUTPUT_FPS, frame)
+                                      for position, frame in enumerate(vp8_frames(segments.OUTPUT_FPS))]})
+        return {'path': os.path.join(self.directory, 'segments', f'segment_{index:05d}.webm'),
+                'start': start, 'duration': 1.0, 'video': video, 'tracks': tracks}
+
+    async def test_segments_concatenated_to_playable_webm(self):
+        loop = asyncio.get_running_loop()
+        pool = recording.get_pool()
+        paths = await asyncio.gather(*(
+            loop.run_in_executor(pool, segments.encode_segment, self.job(index, float(index)))
+            for index in range(2)))
+        output = os.path.join(self.directory, 'recording.webm')
+        self.assertEqual(await loop.run_in_executor(pool, segments.concat_segments, paths, output), output)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+        with av.open(output) as container:
+            self.assertEqual([(stream.type, stream.codec_context.name) for stream in container.streams],
+                             [('video', 'vp8'), ('audio', 'opus')])
+            self.assertAlmostEqual(container.duration / av.time_base, 2.0, delta=0.1)
+            video = list(container.decode(video=0))
+        self.assertEqual(len(video), 2 * segments.OUTPUT_FPS)
+        self.assertEqual((video[0].width, video[0].height), (segments.OUTPUT_WIDTH, segments.OUTPUT_HEIGHT))
+        # Vignette unique : l'image décodée occupe tout le cadre
+        self.assertGreater(video[-1].to_ndarray(format='rgb24').mean(), 50)
+        with av.open(output) as container:
+            audio = np.concatenate([frame.to_ndarray() for frame in container.decode(audio=0)], axis=1)
+        self.assertGreater(np.abs(audio).max(), 0.1)
+
+    async def test_audio_only_segment(self):
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(recording.get_pool(), segments.encode_segment, self.job(0, 0.0, video=False))
+        with av.open(path) as container:
+            self.assertEqual([stream.type for stream in container.streams], ['audio'])
+
+
+# Les connexions de la base de test ne doivent pas être fermées par database_sync_to_async
+@mock.patch('channels.db.close_old_connections')
+class CallRecorderTests(TestCase):
+    """L'enregistreur d'une salle SFU réelle finalise l'enregistrement quand le dernier participant part"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.initiator = User.objects.create_user(username='recording_initiator')
+        cls.call = Call.objects.create(initiator=cls.initiator, call_type='video', status='in_progress')
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.media_root = media_root
+
+    @classmethod
+    def tearDownClass(cls):
+        if recording._pool is not None:
+            recording._pool.shutdown()
+            recording._pool = None
+        super().tearDownClass()
+
+    async def join(self, room, user_id):
+        pc = RTCPeerConnection()
+        pc.createDataChannel('client')
+        await pc.setLocalDescription(await pc.createOffer())
+        await room.handle_offer(user_id, {'type': 'offer', 'sdp': pc.localDescription.sdp})
+        return pc
+
+    async def test_finish_saves_recording_path(self, _):
+        room = sfu.SfuRoom(self.call.id, mock.AsyncMock())
+        client = await self.join(room, self.initiator.id)
+        recorder = await recording.start_recording(room)
+        self.assertIs(recording.find_recorder(self.call.id), recorder)
+        self.assertIn(recording.RECORDER_PEER, room.participants)
+        # Une seconde d'appel à finaliser (segment noir et silencieux)
+        recorder._origin -= 1.0
+
+        with mock.patch.object(recording, 'save_recording_path', wraps=recording.save_recording_path) as save:
+            await room.leave(self.initiator.id)
+            self.assertFalse(room.participants)
+            name = await recorder.finished
+        await client.close()
+
+        path = f'recordings/call_{self.call.id}/recording.webm'
+        self.assertEqual(name, path)
+        save.assert_called_once_with(self.call.id, path)
+        await self.call.arefresh_from_db()
+        self.assertEqual(self.call.recording_path, path)
+        self.assertIsNone(recording.find_recorder(self.call.id))
+        with av.open(os.path.join(self.media_root, path)) as container:
+            self.assertEqual([stream.type for stream in container.streams], ['video', 'audio'])
+            self.assertAlmostEqual(container.duration / av.time_base, 1.0, delta=0.2)
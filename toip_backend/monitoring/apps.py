@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+class MonitoringConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'monitoring'
+
+    def ready(self):
+        from .middleware import install_timer_wrapper
+        from .profiling import install_query_wrapper
+        connection_created.connect(install_timer_wrapper, dispatch_uid='monitoring.middleware')
+        connection_created.connect(install_query_wrapper, dispatch_uid='monitoring.profiling')
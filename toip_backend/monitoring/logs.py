@@ -0,0 +1,147 @@
+"""
+Journalisation structurée, échantillonnée et non bloquante
+
+Un événement est un nom stable et des champs, formatés seulement si un
+gestionnaire l'écrit, et hors de la boucle asyncio :
+
+    log = get_logger('signaling')
+    log.info('ws.message.received', call_id=call_id, type=message_type)
+
+- Le niveau du logger est testé avant tout travail : un événement filtré ne
+  coûte qu'un appel de fonction (pas de f-string évaluée).
+- LOG_SAMPLING ({nom d'événement: taux}) n'écrit qu'une part des événements
+  fréquents ; les événements retenus portent sample_rate pour remettre les
+  comptes à l'échelle. Les avertissements et erreurs ne doivent pas y figurer.
+- QueuedHandler place les enregistrements dans une file bornée vidée par un
+  thread qui formate et écrit (fichier, console) : l'appelant n'attend jamais
+  le disque. File pleine : l'enregistrement est abandonné et compté.
+
+Les champs sont formatés après coup par le thread d'écriture : n'y passer que
+des valeurs qui ne changent plus (identifiants, chaînes, nombres).
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import Counter
+
+SAMPLING = getattr(settings, 'LOG_SAMPLING', {})
+
+DROPPED_RECORDS = Counter('toip_log_records_dropped_total',
+                          "Enregistrements de journal abandonnés faute de place dans la file d'écriture")
+
+
+def _format_field(value):
+    text = str(value)
+    if not text or any(char in text for char in ' ="\n'):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+class Event:
+    """Message d'un enregistrement : formaté en « nom clé=valeur … » seulement à l'écriture"""
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.name] + [f'{key}={_format_field(value)}' for key, value in self.fields.items()])
+
+
+class EventLogger:
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def _log(self, level, event, fields, exc_info=None):
+        if not self.logger.isEnabledFor(level):
+            return
+        rate = SAMPLING.get(event)
+        if rate is not None and rate < 1:
+            if random.random() >= rate:
+                return
+            fields['sample_rate'] = rate
+        # stacklevel : module et ligne de l'appelant, pas de cette classe
+        self.logger.log(level, Event(event, fields), exc_info=exc_info, stacklevel=3)
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+def get_logger(name):
+    return EventLogger(name)
+
+
+class JsonFormatter(logging.Formatter):
+    """Une ligne JSON par enregistrement : horodatage, niveau, logger, événement et champs"""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name}
+        if isinstance(record.msg, Event):
+            entry['event'] = record.msg.name
+            entry.update(record.msg.fields)
+        else:
+            entry['message'] = record.getMessage()
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """
+    Gestionnaire de LOGGING qui délègue à un gestionnaire cible via une file bornée :
+
+        'file': {
+            '()': 'monitoring.logs.QueuedHandler',
+            'target': {'class': 'logging.FileHandler', 'filename': ...},
+            'formatter': 'json',
+        }
+
+    Le formateur est appliqué par la cible, dans le thread d'écriture.
+    """
+
+    def __init__(self, target, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        options = dict(target)
+        self.target = import_string(options.pop('class'))(**options)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Pas de formatage ici (QueueHandler formate dans le thread appelant)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+    def close(self):
+        # Appelé par logging.shutdown() : la file est vidée avant l'arrêt
+        if self.listener._thread is not None:
+            self.listener.stop()
+        self.target.close()
+        super().close()
@@ -0,0 +1,229 @@
+"""
+Métriques du processus au format texte de Prometheus
+
+Compteurs, jauges et histogrammes tenus en mémoire : chaque worker (daphne,
+runserver) expose les siens sur /metrics/ et Prometheus agrège les cibles.
+Une mise à jour coûte un verrou et une addition ; les séries étiquetées sont
+créées à leur première utilisation. Les valeurs d'étiquettes doivent rester
+en nombre borné (types de message connus, noms de vues), jamais des
+identifiants d'appel ou d'utilisateur.
+
+Déclaration au niveau du module qui mesure :
+    RELAYED = Counter('toip_signaling_messages_total', "Messages relayés", ['type'])
+    RELAYED.labels('offer').inc()
+"""
+import bisect
+import math
+import threading
+import time
+
+from asgiref.sync import SyncToAsync
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bornes (secondes) des histogrammes de latence : de 0,5 ms à 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = {}
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class _Value:
+    """Série d'un compteur ou d'une jauge"""
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class _Timer:
+    def __init__(self, series):
+        self.series = series
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.series.observe(time.perf_counter() - self.started)
+
+
+class _Buckets:
+    """Série d'un histogramme : effectifs par intervalle (cumulés au rendu), somme et nombre"""
+
+    def __init__(self, lock, bounds):
+        self._lock = lock
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        if name in REGISTRY:
+            raise ValueError(f"métrique déjà déclarée : {name}")
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+        REGISTRY[name] = self
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        series = self._series.get(key)
+        if series is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} attend les étiquettes {self.labelnames}")
+            with self._lock:
+                series = self._series.setdefault(key, self._new_series())
+        return series
+
+    def _new_series(self):
+        return _Value(self._lock)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, series.value) for key, series in self._series.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.kind}']
+        for name, key, value in self._samples():
+            lines.append(f'{name}{_format_labels(self._sample_labelnames(name), key)} {_format_value(value)}')
+        return lines
+
+    def _sample_labelnames(self, name):
+        return self.labelnames
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class CallbackGauge(Metric):
+    """Jauge lue au moment de l'export : collect() retourne {valeurs d'étiquettes: valeur}"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, collect):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def _samples(self):
+        return [(self.name, tuple(str(value) for value in key), value) for key, value in self.collect().items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_series(self):
+        return _Buckets(self._lock, self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            series = [(key, list(buckets.counts), buckets.sum) for key, buckets in self._series.items()]
+        for key, counts, total in series:
+            cumulated = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulated += count
+                samples.append((f'{self.name}_bucket', key + (_format_value(bound),), cumulated))
+            samples.append((f'{self.name}_sum', key, total))
+            samples.append((f'{self.name}_count', key, cumulated))
+        return samples
+
+    def _sample_labelnames(self, name):
+        if name.endswith('_bucket'):
+            return self.labelnames + ('le',)
+        return self.labelnames
+
+
+def render():
+    """Toutes les métriques déclarées, au format texte de Prometheus"""
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _sync_to_async_queue_depth():
+    # Appels en attente d'un thread : l'exécuteur partagé sert les consommateurs WebSocket
+    # (database_sync_to_async), un exécuteur par requête sert les vues HTTP sous ASGI
+    per_request = sum(executor._work_queue.qsize()
+                      for executor in list(SyncToAsync.context_to_thread_executor.values()))
+    return {
+        ('shared',): SyncToAsync.single_thread_executor._work_queue.qsize(),
+        ('per_request',): per_request,
+    }
+
+
+SYNC_TO_ASYNC_QUEUE = CallbackGauge(
+    'toip_sync_to_async_queue_depth',
+    "Appels sync_to_async / database_sync_to_async en attente d'un thread",
+    ['executor'], _sync_to_async_queue_depth,
+)
@@ -0,0 +1,90 @@
+import contextvars
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .metrics import Histogram
+
+# Bornes des histogrammes de requêtes SQL par requête HTTP
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+
+VIEW_DB_SECONDS = Histogram('toip_view_db_seconds', "Temps passé en base de données par requête HTTP", ['view'])
+VIEW_DB_QUERIES = Histogram('toip_view_db_queries', "Requêtes SQL par requête HTTP", ['view'], buckets=QUERY_BUCKETS)
+
+
+_timer = contextvars.ContextVar('monitoring_query_timer', default=None)
+
+
+class QueryTimer:
+    """Cumule le nombre et la durée des requêtes SQL d'une requête HTTP"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+
+
+def timer_wrapper(execute, sql, params, many, context):
+    timer = _timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    return timer(execute, sql, params, many, context)
+
+
+def install_timer_wrapper(sender, connection, **kwargs):
+    """
+    Récepteur de connection_created. Le minuteur est lu dans le contexte : les
+    requêtes d'une vue asynchrone, exécutées par sync_to_async dans un autre
+    thread (donc sur une autre connexion), sont aussi comptées.
+    """
+    if timer_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, timer_wrapper)
+
+
+class ViewMetricsMiddleware:
+    """
+    Temps passé en base et nombre de requêtes SQL de chaque requête HTTP,
+    étiquetés par le nom de la vue résolue (par exemple call-history)
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = QueryTimer()
+        token = _timer.set(timer)
+        try:
+            response = self.get_response(request)
+        finally:
+            _timer.reset(token)
+        self.observe(request, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = QueryTimer()
+        token = _timer.set(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _timer.reset(token)
+        self.observe(request, timer)
+        return response
+
+    def observe(self, request, timer):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unresolved'
+        VIEW_DB_SECONDS.labels(view).observe(timer.seconds)
+        VIEW_DB_QUERIES.labels(view).observe(timer.count)
@@ -0,0 +1,331 @@
+"""
+Profilage à la demande des requêtes HTTP et des messages WebSocket
+
+Un profil réunit les requêtes SQL (texte, durée, répétitions), le temps passé
+en base et un échantillonnage de la pile du thread qui traite la requête ou
+le message (graphe de flammes). Il est déclenché :
+
+- pour une part des requêtes et des messages (PROFILING_SAMPLE_RATE) ;
+- par l'en-tête X-Profile (paramètre ?profile= d'une WebSocket), retenu si sa
+  valeur est PROFILING_TOKEN ou si l'utilisateur authentifié est membre du
+  personnel (is_staff).
+
+Sans déclenchement, le surcoût se limite à un test dans l'intergiciel et à la
+lecture d'une variable de contexte par requête SQL. Les profils sont gardés
+dans la mémoire du processus (les PROFILING_STORE_SIZE derniers) et consultés
+sur /admin/profiles/ : chaque worker n'y montre que les siens, l'en-tête
+X-Profile-Id de la réponse identifie le profil.
+
+Pour une WebSocket, seuls les échantillons où le message profilé est sur la
+pile sont comptés (la boucle asyncio traite d'autres connexions pendant ses
+attentes) ; le travail en base, exécuté par database_sync_to_async dans un
+autre thread, apparaît dans les requêtes SQL et non dans le graphe.
+"""
+import collections
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import parse_qs
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+SAMPLE_RATE = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+TOKEN = getattr(settings, 'PROFILING_TOKEN', None)
+INTERVAL = getattr(settings, 'PROFILING_INTERVAL', 0.005)
+STORE_SIZE = getattr(settings, 'PROFILING_STORE_SIZE', 100)
+MAX_QUERIES = getattr(settings, 'PROFILING_MAX_QUERIES', 200)
+
+STORE = collections.deque(maxlen=STORE_SIZE)
+
+_current = contextvars.ContextVar('monitoring_profile', default=None)
+_ids = itertools.count(1)
+_labels = {}
+
+
+def _label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f'{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+    return label
+
+
+class Profile:
+
+    def __init__(self, kind, name, path, root):
+        self.id = f'{os.getpid()}-{next(_ids)}'
+        self.kind = kind
+        self.name = name
+        self.path = path
+        # Méthode HTTP, ou type du message WebSocket
+        self.operation = None
+        self.status = None
+        # Cadre du point d'entrée (intergiciel, websocket_receive) : bas des piles échantillonnées
+        self.root = root
+        self.thread_id = threading.get_ident()
+        self.started_at = timezone.now()
+        self.duration = 0.0
+        self.samples = 0
+        self.stacks = collections.Counter()
+        self.query_count = 0
+        self.db_seconds = 0.0
+        self.queries = []
+
+    def sample(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(_label(frame.f_code))
+            if frame is self.root:
+                break
+            frame = frame.f_back
+        else:
+            # Le point d'entrée n'est pas sur la pile : le thread travaille pour une autre tâche
+            return
+        self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def record_query(self, sql, seconds):
+        self.query_count += 1
+        self.db_seconds += seconds
+        if len(self.queries) < MAX_QUERIES:
+            self.queries.append((sql, seconds))
+
+    def repeated_queries(self):
+        """Requêtes de même texte exécutées plusieurs fois (signature d'un N+1), les plus fréquentes d'abord"""
+        counts = collections.Counter(sql for sql, _ in self.queries)
+        return [(sql, count) for sql, count in counts.most_common() if count > 1]
+
+    @property
+    def duration_ms(self):
+        return self.duration * 1000
+
+    @property
+    def db_ms(self):
+        return self.db_seconds * 1000
+
+    def server_timing(self):
+        return f'db;dur={self.db_ms:.1f};desc="{self.query_count} queries", total;dur={self.duration_ms:.1f}'
+
+    def collapsed(self):
+        """Piles au format replié (flamegraph.pl, speedscope) : « a;b;c nombre » par ligne"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class Sampler:
+    """Thread unique qui relève la pile des threads profilés, actif seulement pendant un profil"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = set()
+        self.active = threading.Event()
+        self.thread = None
+
+    def add(self, profile):
+        with self.lock:
+            self.profiles.add(profile)
+            self.active.set()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profiling-sampler', daemon=True)
+                self.thread.start()
+
+    def remove(self, profile):
+        with self.lock:
+            self.profiles.discard(profile)
+
+    def run(self):
+        while True:
+            self.active.wait()
+            time.sleep(INTERVAL)
+            with self.lock:
+                profiles = list(self.profiles)
+                if not profiles:
+                    self.active.clear()
+                    continue
+            frames = sys._current_frames()
+            for profile in profiles:
+                frame = frames.get(profile.thread_id)
+                if frame is not None:
+                    profile.sample(frame)
+
+
+SAMPLER = Sampler()
+
+
+def query_wrapper(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.record_query(sql, time.perf_counter() - started)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """
+    Récepteur de connection_created. En tête de liste : les execute_wrapper()
+    temporaires retirent le dernier élément en sortie de bloc.
+    """
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, query_wrapper)
+
+
+@contextlib.contextmanager
+def active(profile):
+    """Profile le bloc : requêtes SQL du contexte courant (et des threads de sync_to_async), pile du thread"""
+    token = _current.set(profile)
+    SAMPLER.add(profile)
+    started = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile.duration = time.perf_counter() - started
+        SAMPLER.remove(profile)
+        _current.reset(token)
+        # Le cadre retiendrait ses variables locales (requête, réponse) tant que le profil est gardé
+        profile.root = None
+
+
+def sampled():
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+def save(profile):
+    STORE.append(profile)
+
+
+def find(profile_id):
+    for profile in STORE:
+        if profile.id == profile_id:
+            return profile
+    return None
+
+
+def flame_graph(profile, min_width=0.1):
+    """
+    Rectangles du graphe de flammes (racine en haut), en pourcentage de la largeur :
+    [{'name', 'depth', 'left', 'width', 'count'}], rectangles de moins de min_width % omis
+    """
+    root = {'count': 0, 'children': {}}
+    for stack, count in profile.stacks.items():
+        node = root
+        node['count'] += count
+        for name in stack.split(';'):
+            node = node['children'].setdefault(name, {'count': 0, 'children': {}})
+            node['count'] += count
+    if not root['count']:
+        return []
+
+    boxes = []
+    total = root['count']
+    pending = [(root, 0, 0)]
+    while pending:
+        node, depth, offset = pending.pop()
+        for name, child in sorted(node['children'].items()):
+            width = child['count'] * 100 / total
+            if width >= min_width:
+                boxes.append({'name': name, 'depth': depth, 'left': offset * 100 / total, 'width': width,
+                              'count': child['count']})
+                pending.append((child, depth + 1, offset))
+            offset += child['count']
+    return boxes
+
+
+def _authorized(value, user):
+    if TOKEN and value == TOKEN:
+        return True
+    return user is not None and user.is_authenticated and user.is_staff
+
+
+class ProfilingMiddleware:
+    """Profile les requêtes HTTP échantillonnées ou demandées par l'en-tête X-Profile"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        requested = request.META.get('HTTP_X_PROFILE')
+        chosen = sampled()
+        if requested is None and not chosen:
+            return self.get_response(request)
+
+        profile = Profile('http', request.path, request.path, sys._getframe())
+        profile.operation = request.method
+        with active(profile):
+            response = self.get_response(request)
+        # L'utilisateur n'est connu qu'après l'authentification (DRF l'établit dans la vue)
+        if not chosen and not _authorized(requested, getattr(request, 'user', None)):
+            return response
+        return self.keep(request, response, profile)
+
+    async def __acall__(self, request):
+        requested = request.META.get('HTTP_X_PROFILE')
+        chosen = sampled()
+        if requested is None and not chosen:
+            return await self.get_response(request)
+
+        profile = Profile('http', request.path, request.path, sys._getframe())
+        profile.operation = request.method
+        with active(profile):
+            response = await self.get_response(request)
+        # Utilisateur de session chargé à la demande : lecture en base hors de la boucle
+        if not chosen and not await sync_to_async(_authorized)(requested, getattr(request, 'user', None)):
+            return response
+        return self.keep(request, response, profile)
+
+    def keep(self, request, response, profile):
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            profile.name = match.view_name
+        profile.status = response.status_code
+        save(profile)
+        response['X-Profile-Id'] = profile.id
+        response['Server-Timing'] = profile.server_timing()
+        return response
+
+
+class ProfiledConsumerMixin:
+    """
+    Profile les messages reçus par un consommateur WebSocket : échantillonnés, ou
+    tous ceux d'une connexion ouverte avec ?profile= (jeton ou membre du personnel)
+    """
+    profile_requested = None
+
+    async def websocket_receive(self, message):
+        if self.profile_requested is None:
+            value = parse_qs(self.scope.get('query_string', b'').decode()).get('profile', [None])[0]
+            self.profile_requested = value is not None and _authorized(value, self.scope.get('user'))
+        if not self.profile_requested and not sampled():
+            await super().websocket_receive(message)
+            return
+
+        profile = Profile('websocket', f'{type(self).__name__}.receive', self.scope.get('path'), sys._getframe())
+        profile.operation = message_type(message)
+        with active(profile):
+            await super().websocket_receive(message)
+        save(profile)
+
+
+def message_type(message):
+    """Type d'un message JSON ('binary' pour une trame binaire)"""
+    if message.get('text') is None:
+        return 'binary'
+    try:
+        data = json.loads(message['text'])
+    except ValueError:
+        return None
+    return data.get('type') if isinstance(data, dict) else None
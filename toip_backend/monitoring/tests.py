@@ -0,0 +1,239 @@
+import io
+import logging
+import sys
+import time
+from unittest import mock
+
+from asgiref.testing import ApplicationCommunicator
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.authtoken.models import Token
+
+from calls.models import Call
+from signaling.consumers import IncomingCallConsumer, WEBSOCKET_CONNECTIONS
+from signaling.views import CALL_NOTIFICATIONS, notify_incoming_call
+from users.models import User
+from . import logs, metrics, profiling
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+class RenderTests(TestCase):
+
+    def tearDown(self):
+        metrics.REGISTRY.pop('test_latency_seconds', None)
+
+    def test_histogram_exposition(self):
+        histogram = metrics.Histogram('test_latency_seconds', "Latence \"test\"", ['type'], buckets=(0.1, 1.0))
+        histogram.labels('offer').observe(0.05)
+        histogram.labels('offer').observe(0.5)
+        histogram.labels('offer').observe(3)
+
+        lines = histogram.render()
+        self.assertEqual(lines[:2], ['# HELP test_latency_seconds Latence \\"test\\"',
+                                     '# TYPE test_latency_seconds histogram'])
+        self.assertEqual(lines[2:], [
+            'test_latency_seconds_bucket{type="offer",le="0.1"} 1',
+            'test_latency_seconds_bucket{type="offer",le="1.0"} 2',
+            'test_latency_seconds_bucket{type="offer",le="+Inf"} 3',
+            'test_latency_seconds_sum{type="offer"} 3.55',
+            'test_latency_seconds_count{type="offer"} 3',
+        ])
+
+    def test_duplicate_name(self):
+        metrics.Histogram('test_latency_seconds', "Latence")
+        with self.assertRaises(ValueError):
+            metrics.Counter('test_latency_seconds', "Latence")
+
+
+class MetricsEndpointTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='metrics_user', password='metrics-pass-1')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def test_view_database_metrics(self):
+        self.client.get('/api/users/me/', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        response = self.client.get('/metrics/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        body = response.content.decode()
+        self.assertIn('toip_view_db_queries_count{view="user-me"}', body)
+        self.assertIn('toip_view_db_seconds_sum{view="user-me"}', body)
+        self.assertIn('toip_sync_to_async_queue_depth{executor="shared"} 0', body)
+
+    @override_settings(METRICS_TOKEN='jeton-de-test')
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 401)
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer jeton-de-test')
+        self.assertEqual(response.status_code, 200)
+
+    def test_no_token_restricted_to_internal_network(self):
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='203.0.113.7').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='::1').status_code, 200)
+        with override_settings(METRICS_ALLOWED_NETWORKS=['10.0.0.0/8']):
+            self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.1.2.3').status_code, 200)
+            self.assertEqual(self.client.get('/metrics/').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='jeton-de-test')
+    def test_token_required_from_any_address(self):
+        response = self.client.get('/metrics/', REMOTE_ADDR='203.0.113.7', HTTP_AUTHORIZATION='Bearer jeton-de-test')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    def test_notifications(self):
+        call = Call.objects.create(initiator=self.user, call_type='audio')
+        success = CALL_NOTIFICATIONS.labels('success')
+        before = success.value
+        self.assertTrue(notify_incoming_call(call, self.user.id))
+        self.assertEqual(success.value, before + 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ConnectionGaugeTests(TestCase):
+
+    async def test_incoming_call_connections(self):
+        gauge = WEBSOCKET_CONNECTIONS.labels('IncomingCallConsumer')
+        before = gauge.value
+        scope = {'type': 'websocket', 'path': '/ws/incoming-calls/', 'headers': [], 'subprotocols': [],
+                 'user': User(id=1, username='gauge_user')}
+        communicator = ApplicationCommunicator(IncomingCallConsumer.as_asgi(), scope)
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output(1))['type'], 'websocket.accept')
+        self.assertEqual(gauge.value, before + 1)
+
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(1)
+        self.assertEqual(gauge.value, before)
+
+
+class StructuredLoggingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = logs.QueuedHandler({'class': 'logging.StreamHandler', 'stream': self.stream})
+        self.handler.setFormatter(logs.JsonFormatter())
+        self.logger = logging.getLogger('test.structured')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def lines(self):
+        self.handler.listener.stop()
+        self.handler.listener.start()
+        return self.stream.getvalue().splitlines()
+
+    def test_event_format(self):
+        event = logs.Event('ws.message.sent', {'call_id': 7, 'type': 'ice-candidate', 'note': 'deux mots'})
+        self.assertEqual(str(event), 'ws.message.sent call_id=7 type=ice-candidate note="deux mots"')
+
+    def test_lazy_and_queued(self):
+        log = logs.EventLogger('test.structured')
+        self.handler.listener.stop()
+        log.debug('filtered', value=1)
+        log.info('ws.connect.accepted', call_id=3, user_id=4)
+        # L'appelant n'a fait que mettre en file l'enregistrement, sans le formater
+        [record] = list(self.handler.queue.queue)
+        self.assertIsInstance(record.msg, logs.Event)
+        self.assertEqual(self.stream.getvalue(), '')
+
+        self.handler.listener.start()
+        [line] = self.lines()
+        self.assertIn('"event": "ws.connect.accepted", "call_id": 3, "user_id": 4', line)
+
+    def test_sampling(self):
+        log = logs.EventLogger('test.structured')
+        with mock.patch.dict(logs.SAMPLING, {'ws.message.sent': 0.25}), \
+                mock.patch('random.random', side_effect=[0.1, 0.5, 0.9, 0.2]):
+            for _ in range(4):
+                log.info('ws.message.sent', call_id=1)
+        lines = self.lines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('"sample_rate": 0.25', lines[0])
+
+    def test_full_queue(self):
+        handler = logs.QueuedHandler({'class': 'logging.NullHandler'}, queue_size=1)
+        handler.listener.stop()
+        before = logs.DROPPED_RECORDS.labels().value
+        record = logging.makeLogRecord({'msg': 'x'})
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual(logs.DROPPED_RECORDS.labels().value, before + 1)
+        handler.close()
+
+
+class ProfilingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user(username='profile_staff', password='profile-pass-1', is_staff=True)
+        cls.user = User.objects.create_user(username='profile_user', password='profile-pass-1')
+        cls.staff_token = Token.objects.create(user=cls.staff)
+        cls.user_token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        profiling.STORE.clear()
+
+    def test_staff_header(self):
+        response = self.client.get('/api/users/me/', HTTP_AUTHORIZATION=f'Token {self.staff_token.key}',
+                                   HTTP_X_PROFILE='1')
+        profile = profiling.find(response['X-Profile-Id'])
+        self.assertEqual((profile.kind, profile.operation, profile.name, profile.status),
+                         ('http', 'GET', 'user-me', 200))
+        self.assertGreater(profile.query_count, 0)
+        self.assertEqual(len(profile.queries), profile.query_count)
+        self.assertIn(f'desc="{profile.query_count} queries"', response['Server-Timing'])
+
+    def test_header_ignored(self):
+        response = self.client.get('/api/users/me/', HTTP_AUTHORIZATION=f'Token {self.user_token.key}',
+                                   HTTP_X_PROFILE='1')
+        self.assertNotIn('X-Profile-Id', response)
+        response = self.client.get('/api/users/me/', HTTP_AUTHORIZATION=f'Token {self.staff_token.key}')
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(len(profiling.STORE), 0)
+
+    def test_token_header(self):
+        with mock.patch.object(profiling, 'TOKEN', 'jeton-de-profil'):
+            response = self.client.get('/api/users/me/', HTTP_AUTHORIZATION=f'Token {self.user_token.key}',
+                                       HTTP_X_PROFILE='jeton-de-profil')
+        self.assertIsNotNone(profiling.find(response['X-Profile-Id']))
+
+    def test_admin_pages(self):
+        response = self.client.get('/api/users/me/', HTTP_AUTHORIZATION=f'Token {self.staff_token.key}',
+                                   HTTP_X_PROFILE='1')
+        profile_id = response['X-Profile-Id']
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/admin/profiles/').status_code, 302)
+
+        self.client.force_login(self.staff)
+        self.assertContains(self.client.get('/admin/profiles/'), profile_id)
+        self.assertContains(self.client.get(f'/admin/profiles/{profile_id}/'), 'Requêtes SQL')
+        self.assertEqual(self.client.get('/admin/profiles/0-0/').status_code, 404)
+
+    def test_stack_samples(self):
+        def busy():
+            deadline = time.perf_counter() + 0.1
+            while time.perf_counter() < deadline:
+                pass
+
+        profile = profiling.Profile('http', 'test', '/', sys._getframe())
+        with profiling.active(profile):
+            busy()
+        self.assertGreater(profile.samples, 0)
+        self.assertTrue(all(stack.startswith('ProfilingTests.test_stack_samples') for stack in profile.stacks))
+        self.assertTrue(any('test_stack_samples.<locals>.busy' in stack for stack in profile.stacks))
+
+    def test_flame_graph(self):
+        profile = profiling.Profile('http', 'test', '/', None)
+        profile.stacks.update({'a;b': 3, 'a;c': 1, 'd': 4})
+        boxes = {(box['name'], box['depth']): (box['left'], box['width']) for box in profiling.flame_graph(profile)}
+        self.assertEqual(boxes, {
+            ('a', 0): (0.0, 50.0), ('d', 0): (50.0, 50.0),
+            ('b', 1): (0.0, 37.5), ('c', 1): (37.5, 12.5),
+        })
@@ -0,0 +1,82 @@
+import hmac
+import ipaddress
+import zlib
+
+from django.conf import settings
+from django.contrib import admin
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import render
+from django.views.decorators.http import require_GET
+
+from . import metrics, profiling
+
+# Hauteur (px) d'un niveau du graphe de flammes
+FRAME_HEIGHT = 18
+
+
+def internal_address(address, networks):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in networks)
+
+
+@require_GET
+def metrics_view(request):
+    """
+    Métriques du processus au format Prometheus : jeton Bearer exigé si
+    METRICS_TOKEN est défini, sinon accès limité aux adresses de METRICS_ALLOWED_NETWORKS
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            return JsonResponse({"detail": "Jeton de métriques invalide."}, status=401)
+    elif not internal_address(request.META.get('REMOTE_ADDR', ''),
+                              getattr(settings, 'METRICS_ALLOWED_NETWORKS', ['127.0.0.0/8', '::1/128'])):
+        return JsonResponse({"detail": "Métriques réservées au réseau interne (ou définir METRICS_TOKEN)."},
+                            status=403)
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+# Pages d'administration des profils (protégées par admin.site.admin_view dans toip_backend.urls)
+
+@require_GET
+def profile_list(request):
+    """Derniers profils de ce processus, du plus récent au plus ancien"""
+    context = {
+        **admin.site.each_context(request),
+        'title': "Profils des requêtes",
+        'profiles': list(reversed(profiling.STORE)),
+        'store_size': profiling.STORE_SIZE,
+    }
+    return render(request, 'monitoring/profile_list.html', context)
+
+
+@require_GET
+def profile_detail(request, profile_id):
+    """Requêtes SQL et graphe de flammes d'un profil (?format=collapsed : piles repliées)"""
+    profile = profiling.find(profile_id)
+    if profile is None:
+        raise Http404("Profil introuvable (sorti du tampon ou relevé par un autre processus).")
+    if request.GET.get('format') == 'collapsed':
+        return HttpResponse(profile.collapsed(), content_type='text/plain; charset=utf-8')
+
+    boxes = profiling.flame_graph(profile)
+    for box in boxes:
+        # Teinte stable par fonction, dans les tons chauds
+        hue = zlib.crc32(box['name'].encode()) % 50
+        box['style'] = (f"left: {box['left']:.3f}%; width: {box['width']:.3f}%; top: {box['depth'] * FRAME_HEIGHT}px; "
+                        f"height: {FRAME_HEIGHT - 1}px; background: hsl({hue}, 80%, 60%);")
+    depth = max((box['depth'] for box in boxes), default=-1) + 1
+    context = {
+        **admin.site.each_context(request),
+        'title': f"Profil {profile.id}",
+        'profile': profile,
+        'queries': [(sql, seconds * 1000) for sql, seconds in profile.queries],
+        'repeated': profile.repeated_queries(),
+        'boxes': boxes,
+        'graph_height': depth * FRAME_HEIGHT,
+    }
+    return render(request, 'monitoring/profile_detail.html', context)
@@ -0,0 +1,71 @@
+"""
+Vues DRF asynchrones
+
+DRF n'exécute que des gestionnaires synchrones : async_api_view est
+l'équivalent de api_view pour une fonction async def. Le traitement (ORM
+asynchrone, couche de canaux, Redis) se fait dans la boucle asyncio du
+serveur ASGI, sans occuper un thread pendant les attentes.
+
+L'authentification, les permissions et les limitations de DRF
+(APIView.initial) restent synchrones : elles sont exécutées en un seul
+passage par sync_to_async. Le rendu de la réponse est inchangé.
+"""
+import inspect
+
+from asgiref.sync import sync_to_async
+from rest_framework.views import APIView
+
+# Attributs posés par les décorateurs de rest_framework.decorators (permission_classes, ...)
+POLICY_ATTRIBUTES = ('renderer_classes', 'parser_classes', 'authentication_classes',
+                     'throttle_classes', 'permission_classes', 'content_negotiation_class',
+                     'metadata_class', 'versioning_class')
+
+
+class AsyncAPIView(APIView):
+    """APIView dont les gestionnaires de méthode sont des coroutines"""
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            # OPTIONS et méthode refusée : gestionnaires synchrones d'APIView
+            if inspect.isawaitable(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+def async_api_view(http_method_names):
+    """Décorateur api_view pour une vue async def (à placer au-dessus de permission_classes, ...)"""
+    http_method_names = [method.lower() for method in http_method_names]
+
+    def decorator(func):
+        async def handler(self, *args, **kwargs):
+            return await func(*args, **kwargs)
+
+        attributes = {'__doc__': func.__doc__, '__module__': func.__module__,
+                      'http_method_names': http_method_names + ['options']}
+        for method in http_method_names:
+            attributes[method] = handler
+        for name in POLICY_ATTRIBUTES:
+            if hasattr(func, name):
+                attributes[name] = getattr(func, name)
+        WrappedAPIView = type(func.__name__, (AsyncAPIView,), attributes)
+        return WrappedAPIView.as_view()
+
+    return decorator
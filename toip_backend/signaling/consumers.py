@@ -1,81 +1,295 @@
+import asyncio
 import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from . import replay, rooms, tracing
 from .models import SignalingMessage
-from calls.models import Call
-import logging
+from calls.models import Call, CallParticipant
+from calls.quality import QualityFormatError, ingest_samples, parse_binary, parse_json_samples
+from mediaserver.sfu import SFU_PEER
+from monitoring.logs import get_logger
+from monitoring.metrics import Counter, Gauge, Histogram
+from monitoring.profiling import ProfiledConsumerMixin
 
 # Utiliser deux loggers distincts
-logger = logging.getLogger('signaling')
-ws_logger = logging.getLogger('websocket')
+logger = get_logger('signaling')
+ws_logger = get_logger('websocket')
 
 
 User = get_user_model()
 
-class SignalingConsumer(AsyncWebsocketConsumer):
+WEBSOCKET_CONNECTIONS = Gauge('toip_websocket_connections', "Connexions WebSocket ouvertes", ['consumer'])
+RELAYED_MESSAGES = Counter('toip_signaling_messages_total',
+                           "Messages de signalisation relayés dans le groupe de l'appel", ['type'])
+RELAY_SECONDS = Histogram('toip_signaling_relay_seconds',
+                          "Réception d'un message WebSocket jusqu'à sa diffusion dans le groupe de l'appel", ['type'])
+# Types de message étiquetés tels quels (les autres sous 'other' : le client choisit le type)
+METRIC_MESSAGE_TYPES = {message_type for message_type, _ in SignalingMessage.MESSAGE_TYPES}
+
+
+def metric_type(message_type):
+    return message_type if message_type in METRIC_MESSAGE_TYPES else 'other'
+
+
+class CountedConnectionMixin:
+    """Tient la jauge des connexions ouvertes, par classe de consommateur"""
+    counted = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        WEBSOCKET_CONNECTIONS.labels(type(self).__name__).inc()
+        self.counted = True
+
+    async def websocket_disconnect(self, message):
+        if self.counted:
+            self.counted = False
+            WEBSOCKET_CONNECTIONS.labels(type(self).__name__).dec()
+        await super().websocket_disconnect(message)
+
+
+class SignalingConsumer(CountedConnectionMixin, ProfiledConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.call_id = self.scope['url_route']['kwargs']['call_id']
+        self.is_group_call = False
+        self.call_type = None
+        self.participant_count = 0
+        self.call_participant = None
+        self.initiator_id = None
+        # Initiateur et participants : destinataires des messages diffusés, pour le rejeu
+        self.participant_ids = set()
+        # Dernière séquence de rejeu remise au client (voir signaling.replay)
+        self.delivered_seq = 0
+        self.registered = False
+        self.heartbeat = None
+        # Appel échantillonné : trames tracées de bout en bout (voir signaling.tracing)
+        self.traced = tracing.sampled(self.call_id)
+        self.media_traced = False
         self.room_group_name = f'call_{self.call_id}'
-        self.username = self.scope['user'].username if self.scope['user'].is_authenticated else "Anonymous"
 
         if not self.scope['user'].is_authenticated:
-            ws_logger.warning(f"Connexion refusée - utilisateur non authentifié - call_id={self.call_id}")
+            ws_logger.warning('ws.connect.unauthenticated', call_id=self.call_id)
             await self.close(code=4003)
             return
 
         is_participant = await self.is_participant()
         if not is_participant:
-            ws_logger.warning(
-                f"Refus connexion: {self.username} non participant - call_id={self.call_id}")
+            ws_logger.warning('ws.connect.forbidden', call_id=self.call_id, user_id=self.scope['user'].id)
             await self.close(code=4004)
             return
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
 
-        ws_logger.info(f"Connexion acceptée: {self.username} - call_id={self.call_id}")
+        ws_logger.info('ws.connect.accepted', call_id=self.call_id, user_id=self.scope['user'].id)
         await self.accept()
 
+        # Registre partagé des connexions de l'appel ; l'état courant est envoyé au client
+        self.registered = True
+        await rooms.join(self.call_id, self.scope['user'].id, self.channel_name)
+        self.heartbeat = asyncio.ensure_future(self.keep_registered())
+        state = await rooms.room_state(self.call_id)
+        if state is not None:
+            await self.send(text_data=json.dumps({'type': 'room-state', 'callId': self.call_id,
+                                                  'members': state['members']}))
+
+        last_seq = parse_qs(self.scope.get('query_string', b'').decode()).get('last_seq', [''])[0]
+        if last_seq.isdigit():
+            await self.replay_missed(int(last_seq))
+
+    async def keep_registered(self):
+        """Prolonge l'entrée de la connexion dans le registre tant qu'elle est ouverte"""
+        while True:
+            await asyncio.sleep(rooms.ROOM_HEARTBEAT)
+            await rooms.join(self.call_id, self.scope['user'].id, self.channel_name)
+
+    async def replay_missed(self, last_seq):
+        """
+        Reconnexion : renvoie depuis Redis les messages relayés pendant l'absence
+        du client. Les messages du groupe arrivés entre-temps sont traités après
+        ce rejeu et ignorés s'ils en font partie (séquence déjà remise).
+        """
+        self.delivered_seq = last_seq
+        messages, complete = await replay.since(self.call_id, self.scope['user'].id, last_seq)
+        for seq, message in messages:
+            await self.send(text_data=json.dumps({**message, 'seq': seq}))
+            self.delivered_seq = seq
+        if not complete:
+            # Messages sortis du tampon : le client doit recourir à poll_messages ou renégocier
+            await self.send(text_data=json.dumps({'type': 'replay-gap', 'callId': self.call_id,
+                                                  'lastSeq': last_seq}))
+        ws_logger.info('ws.replay', call_id=self.call_id, user_id=self.scope['user'].id, messages=len(messages),
+                       complete=complete)
+
+    def replay_receivers(self, message, sender_id):
+        receiver = message.get('receiver')
+        if receiver is not None:
+            return [int(receiver)] if str(receiver).isdigit() else []
+        return [user_id for user_id in self.participant_ids if user_id != sender_id]
+
+    async def relay(self, message, sender_id, trace=None):
+        """Diffuse un message dans le groupe de l'appel après l'avoir ajouté au tampon de rejeu de ses destinataires"""
+        seqs = await replay.append(self.call_id, self.replay_receivers(message, sender_id), message)
+        event = {
+            'type': 'signaling_message',
+            'message': message,
+            'sender_id': sender_id,
+            'seqs': seqs,
+        }
+        if trace is not None:
+            trace.mark('buffered')
+            event['trace'] = trace.context()
+        await self.channel_layer.group_send(self.room_group_name, event)
+        if trace is not None:
+            trace.mark('published')
+
     async def disconnect(self, close_code):
         # Quitter le groupe d'appel
-        ws_logger.info(f"Déconnexion: {self.username} - call_id={self.call_id} - code={close_code}")
+        ws_logger.info('ws.disconnect', call_id=self.call_id, user_id=self.scope['user'].id, code=close_code)
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+        if self.registered:
+            await rooms.leave(self.call_id, self.scope['user'].id, self.channel_name)
+        if self.sfu_enabled:
+            from mediaserver.sfu import find_room
+            room = find_room(self.call_id)
+            if room is not None:
+                await room.leave(self.scope['user'].id)
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
     async def receive(self, text_data=None, bytes_data=None):
+        received = time.perf_counter()
+        trace = tracing.Trace(self.call_id, self.scope['user'].id) if self.traced else None
         if text_data is None:
-            return  # Ignorer les messages binaires pour l'instant
+            # Les trames binaires transportent les statistiques de qualité (voir calls.quality)
+            await self.handle_quality_stats(parse_binary, bytes_data)
+            return
 
         try:
             data = json.loads(text_data)
             message_type = data.get('type')
+            if trace is not None:
+                trace.mark('parsed')
 
-            if ws_logger.isEnabledFor(logging.DEBUG):
-                ws_logger.debug(
-                    f"Message reçu: {message_type} de {self.username} - call_id={self.call_id}")
-            else:
-                ws_logger.info(f"Message {message_type} reçu - call_id={self.call_id}")
+            if message_type == 'quality-stats':
+                await self.handle_quality_stats(parse_json_samples, data.get('samples'))
+                return
 
-            await self.save_signaling_message(data)
+            ws_logger.info('ws.message.received', call_id=self.call_id, user_id=self.scope['user'].id,
+                           type=message_type)
+
+            if data.get('receiver') == SFU_PEER:
+                await self.handle_sfu_message(data)
+                return
 
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'signaling_message',
-                    'message': data,
-                    'sender_id': self.scope['user'].id
-                }
-            )
+            await self.save_signaling_message(data)
+            if trace is not None:
+                trace.mark('persisted')
+            await self.relay(data, self.scope['user'].id, trace)
+            label = metric_type(message_type)
+            RELAYED_MESSAGES.labels(label).inc()
+            RELAY_SECONDS.labels(label).observe(time.perf_counter() - received)
+            if trace is not None:
+                await tracing.record(self.call_id, trace.span(data))
         except json.JSONDecodeError:
-            ws_logger.error(f"Erreur JSON invalide - call_id={self.call_id}")
+            ws_logger.error('ws.message.invalid_json', call_id=self.call_id, user_id=self.scope['user'].id)
             await self.send(text_data=json.dumps({'type': 'error', 'message': 'Format JSON invalide'}))
 
 
+    @property
+    def sfu_enabled(self):
+        """Le serveur média ne prend en charge que les appels de groupe, et seulement s'il est activé"""
+        return getattr(settings, 'SFU_ENABLED', False) and self.is_group_call
+
+    async def handle_sfu_message(self, data):
+        """Offre, réponse et candidats ICE échangés avec le serveur média au lieu d'un pair"""
+        if not self.sfu_enabled:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Serveur média indisponible pour cet appel'}))
+            return
+
+        from mediaserver.sfu import get_room
+        room_class = None
+        if (self.call_type == 'audio' and getattr(settings, 'MCU_AUDIO_CALLS', False)
+                and self.participant_count >= getattr(settings, 'MCU_MIN_PARTICIPANTS', 0)):
+            # Grand appel audio : le serveur mixe l'audio au lieu de retransmettre chaque flux
+            from mediaserver.mcu import McuRoom
+            room_class = McuRoom
+
+        async def send_to_participant(user_id, message):
+            await self.relay(message, None)
+
+        room = get_room(self.call_id, send_to_participant, room_class)
+        message_type = data.get('type')
+        if message_type in ('start-recording', 'stop-recording'):
+            # Enregistrement de tous les participants : décidé par l'initiateur de l'appel seul
+            if self.scope['user'].id != self.initiator_id:
+                ws_logger.warning('recording.forbidden', call_id=self.call_id, user_id=self.scope['user'].id)
+                await self.send(text_data=json.dumps({
+                    'type': 'error', 'message': "Seul l'initiateur de l'appel peut démarrer ou arrêter l'enregistrement"}))
+                return
+            await self.handle_recording_request(room, message_type == 'start-recording')
+            return
+
+        await room.handle_message(self.scope['user'].id, data)
+        if message_type == 'offer' and room.supports_recording and getattr(settings, 'RECORD_GROUP_CALLS', False):
+            await self.handle_recording_request(room, True)
+
+    async def handle_recording_request(self, room, start):
+        """Démarre ou arrête l'enregistrement côté serveur et en informe tous les participants"""
+        from mediaserver.recording import find_recorder, start_recording
+
+        if not room.supports_recording:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': 'Enregistrement indisponible pour cet appel'}))
+            return
+
+        recorder = find_recorder(self.call_id)
+        if start == (recorder is not None):
+            return
+        if start:
+            await start_recording(room, video=self.call_type == 'video')
+        else:
+            await recorder.stop()
+        ws_logger.info('recording.started' if start else 'recording.stopped', call_id=self.call_id,
+                       user_id=self.scope['user'].id)
+        await self.relay({
+            'type': 'recording-started' if start else 'recording-stopped',
+            'sender': SFU_PEER,
+            'callId': self.call_id,
+        }, None)
+
+    async def handle_quality_stats(self, parse, payload):
+        """Lot d'échantillons getStats() : enregistré sans être relayé aux autres participants"""
+        try:
+            samples = parse(payload)
+            saved = await self.save_quality_samples(samples)
+        except QualityFormatError as e:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': f'Statistiques invalides: {e}'}))
+            return
+        if not saved:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': "Statistiques refusées: participant inconnu"}))
+            return
+        if self.traced and not self.media_traced:
+            # Premier lot de statistiques : le média circule, jalon "connected" de la trace
+            self.media_traced = True
+            await tracing.record(self.call_id, tracing.media_span(self.scope['user'].id))
+
     async def signaling_message(self, event):
+        trace = event.get('trace')
+        delivered = tracing.elapsed(trace) if trace is not None else None
         message = event['message']
         sender_id = event['sender_id']
+        seq = event.get('seqs', {}).get(str(self.scope['user'].id))
+        if seq is not None:
+            # Seuls les messages déjà renvoyés par replay_missed sont écartés : deux expéditeurs
+            # peuvent relayer au même destinataire et leurs messages arriver hors séquence
+            if seq <= self.delivered_seq:
+                return
+            message = {**message, 'seq': seq}
 
         # Don't send the message back to the original sender
         if sender_id != self.scope['user'].id:
@@ -86,35 +300,60 @@ class SignalingConsumer(AsyncWebsocketConsumer):
                 user_id = self.scope['user'].id
 
                 if receiver_id == user_id:
-                    logger.info(
-                        f"WebSocket - Sending {message.get('type')} message to specific receiver: {self.scope['user'].username}")
+                    message_id = event.get('message_id')
+                    if message_id is not None and not await self.claim_message(message_id):
+                        return
+                    logger.info('ws.message.sent', call_id=self.call_id, user_id=user_id, type=message.get('type'))
                     await self.send(text_data=json.dumps(message))
+                    await self.record_delivery(trace, delivered)
             else:
                 # If no specific receiver, broadcast to all in the room except sender
-                logger.info(f"WebSocket - Broadcasting {message.get('type')} message to {self.scope['user'].username}")
+                logger.info('ws.message.sent', call_id=self.call_id, user_id=self.scope['user'].id,
+                            type=message.get('type'), broadcast=True)
                 await self.send(text_data=json.dumps(message))
+                await self.record_delivery(trace, delivered)
+
+    @database_sync_to_async
+    def claim_message(self, message_id):
+        """
+        Message stocké par l'API REST (voir views.push_to_websocket) : marqué traité
+        avant l'envoi, sauf s'il a déjà été relevé ou remis à une autre connexion
+        """
+        return SignalingMessage.objects.filter(id=message_id, is_processed=False).update(is_processed=True) == 1
+
+    async def record_delivery(self, trace, delivered):
+        """Segment du destinataire d'un message tracé : remise au consommateur, puis envoi au client"""
+        if trace is None:
+            return
+        span = tracing.recipient_span(trace, self.scope['user'].id, delivered, tracing.elapsed(trace))
+        await tracing.record(self.call_id, span, trace['stages'].get('buffered', 0.0))
 
 
     @database_sync_to_async
     def is_participant(self):
         try:
             call = Call.objects.get(id=self.call_id)
-            user = self.scope['user']
-            user_id = user.id
-            participants = call.participants.all()
-            print(f"Participants: {[(p.id, p.username) for p in participants]}")
-
-            print(f"Vérification si {self.scope['user'].username} est participant de l'appel {self.call_id}")
-            print(f"Initiateur: {call.initiator.username}, Participants: {[p.username for p in call.participants.all()]}")
+            self.is_group_call = call.is_group_call
+            self.call_type = call.call_type
+            participant_ids = set(call.participants.values_list('id', flat=True))
+            self.participant_count = len(participant_ids)
+            self.initiator_id = call.initiator_id
+            self.participant_ids = participant_ids | {call.initiator_id}
             # Vérifier si l'utilisateur est l'initiateur ou un participant
-            if call.initiator.id == user_id:
-                return True
-            is_participant = call.participants.filter(id=user_id).exists()
-            print(f"L'utilisateur {user.username} est participant: {is_participant}")
-            return is_participant
+            return self.scope['user'].id in self.participant_ids
         except Call.DoesNotExist:
             return False
 
+    @database_sync_to_async
+    def save_quality_samples(self, samples):
+        if self.call_participant is None:
+            self.call_participant = CallParticipant.objects.select_related('call').filter(
+                call_id=self.call_id, user=self.scope['user']).first()
+            if self.call_participant is None:
+                return False
+        ingest_samples(self.call_participant, samples)
+        return True
+
     @database_sync_to_async
     def save_signaling_message(self, data):
         message_type = data.get('type')
@@ -138,18 +377,18 @@ class SignalingConsumer(AsyncWebsocketConsumer):
             content=content
         )
 
-class IncomingCallConsumer(AsyncWebsocketConsumer):
+class IncomingCallConsumer(CountedConnectionMixin, AsyncWebsocketConsumer):
     async def connect(self):
         # Vérifier l'authentification
         if not self.scope['user'].is_authenticated:
-            print(f"WebSocket IncomingCall - Refus de connexion: utilisateur non authentifié")
+            ws_logger.warning('ws.incoming.unauthenticated')
             await self.close()
             return
         
         # Groupe personnel pour l'utilisateur
         self.user_group = f'user_{self.scope["user"].id}'
         
-        print(f"WebSocket IncomingCall - Connexion acceptée: utilisateur {self.scope['user'].username}")
+        ws_logger.info('ws.incoming.accepted', user_id=self.scope['user'].id)
         
         await self.channel_layer.group_add(
             self.user_group,
@@ -159,7 +398,7 @@ class IncomingCallConsumer(AsyncWebsocketConsumer):
         await self.accept()
     
     async def disconnect(self, close_code):
-        print(f"WebSocket IncomingCall - Déconnexion: utilisateur {self.scope['user'].username}, code {close_code}")
+        ws_logger.info('ws.incoming.disconnect', user_id=self.scope['user'].id, code=close_code)
         
         await self.channel_layer.group_discard(
             self.user_group,
@@ -167,7 +406,7 @@ class IncomingCallConsumer(AsyncWebsocketConsumer):
         )
     
     async def incoming_call(self, event):
-        print(f"WebSocket IncomingCall - Notification d'appel entrant à {self.scope['user'].username}: appel_id={event['call']['id']}")
+        ws_logger.info('ws.incoming.notified', user_id=self.scope['user'].id, call_id=event['call']['id'])
         
         await self.send(text_data=json.dumps({
             'type': 'incoming_call',
@@ -0,0 +1,220 @@
+"""
+Couche de canaux hybride : remise directe aux canaux du processus
+
+Avec RedisChannelLayer, chaque message passe par Redis même quand
+l'expéditeur et le destinataire sont deux WebSockets du même processus
+daphne (cas courant des appels 1:1 avec répartition collante). Cette couche
+garde la même API et la même configuration, mais retient les canaux locaux
+membres de chaque groupe : les messages qui leur sont destinés sont déposés
+directement dans leur file de réception (receive_buffer), sans aller-retour
+Redis. Redis ne sert plus qu'aux membres des autres processus ; un
+group_send purement local coûte une seule lecture de l'ensemble du groupe.
+
+Les appartenances sont toujours écrites dans Redis, pour que les autres
+processus puissent joindre nos canaux. Les messages venus de Redis sont lus
+par une tâche unique par boucle (pompe) qui les répartit dans les mêmes
+files : un consommateur n'attend que sa file, qu'un message soit local ou
+distant (RedisChannelLayer fait lire Redis par l'un des consommateurs, qui
+ne verrait pas une remise locale pendant cette attente).
+"""
+import asyncio
+import collections
+import copy
+import time
+
+from channels_redis.core import RedisChannelLayer
+
+from monitoring.logs import get_logger
+from monitoring.metrics import Histogram
+from .redis_store import REDIS_ERRORS
+from .sharding import VIRTUAL_NODES, HashRing, shard_name
+
+logger = get_logger('signaling')
+
+# Version de channels_redis dont les méthodes internes sont reprises ici (receive_buffer,
+# receive_single, _map_channel_keys_to_connection, script de group_send) : épinglée
+# dans requirements.txt, à revérifier à chaque mise à jour
+CHANNELS_REDIS_VERSION = '4.2.1'
+
+# Pause avant de reprendre la lecture Redis après une erreur passagère
+PUMP_RETRY_DELAY = 0.5
+
+PUBLISH_SECONDS = Histogram('toip_channel_layer_publish_seconds',
+                            "Durée d'un send / group_send de la couche de canaux (remise locale et Redis)",
+                            ['operation'])
+
+# Même script que RedisChannelLayer.group_send (dépôt borné par la capacité de chaque canal)
+GROUP_SEND_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+class HybridChannelLayer(RedisChannelLayer):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # groupe -> canaux de ce processus membres du groupe
+        self.local_groups = collections.defaultdict(set)
+        # canal local -> nombre de groupes dont il est membre
+        self.local_channels = collections.Counter()
+        self._pump = None
+
+    def is_local(self, channel):
+        """Canal spécifique créé par cette instance (new_channel)"""
+        return '!' in channel and self.non_local_name(channel).endswith(self.client_prefix + '!')
+
+    def deliver_local(self, channel, message):
+        # Copie : le destinataire ne doit pas partager l'objet de l'expéditeur (équivalent de la sérialisation)
+        self.receive_buffer[channel].put_nowait(copy.deepcopy(message))
+
+    async def send(self, channel, message):
+        with PUBLISH_SECONDS.labels('send').time():
+            if channel in self.local_channels:
+                assert isinstance(message, dict), "message is not a dict"
+                self.deliver_local(channel, message)
+                return
+            await super().send(channel, message)
+
+    async def receive(self, channel):
+        if '!' not in channel:
+            return await super().receive(channel)
+        assert self.non_local_name(channel).endswith(self.client_prefix + '!'), "Wrong client prefix"
+
+        pump = self._ensure_pump()
+        buffer = self.receive_buffer[channel]
+        getter = asyncio.ensure_future(buffer.get())
+        try:
+            await asyncio.wait({getter, pump}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not getter.done():
+                getter.cancel()
+            if buffer.empty() and self.receive_buffer.get(channel) is buffer:
+                del self.receive_buffer[channel]
+        if getter.done() and not getter.cancelled():
+            return getter.result()
+        # La pompe s'est arrêtée : remonter son erreur (elle sera relancée au prochain receive)
+        pump.result()
+        raise RuntimeError("Réception Redis arrêtée")
+
+    def _ensure_pump(self):
+        loop = asyncio.get_running_loop()
+        if self._pump is None or self._pump.done() or self._pump.get_loop() is not loop:
+            self._pump = loop.create_task(self._run_pump(f'specific.{self.client_prefix}!'))
+        return self._pump
+
+    async def _run_pump(self, real_channel):
+        """Lit les messages Redis des canaux de ce processus et les range dans leurs files"""
+        while True:
+            try:
+                message_channel, message = await self.receive_single(real_channel)
+            except REDIS_ERRORS as e:
+                # Délai de lecture dépassé (BZPOPMIN de 5 s contre socket_timeout de 5 s avec
+                # redis-py 8) ou connexion perdue : les consommateurs continuent d'attendre
+                logger.warning('layer.pump.interrupted', error=e)
+                await asyncio.sleep(PUMP_RETRY_DELAY)
+                continue
+            for channel in message_channel if isinstance(message_channel, list) else [message_channel]:
+                self.receive_buffer[channel].put_nowait(message)
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        if self.is_local(channel) and channel not in self.local_groups[group]:
+            self.local_groups[group].add(channel)
+            self.local_channels[channel] += 1
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        members = self.local_groups.get(group)
+        if members is None or channel not in members:
+            return
+        members.discard(channel)
+        if not members:
+            del self.local_groups[group]
+        self.local_channels[channel] -= 1
+        if self.local_channels[channel] <= 0:
+            del self.local_channels[channel]
+
+    async def group_send(self, group, message):
+        with PUBLISH_SECONDS.labels('group_send').time():
+            await self._group_send(group, message)
+
+    async def _group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        local = self.local_groups.get(group, ())
+        for channel in local:
+            self.deliver_local(channel, message)
+
+        # Membres des autres processus : une lecture, les appartenances expirées étant ignorées
+        connection = self.connection(self.consistent_hash(group))
+        members = await connection.zrangebyscore(
+            self._group_key(group), min=int(time.time()) - self.group_expiry, max='+inf')
+        remote = [
+            channel for channel in (member.decode('utf8') for member in members)
+            if channel not in local and not self.is_local(channel)
+        ]
+        if remote:
+            await self.send_remote(group, remote, message)
+
+    async def send_remote(self, group, channel_names, message):
+        """Dépôt dans Redis pour les canaux d'autres processus (logique de RedisChannelLayer.group_send)"""
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channel_names, message)
+
+        for connection_index, channel_redis_keys in connection_to_channel_keys.items():
+            connection = self.connection(connection_index)
+            pipe = connection.pipeline()
+            for key in channel_redis_keys:
+                pipe.zremrangebyscore(key, min=0, max=int(time.time()) - int(self.expiry))
+            await pipe.execute()
+
+            args = [channel_keys_to_message[key] for key in channel_redis_keys]
+            args += [channel_keys_to_capacity[key] for key in channel_redis_keys]
+            args += [time.time(), self.expiry]
+            over_capacity = await connection.eval(
+                GROUP_SEND_LUA, len(channel_redis_keys), *channel_redis_keys, *args)
+            if over_capacity > 0:
+                logger.info('layer.group.over_capacity', group=group, channels=len(channel_names), full=over_capacity)
+
+    async def flush(self):
+        self.local_groups.clear()
+        self.local_channels.clear()
+        await super().flush()
+
+    async def close_pools(self):
+        if self._pump is not None and self._pump.get_loop() is asyncio.get_running_loop():
+            self._pump.cancel()
+            try:
+                await self._pump
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._pump = None
+        await super().close_pools()
+
+
+class ShardedChannelLayer(HybridChannelLayer):
+    """
+    HybridChannelLayer répartie sur toutes les instances de hosts par hachage
+    cohérent (voir signaling.sharding) : chaque groupe et la boîte de réception
+    de chaque processus vivent sur une seule instance.
+    """
+
+    def __init__(self, *args, virtual_nodes=VIRTUAL_NODES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = HashRing([shard_name(host) for host in self.hosts], virtual_nodes)
+
+    def consistent_hash(self, value):
+        return self.ring.index(value)
@@ -0,0 +1,135 @@
+"""
+Banc d'essai de la couche de canaux
+
+Compare RedisChannelLayer et HybridChannelLayer sur le relais d'un message
+de signalisation dans un groupe d'appel à deux membres (comme un appel 1:1) :
+  - local  : les deux canaux appartiennent au même processus ;
+  - remote : le pair est sur une autre instance de la couche (autre worker).
+Pour chaque cas : latence group_send -> réception par le pair, et nombre de
+commandes Redis émises par message (comptées côté client). Le banc utilise le
+Redis de CHANNEL_LAYERS avec un préfixe dédié, effacé à la fin.
+"""
+import asyncio
+import time
+import uuid
+
+import redis
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from signaling.layers import HybridChannelLayer
+
+LAYERS = {'redis': RedisChannelLayer, 'hybrid': HybridChannelLayer}
+BENCH_PREFIX = 'bench_asgi'
+
+
+class CommandCounter:
+    """Compte les commandes envoyées par les clients redis.asyncio (pipelines compris)"""
+
+    def __init__(self):
+        self.count = 0
+        self._patched = []
+
+    def __enter__(self):
+        for cls in (redis.asyncio.client.Redis, redis.asyncio.client.Pipeline):
+            original = cls.execute_command
+
+            def counted(client, *args, _original=original, **kwargs):
+                self.count += 1
+                return _original(client, *args, **kwargs)
+
+            cls.execute_command = counted
+            self._patched.append((cls, original))
+        return self
+
+    def __exit__(self, *exc):
+        for cls, original in self._patched:
+            cls.execute_command = original
+        self._patched = []
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class Command(BaseCommand):
+    help = "Compare la latence de relais et les commandes Redis par message des couches de canaux"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--calls', type=int, default=10, help="appels (groupes de deux canaux) simultanés")
+        parser.add_argument('--layers', nargs='+', choices=list(LAYERS), default=list(LAYERS))
+        parser.add_argument('--scenarios', nargs='+', choices=['local', 'remote'], default=['local', 'remote'])
+
+    def handle(self, *args, **options):
+        config = dict(settings.CHANNEL_LAYERS['default'].get('CONFIG', {}), prefix=BENCH_PREFIX)
+        self.stdout.write("couche    cas      latence p50   p99 (ms)   messages/s   commandes Redis/message")
+        for name in options['layers']:
+            for scenario in options['scenarios']:
+                try:
+                    result = asyncio.run(self.run(LAYERS[name], config, scenario, options))
+                except asyncio.TimeoutError:
+                    raise CommandError(f"{name}/{scenario} : message non reçu par le pair après 10 s")
+                except (redis.RedisError, OSError) as e:
+                    raise CommandError(f"Redis injoignable ({config.get('hosts')}): {e}")
+                self.stdout.write(
+                    f"{name:<9} {scenario:<8} {result['p50'] * 1000:8.3f} {result['p99'] * 1000:9.3f} "
+                    f"{result['rate']:12.0f} {result['commands']:14.1f}")
+
+    async def run(self, layer_class, config, scenario, options):
+        sender = layer_class(**config)
+        peer = sender if scenario == 'local' else layer_class(**config)
+        calls = []
+        for index in range(options['calls']):
+            group = f'call_bench_{uuid.uuid4().hex[:8]}_{index}'
+            own, other = await sender.new_channel(), await peer.new_channel()
+            await sender.group_add(group, own)
+            await peer.group_add(group, other)
+            calls.append((group, own, other))
+
+        received = {}
+        latencies = []
+
+        async def listen(layer, channel, record):
+            while True:
+                message = await layer.receive(channel)
+                if record:
+                    latencies.append(time.perf_counter() - message['sent'])
+                    received[message['seq']].set()
+
+        listeners = [asyncio.ensure_future(listen(sender, own, False)) for _, own, _ in calls]
+        listeners += [asyncio.ensure_future(listen(peer, other, True)) for _, _, other in calls]
+        # Mise en route des lectures Redis avant la mesure
+        await asyncio.sleep(0.2)
+
+        try:
+            with CommandCounter() as counter:
+                started = time.perf_counter()
+                for seq in range(options['messages']):
+                    group = calls[seq % len(calls)][0]
+                    event = received[seq] = asyncio.Event()
+                    await sender.group_send(group, {'type': 'signaling.message', 'seq': seq,
+                                                    'sent': time.perf_counter()})
+                    await asyncio.wait_for(event.wait(), timeout=10)
+                    del received[seq]
+                elapsed = time.perf_counter() - started
+                commands = counter.count
+        finally:
+            for listener in listeners:
+                listener.cancel()
+            await asyncio.gather(*listeners, return_exceptions=True)
+            for group, own, other in calls:
+                await sender.group_discard(group, own)
+                await peer.group_discard(group, other)
+            await sender.flush()
+            if peer is not sender:
+                await peer.close_pools()
+
+        return {
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'rate': options['messages'] / elapsed,
+            'commands': commands / options['messages'],
+        }
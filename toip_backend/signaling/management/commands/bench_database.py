@@ -0,0 +1,181 @@
+"""
+Banc d'écriture concurrente de la base de signalisation
+
+Reproduit la charge des consommateurs sur la table des messages de
+signalisation : --writers threads insèrent chacun --messages messages (une
+insertion validée à chaque fois, comme save_signaling_message), pendant
+que --readers threads relèvent et marquent comme traités les messages d'un
+destinataire (comme poll_messages). Chaque thread a sa propre connexion.
+
+Cibles (--target, plusieurs possibles) :
+  - sqlite-default : fichier SQLite temporaire, réglages par défaut de Django
+    (journal de rollback, transactions différées) ;
+  - sqlite-tuned : fichier SQLite temporaire avec SQLITE_OPTIONS (WAL,
+    synchronous=NORMAL, transactions IMMEDIATE, attente du verrou) ;
+  - configured : la base configurée (PostgreSQL et son pool si POSTGRES_DB
+    est défini) ; les données du banc y sont supprimées à la fin.
+Par défaut : les deux cibles SQLite, plus configured sous PostgreSQL.
+
+Résultats par cible : messages écrits par seconde, latences d'insertion
+p50/p99/max et erreurs (« database is locked » au-delà de l'attente).
+"""
+import itertools
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connections
+
+from calls.models import Call, CallParticipant
+from signaling.models import SignalingMessage
+from users.models import User
+
+BENCH_USER_PREFIX = 'bench_db_'
+FAKE_CANDIDATE = {'candidate': 'candidate:842163049 1 udp 1677729535 203.0.113.7 50000 typ srflx '
+                               'raddr 10.0.0.5 rport 50000 generation 0', 'sdpMid': '0', 'sdpMLineIndex': 0}
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class Command(BaseCommand):
+    help = "Compare le débit d'écriture concurrente des profils de base de données (SQLite, PostgreSQL)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', choices=['sqlite-default', 'sqlite-tuned', 'configured'])
+        parser.add_argument('--writers', type=int, default=16, help="threads d'écriture (consommateurs)")
+        parser.add_argument('--readers', type=int, default=4, help="threads de relève (poll_messages)")
+        parser.add_argument('--messages', type=int, default=250, help="messages écrits par thread")
+
+    def handle(self, *args, **options):
+        targets = options['target']
+        if not targets:
+            targets = ['sqlite-default', 'sqlite-tuned']
+            if connections['default'].vendor == 'postgresql':
+                targets.append('configured')
+
+        directory = tempfile.mkdtemp(prefix='bench_database_')
+        try:
+            for target in targets:
+                alias = self.prepare(target, directory)
+                self.run(target, alias, options)
+        finally:
+            for alias in ('bench_sqlite_default', 'bench_sqlite_tuned'):
+                if alias in connections.settings:
+                    connections[alias].close()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def prepare(self, target, directory):
+        """Alias de la base de la cible ; les fichiers SQLite temporaires sont migrés"""
+        if target == 'configured':
+            return 'default'
+        alias = 'bench_' + target.replace('-', '_')
+        connections.settings[alias] = {
+            **connections.settings['default'],
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': f'{directory}/{alias}.sqlite3',
+            'CONN_MAX_AGE': 0,
+            'OPTIONS': dict(settings.SQLITE_OPTIONS) if target == 'sqlite-tuned' else {},
+        }
+        call_command('migrate', database=alias, verbosity=0, interactive=False)
+        return alias
+
+    def create_fixtures(self, alias, count):
+        """Un appel de groupe par paire (écrivain, destinataire relevé)"""
+        User.objects.using(alias).filter(username__startswith=BENCH_USER_PREFIX).delete()
+        users = User.objects.using(alias).bulk_create([
+            User(username=f'{BENCH_USER_PREFIX}{index}', password='!') for index in range(count + 1)
+        ])
+        calls = Call.objects.using(alias).bulk_create([
+            Call(initiator=users[0], call_type='audio', is_group_call=True, status='in_progress')
+            for _ in range(count)
+        ])
+        CallParticipant.objects.using(alias).bulk_create(
+            [CallParticipant(call=call, user=user, has_accepted=True) for call, user in zip(calls, users[1:])])
+        return users[0], list(zip(calls, users[1:]))
+
+    def run(self, target, alias, options):
+        sender, pairs = self.create_fixtures(alias, max(options['writers'], options['readers']))
+        latencies = []
+        errors = []
+        done = threading.Event()
+        start = threading.Barrier(options['writers'] + options['readers'] + 1)
+
+        def write(call, receiver):
+            local_latencies = []
+            start.wait()
+            try:
+                for _ in range(options['messages']):
+                    began = time.perf_counter()
+                    try:
+                        SignalingMessage.objects.using(alias).create(
+                            call=call, sender=sender, receiver=receiver,
+                            message_type='ice-candidate', content={'candidate': FAKE_CANDIDATE})
+                    except DatabaseError as e:
+                        errors.append(e)
+                        continue
+                    local_latencies.append(time.perf_counter() - began)
+            finally:
+                latencies.extend(local_latencies)
+                connections[alias].close()
+
+        def poll(call, receiver):
+            start.wait()
+            try:
+                while not done.is_set():
+                    pending = list(SignalingMessage.objects.using(alias).filter(
+                        call=call, receiver=receiver, is_processed=False).values_list('id', flat=True))
+                    try:
+                        if pending:
+                            SignalingMessage.objects.using(alias).filter(id__in=pending).update(is_processed=True)
+                    except DatabaseError as e:
+                        errors.append(e)
+                    time.sleep(0.005)
+            finally:
+                connections[alias].close()
+
+        writers = [threading.Thread(target=write, args=pair) for pair in pairs[:options['writers']]]
+        readers = [threading.Thread(target=poll, args=pair) for pair in itertools.islice(pairs, options['readers'])]
+        for thread in writers + readers:
+            thread.start()
+        start.wait()
+        began = time.perf_counter()
+        for thread in writers:
+            thread.join()
+        elapsed = time.perf_counter() - began
+        done.set()
+        for thread in readers:
+            thread.join()
+
+        try:
+            self.report(target, alias, options, latencies, errors, elapsed)
+        finally:
+            User.objects.using(alias).filter(username__startswith=BENCH_USER_PREFIX).delete()
+
+    def report(self, target, alias, options, latencies, errors, elapsed):
+        connection = connections[alias]
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                journal = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+            mode = f"journal {journal}, transactions {connection.transaction_mode or 'DEFERRED'}"
+        else:
+            pool = connection.settings_dict['OPTIONS'].get('pool')
+            mode = f"pool {pool}" if pool else f"CONN_MAX_AGE {connection.settings_dict['CONN_MAX_AGE']}"
+        written = len(latencies)
+        expected = options['writers'] * options['messages']
+        self.stdout.write(f"cible                    {target} ({connection.vendor}, {mode})")
+        self.stdout.write(f"threads                  {options['writers']} écrivains, {options['readers']} relèves")
+        self.stdout.write(f"messages écrits          {written}/{expected} en {elapsed:.2f} s ({written / elapsed:.0f}/s)")
+        self.stdout.write(f"latence d'insertion      p50 {percentile(latencies, 50) * 1000:.2f}  "
+                          f"p99 {percentile(latencies, 99) * 1000:.2f}  max {max(latencies, default=0) * 1000:.2f} ms")
+        self.stdout.write(f"erreurs                  {len(errors)}"
+                          + (f" (dernière : {errors[-1]})" if errors else ''))
+        self.stdout.write('')
@@ -0,0 +1,127 @@
+"""
+Banc d'essai de la répartition de la couche de canaux (ShardedChannelLayer)
+
+1. Déplacements : part des groupes call_* / user_* qui changent d'instance
+   quand on passe de k à k+1 instances, avec l'anneau de signaling.sharding
+   et avec le modulo de channels_redis.
+2. Débit : pour k = 1..N instances (--hosts), --workers processus relaient
+   des messages dans des groupes d'appel dont le pair est une autre instance
+   de la couche (--peers instances par processus, comme autant de workers
+   daphne), pendant --seconds secondes. Pour chaque k : messages/s mesurés,
+   et part des commandes et du temps CPU de l'instance Redis la plus chargée
+   (INFO). Le débit atteignable quand chaque instance a son propre cœur est
+   limité par cette instance : 1 / part maximale.
+
+Instances locales : docker compose --profile sharding up (ports 6380 à 6382).
+Les clés du banc utilisent un préfixe dédié et expirent d'elles-mêmes.
+"""
+import asyncio
+import multiprocessing
+import time
+import uuid
+
+import redis
+from channels_redis.utils import _consistent_hash
+from django.core.management.base import BaseCommand, CommandError
+
+from signaling.layers import ShardedChannelLayer
+from signaling.sharding import HashRing, moved_fraction
+
+BENCH_PREFIX = 'bench_shard'
+DEFAULT_HOSTS = ['redis://127.0.0.1:6380', 'redis://127.0.0.1:6381', 'redis://127.0.0.1:6382']
+
+
+async def relay_calls(hosts, calls, peers, seconds):
+    """Relaie des messages dans calls groupes jusqu'à l'échéance ; retourne le nombre de messages reçus"""
+    sender = ShardedChannelLayer(hosts=hosts, prefix=BENCH_PREFIX)
+    receivers = [ShardedChannelLayer(hosts=hosts, prefix=BENCH_PREFIX) for _ in range(peers)]
+    members = []
+    for index in range(calls):
+        layer = receivers[index % peers]
+        group = f"{'call' if index % 2 == 0 else 'user'}_{uuid.uuid4().hex[:12]}"
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        members.append((group, layer, channel))
+
+    deadline = time.perf_counter() + seconds
+
+    async def relay(group, layer, channel):
+        count = 0
+        while time.perf_counter() < deadline:
+            await sender.group_send(group, {'type': 'signaling.message', 'seq': count})
+            await layer.receive(channel)
+            count += 1
+        return count
+
+    try:
+        counts = await asyncio.gather(*(relay(*member) for member in members))
+    finally:
+        for group, layer, channel in members:
+            await layer.group_discard(group, channel)
+        for layer in [sender, *receivers]:
+            await layer.close_pools()
+    return sum(counts)
+
+
+def run_worker(hosts, calls, peers, seconds):
+    return asyncio.run(relay_calls(hosts, calls, peers, seconds))
+
+
+def shard_stats(client):
+    info = client.info()
+    return info['total_commands_processed'], info['used_cpu_user'] + info['used_cpu_sys']
+
+
+class Command(BaseCommand):
+    help = "Mesure les déplacements de groupes et le débit de la couche de canaux répartie sur plusieurs Redis"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hosts', nargs='+', default=DEFAULT_HOSTS, help="URL redis:// des instances")
+        parser.add_argument('--workers', type=int, default=4, help="processus émetteurs")
+        parser.add_argument('--calls', type=int, default=50, help="appels (groupes) par processus")
+        parser.add_argument('--peers', type=int, default=16, help="instances de couche réceptrices par processus")
+        parser.add_argument('--seconds', type=float, default=5.0)
+        parser.add_argument('--groups', type=int, default=20000, help="groupes pour le calcul des déplacements")
+
+    def handle(self, *args, **options):
+        self.report_moves(options['groups'], max(len(options['hosts']), 8))
+        self.report_throughput(options)
+
+    def report_moves(self, groups, max_shards):
+        keys = [f'{kind}_{index}' for index in range(groups // 2) for kind in ('call', 'user')]
+        nodes = [f'redis://shard-{index}:6379' for index in range(max_shards)]
+        self.stdout.write("instances   groupes déplacés : anneau   modulo   idéal")
+        for count in range(1, max_shards):
+            before, after = HashRing(nodes[:count]), HashRing(nodes[:count + 1])
+            ring = moved_fraction(before.node, after.node, keys)
+            modulo = moved_fraction(lambda key: _consistent_hash(key, count),
+                                    lambda key: _consistent_hash(key, count + 1), keys)
+            self.stdout.write(f"{count} -> {count + 1:<3} {ring:24.1%} {modulo:8.1%} {1 / (count + 1):7.1%}")
+        self.stdout.write("")
+
+    def report_throughput(self, options):
+        hosts = options['hosts']
+        clients = [redis.Redis.from_url(host) for host in hosts]
+        self.stdout.write("instances   messages/s   gain mesuré   part max. commandes   part max. CPU   gain atteignable")
+        baseline = None
+        for count in range(1, len(hosts) + 1):
+            try:
+                before = [shard_stats(client) for client in clients[:count]]
+                with multiprocessing.Pool(options['workers']) as pool:
+                    received = pool.starmap(run_worker, [
+                        (hosts[:count], options['calls'], options['peers'], options['seconds'])
+                    ] * options['workers'])
+                after = [shard_stats(client) for client in clients[:count]]
+            except (redis.RedisError, OSError) as e:
+                raise CommandError(f"Redis injoignable ({', '.join(hosts[:count])}): {e}")
+
+            rate = sum(received) / options['seconds']
+            commands = [end[0] - start[0] for start, end in zip(before, after)]
+            cpu = [end[1] - start[1] for start, end in zip(before, after)]
+            command_share = max(commands) / sum(commands)
+            cpu_share = max(cpu) / sum(cpu) if sum(cpu) else 1.0
+            baseline = baseline or rate
+            # Une instance par cœur : le débit suit l'inverse de la charge de la plus sollicitée
+            self.stdout.write(
+                f"{count:<11} {rate:10.0f} {rate / baseline:12.2f}x {command_share:21.1%} {cpu_share:15.1%} "
+                f"{1 / command_share:17.2f}x")
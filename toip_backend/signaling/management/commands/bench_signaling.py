@@ -0,0 +1,416 @@
+"""
+Banc de charge de la signalisation WebSocket
+
+Crée des utilisateurs (avec jeton), des appels 1:1 et des appels de groupe
+synthétiques, puis fait jouer à chaque participant le scénario d'un appel
+réel sur ws/incoming-calls/ et ws/signaling/<call_id>/ (authentification par
+?token=, via TokenAuthMiddleware) :
+  1. connexion aux notifications d'appel entrant, puis à la signalisation
+     pour l'initiateur ;
+  2. notification incoming_call des autres participants (groupe user_<id>),
+     qui rejoignent alors la signalisation ;
+  3. offre de chaque participant vers ceux qui le suivent, réponses, puis
+     échange de --candidates candidats ICE dans chaque sens (maillage
+     complet dans les appels de groupe).
+
+Deux cibles :
+  - par défaut, l'application de daphne_asgi.py tourne dans ce processus,
+    avec la couche de canaux choisie (--layer memory : InMemoryChannelLayer,
+    --layer redis : CHANNEL_LAYERS) ;
+  - --url ws://127.0.0.1:8000 : un serveur local déjà démarré, partageant
+    cette base de données (et cette couche de canaux Redis pour les
+    notifications, absentes avec --layer memory).
+
+Résultats : messages relayés par seconde, latences p50/p99/p99.9 de relais
+(envoi -> réception par le destinataire), de connexion et de notification,
+et requêtes SQL par message relayé (cible en processus seulement). Les
+données du banc (utilisateurs BENCH_USER_PREFIX*) sont supprimées à la fin.
+"""
+import asyncio
+import base64
+import contextlib
+import contextvars
+import io
+import itertools
+import json
+import os
+import struct
+import time
+from urllib.parse import urlsplit
+
+from channels.layers import get_channel_layer
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db.backends.utils import CursorWrapper
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+
+from calls.models import Call, CallParticipant
+from signaling import replay
+from users.models import User
+
+BENCH_USER_PREFIX = 'bench_ws_'
+TIMEOUT = 30
+
+FAKE_SDP = 'v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n' + (
+    'a=rtpmap:111 opus/48000/2\r\na=fmtp:111 minptime=10;useinbandfec=1\r\n' * 40)
+FAKE_CANDIDATE = ('candidate:842163049 1 udp 1677729535 203.0.113.7 {port} typ srflx '
+                  'raddr 10.0.0.5 rport {port} generation 0')
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class QueryCounter:
+    """Compte les requêtes SQL de tous les threads (database_sync_to_async compris)"""
+
+    def __init__(self):
+        self.count = 0
+        self._patched = []
+
+    def __enter__(self):
+        for name in ('execute', 'executemany'):
+            original = getattr(CursorWrapper, name)
+
+            def counted(cursor, *args, _original=original, **kwargs):
+                self.count += 1
+                return _original(cursor, *args, **kwargs)
+
+            setattr(CursorWrapper, name, counted)
+            self._patched.append((name, original))
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self._patched:
+            setattr(CursorWrapper, name, original)
+        self._patched = []
+
+
+class AsgiConnection:
+    """Connexion WebSocket à l'application ASGI exécutée dans ce processus"""
+
+    def __init__(self, application, path, query):
+        self.application = application
+        self.scope = {
+            'type': 'websocket', 'path': f'/{path}', 'raw_path': f'/{path}'.encode(),
+            'query_string': query.encode(), 'headers': [(b'host', b'localhost')],
+            'subprotocols': [], 'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 80),
+        }
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        self.task = None
+
+    async def connect(self):
+        # Contexte vide, comme pour une connexion reçue par daphne
+        self.task = contextvars.Context().run(
+            asyncio.create_task, self.application(self.scope, self.incoming.get, self.outgoing.put))
+        await self.incoming.put({'type': 'websocket.connect'})
+        message = await self.outgoing.get()
+        return message['type'] == 'websocket.accept'
+
+    async def send(self, text):
+        await self.incoming.put({'type': 'websocket.receive', 'text': text})
+
+    async def receive(self):
+        message = await self.outgoing.get()
+        if message['type'] == 'websocket.send':
+            return message.get('text')
+        return None
+
+    async def close(self):
+        if self.task is None or self.task.done():
+            return
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        try:
+            await asyncio.wait_for(self.task, TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+
+class SocketConnection:
+    """Client WebSocket minimal (RFC 6455, ws:// seulement) pour un serveur local"""
+
+    def __init__(self, url, path, query):
+        parts = urlsplit(url)
+        if parts.scheme != 'ws':
+            raise CommandError("Seules les URL ws:// sont prises en charge")
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.target = f"{parts.path.rstrip('/')}/{path}?{query}"
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write((
+            f'GET {self.target} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n'
+            f'Origin: http://{self.host}:{self.port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+        response = await self.reader.readuntil(b'\r\n\r\n')
+        return response.startswith(b'HTTP/1.1 101')
+
+    def _frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        mask = os.urandom(4)
+        repeated = (mask * (length // 4 + 1))[:length]
+        masked = (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+        return header + mask + masked
+
+    async def send(self, text):
+        self.writer.write(self._frame(0x1, text.encode()))
+        await self.writer.drain()
+
+    async def receive(self):
+        fragments = []
+        try:
+            while True:
+                first, second = await self.reader.readexactly(2)
+                length = second & 0x7F
+                if length == 126:
+                    length, = struct.unpack('!H', await self.reader.readexactly(2))
+                elif length == 127:
+                    length, = struct.unpack('!Q', await self.reader.readexactly(8))
+                payload = await self.reader.readexactly(length)
+                opcode = first & 0x0F
+                if opcode == 0x8:
+                    return None
+                if opcode == 0x9:
+                    self.writer.write(self._frame(0xA, payload))
+                    continue
+                if opcode in (0x0, 0x1, 0x2):
+                    fragments.append(payload)
+                    if first & 0x80:
+                        return b''.join(fragments).decode()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def close(self):
+        if self.writer is None or self.writer.is_closing():
+            return
+        try:
+            self.writer.write(self._frame(0x8, struct.pack('!H', 1000)))
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+class BenchClient:
+    """Un participant : ses deux WebSockets et les messages du banc reçus, par type"""
+
+    def __init__(self, bench, user, token):
+        self.bench = bench
+        self.user = user
+        self.token = token
+        self.signaling = None
+        self.incoming = None
+        self.readers = []
+        self.received = {}
+        self.changed = asyncio.Event()
+
+    async def open(self, path):
+        connection = self.bench.connection(path, f'token={self.token}')
+        started = time.perf_counter()
+        if not await connection.connect():
+            self.bench.rejected += 1
+            raise ConnectionError(f"connexion refusée : {path}")
+        self.bench.connect_latencies.append(time.perf_counter() - started)
+        self.readers.append(asyncio.ensure_future(self.read(connection)))
+        return connection
+
+    async def read(self, connection):
+        while True:
+            text = await connection.receive()
+            if text is None:
+                return
+            now = time.perf_counter()
+            message = json.loads(text)
+            if message.get('type') == 'incoming_call':
+                sent_at = message['call'].get('benchSentAt')
+                if sent_at is not None:
+                    self.bench.notify_latencies.append(now - sent_at)
+            elif 'benchSentAt' in message:
+                self.bench.relay_latencies.append(now - message['benchSentAt'])
+            else:
+                continue
+            self.received[message['type']] = self.received.get(message['type'], 0) + 1
+            self.changed.set()
+
+    async def wait_for(self, message_type, count):
+        async def reached():
+            while self.received.get(message_type, 0) < count:
+                self.changed.clear()
+                await self.changed.wait()
+        await asyncio.wait_for(reached(), TIMEOUT)
+
+    async def send(self, message_type, receiver, **content):
+        await self.signaling.send(json.dumps({
+            'type': message_type, 'receiver': receiver.user.id, 'sender': self.user.id,
+            'benchSentAt': time.perf_counter(), **content,
+        }))
+        self.bench.sent += 1
+
+    async def close(self):
+        for connection in (self.signaling, self.incoming):
+            if connection is not None:
+                await connection.close()
+        for reader in self.readers:
+            reader.cancel()
+        await asyncio.gather(*self.readers, return_exceptions=True)
+
+
+class Command(BaseCommand):
+    help = "Banc de charge de la signalisation WebSocket (appels 1:1 et de groupe synthétiques)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200, help="appels 1:1")
+        parser.add_argument('--group-calls', type=int, default=20)
+        parser.add_argument('--group-size', type=int, default=4)
+        parser.add_argument('--candidates', type=int, default=4, help="candidats ICE par sens et par paire")
+        parser.add_argument('--concurrency', type=int, default=100, help="appels simultanés au plus")
+        parser.add_argument('--layer', choices=['memory', 'redis'], default='memory')
+        parser.add_argument('--url', help="serveur local (ws://hôte:port) au lieu de l'application en processus")
+
+    def handle(self, *args, **options):
+        layers = None
+        if options['layer'] == 'memory':
+            layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 1000}}}
+        self.url = options['url']
+        self.application = None
+        if not self.url:
+            from daphne_asgi import application
+            self.application = application
+
+        rooms = self.create_fixtures(options)
+        try:
+            with override_settings(**({'CHANNEL_LAYERS': layers} if layers else {})):
+                # Les consommateurs écrivent sur la sortie standard : elle est mise de côté
+                with contextlib.redirect_stdout(io.StringIO()), QueryCounter() as queries:
+                    elapsed = asyncio.run(self.run(rooms, options))
+        finally:
+            self.delete_fixtures(rooms)
+        self.report(rooms, options, elapsed, None if options['url'] else queries.count)
+
+    def create_fixtures(self, options):
+        """[(appel, [(utilisateur, jeton)])] : initiateur en premier"""
+        User.objects.filter(username__startswith=BENCH_USER_PREFIX).delete()
+        sizes = [2] * options['calls'] + [options['group_size']] * options['group_calls']
+        password = make_password(None)
+        users = User.objects.bulk_create([
+            User(username=f'{BENCH_USER_PREFIX}{index}', password=password)
+            for index in range(sum(sizes))
+        ])
+        tokens = Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in users])
+        members = iter(zip(users, (token.key for token in tokens)))
+        rooms = [[next(members) for _ in range(size)] for size in sizes]
+        calls = Call.objects.bulk_create([
+            Call(initiator=room[0][0], call_type='audio', is_group_call=len(room) > 2, status='in_progress')
+            for room in rooms
+        ])
+        CallParticipant.objects.bulk_create([
+            CallParticipant(call=call, user=user, has_accepted=True)
+            for call, room in zip(calls, rooms) for user, _ in room[1:]
+        ])
+        return list(zip(calls, rooms))
+
+    def delete_fixtures(self, rooms):
+        for call, _ in rooms:
+            replay.clear_call(call.id)
+        User.objects.filter(username__startswith=BENCH_USER_PREFIX).delete()
+
+    def connection(self, path, query):
+        if self.url:
+            return SocketConnection(self.url, path, query)
+        return AsgiConnection(self.application, path, query)
+
+    async def run(self, rooms, options):
+        self.notify = not (options['url'] and options['layer'] == 'memory')
+        self.connect_latencies, self.relay_latencies, self.notify_latencies = [], [], []
+        self.sent = self.rejected = self.failed = 0
+        limit = asyncio.Semaphore(options['concurrency'])
+
+        async def limited(call, room):
+            async with limit:
+                await self.run_call(call, room, options['candidates'])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(call, room) for call, room in rooms))
+        elapsed = time.perf_counter() - started
+        layer = get_channel_layer()
+        if hasattr(layer, 'close_pools'):
+            await layer.close_pools()
+        return elapsed
+
+    async def run_call(self, call, room, candidates):
+        clients = [BenchClient(self, user, token) for user, token in room]
+        initiator, others = clients[0], clients[1:]
+        try:
+            for client in clients:
+                client.incoming = await client.open('ws/incoming-calls/')
+            initiator.signaling = await initiator.open(f'ws/signaling/{call.id}/')
+            if self.notify:
+                layer = get_channel_layer()
+                for client in others:
+                    await layer.group_send(f'user_{client.user.id}', {
+                        'type': 'incoming_call',
+                        'call': {'id': call.id, 'call_type': call.call_type, 'is_group_call': call.is_group_call,
+                                 'initiator': initiator.user.id, 'benchSentAt': time.perf_counter()},
+                    })
+                await asyncio.gather(*(client.wait_for('incoming_call', 1) for client in others))
+            for client in others:
+                client.signaling = await client.open(f'ws/signaling/{call.id}/')
+
+            # Chaque participant fait une offre à ceux qui le suivent et répond à ceux qui le précèdent
+            pairs = list(itertools.combinations(clients, 2))
+            for caller, callee in pairs:
+                await caller.send('offer', callee, sdp={'type': 'offer', 'sdp': FAKE_SDP})
+            await asyncio.gather(*(client.wait_for('offer', index) for index, client in enumerate(clients)))
+            for caller, callee in pairs:
+                await callee.send('answer', caller, sdp={'type': 'answer', 'sdp': FAKE_SDP})
+            await asyncio.gather(*(
+                client.wait_for('answer', len(clients) - 1 - index) for index, client in enumerate(clients)))
+            for number in range(candidates):
+                for first, second in pairs:
+                    for sender, receiver in ((first, second), (second, first)):
+                        await sender.send('ice-candidate', receiver, candidate={
+                            'candidate': FAKE_CANDIDATE.format(port=50000 + number),
+                            'sdpMid': '0', 'sdpMLineIndex': 0,
+                        })
+            await asyncio.gather(*(
+                client.wait_for('ice-candidate', candidates * (len(clients) - 1)) for client in clients))
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            self.failed += 1
+        finally:
+            for client in clients:
+                await client.close()
+
+    def report(self, rooms, options, elapsed, queries):
+        relayed = len(self.relay_latencies)
+        sockets = sum(2 * len(room) for _, room in rooms)
+        target = options['url'] or f"en processus, couche {options['layer']}"
+        self.stdout.write(f"cible                    {target}")
+        self.stdout.write(f"appels                   {options['calls']} 1:1, {options['group_calls']} de groupe "
+                          f"({options['group_size']} participants), {options['concurrency']} simultanés au plus")
+        self.stdout.write(f"WebSockets               {sockets} ({self.rejected} refusées), "
+                          f"{self.failed} appel(s) en échec")
+        self.stdout.write(f"messages relayés         {relayed}/{self.sent} en {elapsed:.2f} s "
+                          f"({relayed / elapsed:.0f}/s)")
+        for label, values in (('latence de relais', self.relay_latencies),
+                              ('latence de connexion', self.connect_latencies),
+                              ('latence de notification', self.notify_latencies)):
+            if values:
+                self.stdout.write(
+                    f"{label:<24} p50 {percentile(values, 50) * 1000:.2f}  p99 {percentile(values, 99) * 1000:.2f}  "
+                    f"p99.9 {percentile(values, 99.9) * 1000:.2f} ms")
+        if queries is not None and relayed:
+            self.stdout.write(f"requêtes SQL / message   {queries / relayed:.2f} "
+                              f"({queries} au total, connexions comprises)")
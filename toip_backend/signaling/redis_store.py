@@ -0,0 +1,45 @@
+"""
+Clients Redis partagés par l'état de signalisation (tampon de rejeu, registre des salles)
+
+Ces données sont conservées hors de la couche de canaux : elles doivent être
+lisibles par tous les workers et par les vues REST.
+"""
+import asyncio
+import weakref
+
+import redis
+import redis.asyncio
+from django.conf import settings
+
+REDIS_URL = getattr(settings, 'SIGNALING_REDIS_URL', 'redis://127.0.0.1:6379/0')
+# Connexions par boucle asyncio ; au-delà, une commande attend une connexion libre (POOL_TIMEOUT secondes)
+MAX_CONNECTIONS = getattr(settings, 'SIGNALING_REDIS_MAX_CONNECTIONS', 100)
+POOL_TIMEOUT = getattr(settings, 'SIGNALING_REDIS_POOL_TIMEOUT', 2)
+# Erreurs traitées comme une indisponibilité de Redis
+REDIS_ERRORS = (redis.RedisError, OSError)
+
+_async_clients = weakref.WeakKeyDictionary()
+_sync_client = None
+
+
+def call_prefix(call_id):
+    # Étiquette {call_N} : toutes les clés d'un appel sur le même nœud en mode cluster
+    return f'signaling:{{call_{call_id}}}'
+
+
+def get_async_client():
+    """Un client par boucle asyncio (les connexions redis.asyncio y sont liées)"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        pool = redis.asyncio.BlockingConnectionPool.from_url(
+            REDIS_URL, max_connections=MAX_CONNECTIONS, timeout=POOL_TIMEOUT, socket_connect_timeout=1)
+        client = _async_clients[loop] = redis.asyncio.Redis(connection_pool=pool)
+    return client
+
+
+def get_sync_client():
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = redis.Redis.from_url(REDIS_URL, socket_connect_timeout=1)
+    return _sync_client
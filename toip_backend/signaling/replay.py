@@ -0,0 +1,110 @@
+"""
+Tampon de rejeu de la signalisation WebSocket
+
+Chaque message relayé à un participant reçoit un numéro de séquence propre à
+ce destinataire et est conservé dans un anneau borné (sorted set Redis, score
+= séquence) par (appel, destinataire). Un client qui se reconnecte avec
+?last_seq=N reçoit les messages manqués depuis Redis, sans requête SQL.
+Les clés expirent d'elles-mêmes (SIGNALING_REPLAY_TTL) et sont supprimées à
+la fin de l'appel.
+
+Le rejeu est un complément : si Redis est indisponible, les messages sont
+relayés sans numéro de séquence et le client se rabat sur poll_messages.
+"""
+import json
+
+from django.conf import settings
+
+from monitoring.logs import get_logger
+from .redis_store import REDIS_ERRORS, call_prefix, get_async_client, get_sync_client
+
+logger = get_logger('signaling')
+
+REPLAY_SIZE = getattr(settings, 'SIGNALING_REPLAY_SIZE', 200)
+REPLAY_TTL = getattr(settings, 'SIGNALING_REPLAY_TTL', 6 * 3600)
+
+# Ajout atomique d'un message aux anneaux de plusieurs destinataires.
+# KEYS : ensemble des destinataires de l'appel, puis (anneau, compteur) par destinataire
+# ARGV : message JSON, taille de l'anneau, TTL, puis l'identifiant de chaque destinataire
+APPEND_SCRIPT = """
+local seqs = {}
+for i = 2, #KEYS, 2 do
+    local seq = redis.call('INCR', KEYS[i + 1])
+    redis.call('ZADD', KEYS[i], seq, seq .. ':' .. ARGV[1])
+    redis.call('ZREMRANGEBYRANK', KEYS[i], 0, -(tonumber(ARGV[2]) + 1))
+    redis.call('EXPIRE', KEYS[i], ARGV[3])
+    redis.call('EXPIRE', KEYS[i + 1], ARGV[3])
+    redis.call('SADD', KEYS[1], ARGV[3 + i / 2])
+    seqs[#seqs + 1] = seq
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return seqs
+"""
+
+
+def receivers_key(call_id):
+    return f'{call_prefix(call_id)}:receivers'
+
+
+def ring_key(call_id, user_id):
+    return f'{call_prefix(call_id)}:ring:{user_id}'
+
+
+def seq_key(call_id, user_id):
+    return f'{call_prefix(call_id)}:seq:{user_id}'
+
+
+async def append(call_id, user_ids, message):
+    """Ajoute le message à l'anneau de chaque destinataire ; retourne {str(user_id): seq}"""
+    user_ids = [str(user_id) for user_id in user_ids]
+    if not user_ids:
+        return {}
+    keys = [receivers_key(call_id)]
+    for user_id in user_ids:
+        keys += [ring_key(call_id, user_id), seq_key(call_id, user_id)]
+    try:
+        seqs = await get_async_client().eval(
+            APPEND_SCRIPT, len(keys), *keys, json.dumps(message), REPLAY_SIZE, REPLAY_TTL, *user_ids)
+    except REDIS_ERRORS as e:
+        logger.warning('replay.unavailable', call_id=call_id, error=e)
+        return {}
+    return dict(zip(user_ids, seqs))
+
+
+async def since(call_id, user_id, last_seq):
+    """
+    Messages de séquence > last_seq, sous forme [(seq, message)], et un booléen
+    indiquant si le rejeu est complet (False si des messages ont quitté l'anneau)
+    """
+    ring = ring_key(call_id, user_id)
+    try:
+        async with get_async_client().pipeline(transaction=True) as pipe:
+            pipe.zrange(ring, 0, 0, withscores=True)
+            pipe.zrangebyscore(ring, f'({last_seq}', '+inf')
+            pipe.get(seq_key(call_id, user_id))
+            oldest, entries, current = await pipe.execute()
+    except REDIS_ERRORS as e:
+        logger.warning('replay.unavailable', call_id=call_id, error=e)
+        return [], False
+
+    current = int(current or 0)
+    messages = []
+    for entry in entries:
+        seq, _, payload = entry.decode().partition(':')
+        messages.append((int(seq), json.loads(payload)))
+    complete = current >= last_seq and (
+        current == last_seq or (bool(oldest) and int(oldest[0][1]) <= last_seq + 1))
+    return messages, complete
+
+
+def clear_call(call_id):
+    """Supprime les anneaux d'un appel terminé (appelé depuis les vues synchrones)"""
+    client = get_sync_client()
+    try:
+        user_ids = [user_id.decode() for user_id in client.smembers(receivers_key(call_id))]
+        keys = [receivers_key(call_id)]
+        for user_id in user_ids:
+            keys += [ring_key(call_id, user_id), seq_key(call_id, user_id)]
+        client.delete(*keys)
+    except REDIS_ERRORS as e:
+        logger.warning('replay.unavailable', call_id=call_id, error=e)
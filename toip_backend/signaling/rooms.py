@@ -0,0 +1,162 @@
+"""
+Registre des salles d'appel partagé entre workers
+
+Trois clés Redis par appel, mises à jour à la connexion et à la déconnexion
+des WebSockets de signalisation :
+    connections : nom de canal -> {"userId", "joinedAt"}
+    members     : id utilisateur -> nombre de connexions ouvertes
+    alive       : nom de canal -> échéance (ensemble trié, secondes Redis)
+Présence d'un utilisateur (HEXISTS) et nombre de membres (HLEN) sont en
+O(1). Chaque consommateur prolonge l'échéance de sa connexion toutes les
+ROOM_HEARTBEAT secondes ; les connexions dont l'échéance est passée (worker
+arrêté brutalement) sont retirées par chaque script avant lecture ou
+écriture, en O(log n) quand rien n'a expiré. Les clés sont supprimées quand
+la dernière connexion part, et expirent avec la dernière échéance.
+"""
+import json
+import time
+
+from django.conf import settings
+
+from monitoring.logs import get_logger
+from .redis_store import REDIS_ERRORS, call_prefix, get_async_client, get_sync_client
+
+logger = get_logger('signaling')
+
+ROOM_TTL = getattr(settings, 'SIGNALING_ROOM_TTL', 90)
+ROOM_HEARTBEAT = getattr(settings, 'SIGNALING_ROOM_HEARTBEAT', 30)
+
+# KEYS : connections, members, alive. Retire les connexions expirées
+PRUNE = """
+local now = tonumber(redis.call('TIME')[1])
+for _, channel in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)) do
+    local entry = redis.call('HGET', KEYS[1], channel)
+    if entry then
+        redis.call('HDEL', KEYS[1], channel)
+        local user = cjson.decode(entry)['userId']
+        if redis.call('HINCRBY', KEYS[2], user, -1) <= 0 then
+            redis.call('HDEL', KEYS[2], user)
+        end
+    end
+    redis.call('ZREM', KEYS[3], channel)
+end
+"""
+
+# ARGV : canal, utilisateur, entrée JSON, TTL. Aussi appelé par le battement de
+# cœur du consommateur : prolonge l'échéance, ou réinscrit une connexion retirée
+JOIN_SCRIPT = PRUNE + """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[3]) == 1 then
+    redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+end
+redis.call('ZADD', KEYS[3], now + ARGV[4], ARGV[1])
+for _, key in ipairs(KEYS) do
+    redis.call('EXPIRE', key, ARGV[4])
+end
+return redis.call('HLEN', KEYS[2])
+"""
+
+# ARGV : canal, utilisateur
+LEAVE_SCRIPT = PRUNE + """
+redis.call('ZREM', KEYS[3], ARGV[1])
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 1 then
+    if redis.call('HINCRBY', KEYS[2], ARGV[2], -1) <= 0 then
+        redis.call('HDEL', KEYS[2], ARGV[2])
+    end
+end
+if redis.call('HLEN', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+end
+return redis.call('HLEN', KEYS[2])
+"""
+
+# ARGV : utilisateur
+IS_MEMBER_SCRIPT = PRUNE + "return redis.call('HEXISTS', KEYS[2], ARGV[1])"
+MEMBER_COUNT_SCRIPT = PRUNE + "return redis.call('HLEN', KEYS[2])"
+CONNECTIONS_SCRIPT = PRUNE + "return redis.call('HGETALL', KEYS[1])"
+
+
+def connections_key(call_id):
+    return f'{call_prefix(call_id)}:connections'
+
+
+def members_key(call_id):
+    return f'{call_prefix(call_id)}:members'
+
+
+def alive_key(call_id):
+    return f'{call_prefix(call_id)}:alive'
+
+
+def _keys(call_id):
+    return [connections_key(call_id), members_key(call_id), alive_key(call_id)]
+
+
+async def join(call_id, user_id, channel_name):
+    """
+    Enregistre ou prolonge une connexion ; retourne le nombre de membres
+    présents (None si Redis est indisponible)
+    """
+    entry = json.dumps({'userId': user_id, 'joinedAt': time.time()})
+    try:
+        return await get_async_client().eval(
+            JOIN_SCRIPT, 3, *_keys(call_id), channel_name, user_id, entry, ROOM_TTL)
+    except REDIS_ERRORS as e:
+        logger.warning('rooms.unavailable', call_id=call_id, error=e)
+        return None
+
+
+async def leave(call_id, user_id, channel_name):
+    """Retire une connexion ; retourne le nombre de membres restants (None si Redis est indisponible)"""
+    try:
+        return await get_async_client().eval(LEAVE_SCRIPT, 3, *_keys(call_id), channel_name, user_id)
+    except REDIS_ERRORS as e:
+        logger.warning('rooms.unavailable', call_id=call_id, error=e)
+        return None
+
+
+async def is_member(call_id, user_id):
+    try:
+        return bool(await get_async_client().eval(IS_MEMBER_SCRIPT, 3, *_keys(call_id), user_id))
+    except REDIS_ERRORS as e:
+        logger.warning('rooms.unavailable', call_id=call_id, error=e)
+        return None
+
+
+async def member_count(call_id):
+    try:
+        return await get_async_client().eval(MEMBER_COUNT_SCRIPT, 3, *_keys(call_id))
+    except REDIS_ERRORS as e:
+        logger.warning('rooms.unavailable', call_id=call_id, error=e)
+        return None
+
+
+def _state(connections):
+    """Membres (première connexion de chacun) et connexions, à partir du hash connections (HGETALL)"""
+    members = {}
+    entries = []
+    for channel_name, entry in zip(connections[::2], connections[1::2]):
+        entry = json.loads(entry)
+        entries.append({'channel': channel_name.decode(), 'userId': entry['userId'], 'joinedAt': entry['joinedAt']})
+        member = members.setdefault(entry['userId'], {'userId': entry['userId'], 'joinedAt': entry['joinedAt'],
+                                                      'connections': 0})
+        member['joinedAt'] = min(member['joinedAt'], entry['joinedAt'])
+        member['connections'] += 1
+    return {'members': sorted(members.values(), key=lambda m: m['joinedAt']), 'connections': entries}
+
+
+async def room_state(call_id):
+    """{'members': [...], 'connections': [...]} ; None si Redis est indisponible"""
+    try:
+        return _state(await get_async_client().eval(CONNECTIONS_SCRIPT, 3, *_keys(call_id)))
+    except REDIS_ERRORS as e:
+        logger.warning('rooms.unavailable', call_id=call_id, error=e)
+        return None
+
+
+def room_state_sync(call_id):
+    """Variante synchrone de room_state pour les vues REST"""
+    try:
+        return _state(get_sync_client().eval(CONNECTIONS_SCRIPT, 3, *_keys(call_id)))
+    except REDIS_ERRORS as e:
+        logger.warning('rooms.unavailable', call_id=call_id, error=e)
+        return None
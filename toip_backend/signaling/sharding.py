@@ -0,0 +1,62 @@
+"""
+Répartition de la couche de canaux sur plusieurs instances Redis
+
+channels_redis choisit l'instance d'une clé par crc32(clé) modulo le nombre
+d'instances : ajouter une instance déplace presque tous les groupes. L'anneau
+de hachage cohérent ci-dessous place chaque instance en VIRTUAL_NODES points ;
+une clé (groupe call_* / user_*, boîte de réception d'un processus) revient à
+l'instance du premier point qui la suit. Ajouter une Nème instance ne déplace
+qu'environ 1/N des clés, toutes vers la nouvelle instance.
+
+Une instance est identifiée par son adresse (et non par sa position dans
+CHANNEL_LAYER_SHARDS) : réordonner la liste ne déplace rien.
+"""
+import bisect
+import hashlib
+
+VIRTUAL_NODES = 160
+
+
+def _hash(value):
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+
+def shard_name(host):
+    """Identifiant stable d'une entrée hosts décodée par channels_redis (decode_hosts)"""
+    if 'address' in host:
+        return str(host['address'])
+    if 'sentinels' in host:
+        return f"sentinel:{host.get('master_name')}"
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}/{host.get('db', 0)}"
+
+
+class HashRing:
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(f'{node}#{replica}'), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(virtual_nodes)
+        )
+        self._points = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def index(self, key):
+        """Position dans nodes de l'instance responsable de la clé"""
+        if len(self.nodes) == 1:
+            return 0
+        position = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._indexes[position]
+
+    def node(self, key):
+        return self.nodes[self.index(key)]
+
+
+def moved_fraction(before, after, keys):
+    """Part des clés qui changent d'instance entre deux placements (fonctions clé -> instance)"""
+    keys = list(keys)
+    moved = sum(1 for key in keys if before(key) != after(key))
+    return moved / len(keys) if keys else 0.0
@@ -1,3 +1,549 @@
-from django.test import TestCase
+import asyncio
+import collections
+import contextlib
+import json
+import unittest
+import uuid
+from unittest import mock
 
-# Create your tests here.
+import channels_redis
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from toip_backend.budgets import EndpointBudgetTestCase, seed_users
+from calls.models import Call, CallParticipant
+from . import layers, replay, rooms, sharding, tracing, views
+from .consumers import SignalingConsumer
+from .redis_store import REDIS_ERRORS, get_sync_client
+from .models import SignalingMessage
+
+PENDING = 60           # messages en attente pour l'utilisateur mesuré (offre, réponse, candidats ICE)
+HISTORY_CALLS = 200    # autres appels dont les messages ont déjà été traités
+HISTORY_MESSAGES = 30
+
+
+class PollEndpointBudgetTests(EndpointBudgetTestCase):
+    """Relève HTTP des messages de signalisation (repli quand le WebSocket est indisponible)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = seed_users('budget_signal_', 20)
+        initiator, cls.user = users[0], users[1]
+        calls = Call.objects.bulk_create([
+            Call(initiator=users[index % len(users)], call_type='video', status='completed')
+            for index in range(HISTORY_CALLS)
+        ] + [Call(initiator=initiator, call_type='video', status='in_progress')])
+        cls.call = calls[-1]
+        CallParticipant.objects.bulk_create([
+            CallParticipant(call=cls.call, user=initiator, has_accepted=True),
+            CallParticipant(call=cls.call, user=cls.user, has_accepted=True),
+        ])
+
+        messages = [
+            SignalingMessage(call=call, sender=users[0], receiver=users[1], message_type='ice-candidate',
+                             content={'candidate': {'candidate': f'candidate:{index}'}}, is_processed=True)
+            for call in calls[:-1] for index in range(HISTORY_MESSAGES)
+        ]
+        messages.append(SignalingMessage(call=cls.call, sender=initiator, receiver=cls.user, message_type='offer',
+                                         content={'sdp': {'type': 'offer', 'sdp': 'v=0'}}))
+        messages += [
+            SignalingMessage(call=cls.call, sender=initiator, receiver=cls.user, message_type='ice-candidate',
+                             content={'candidate': {'candidate': f'candidate:{index}', 'sdpMid': '0'}})
+            for index in range(PENDING - 1)
+        ]
+        SignalingMessage.objects.bulk_create(messages)
+
+    def setUp(self):
+        self.authenticate(self.user)
+
+    def reset_pending(self):
+        SignalingMessage.objects.filter(call=self.call).update(is_processed=False)
+
+    def test_poll(self):
+        url = f'/api/signaling/poll/{self.call.id}/'
+        response = self.assertWithinBudget('get', url, queries=5, latency_ms=40, before=self.reset_pending)
+        self.assertEqual(len(response.data), PENDING)
+        self.assertEqual(response.data[0]['type'], 'offer')
+        self.assertFalse(SignalingMessage.objects.filter(call=self.call, is_processed=False).exists())
+
+    def test_poll_empty(self):
+        SignalingMessage.objects.filter(call=self.call).update(is_processed=True)
+        response = self.assertWithinBudget('get', f'/api/signaling/poll/{self.call.id}/', queries=4, latency_ms=20)
+        self.assertEqual(response.data, [])
+
+
+
+class SignalingPushTests(TestCase):
+    """Message envoyé par l'API REST : remis à la WebSocket du destinataire connecté, sinon laissé à la relève"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.caller, cls.callee = seed_users('push_signal_', 2)
+        cls.call = Call.objects.create(initiator=cls.caller, call_type='video', status='in_progress')
+        CallParticipant.objects.create(call=cls.call, user=cls.callee, has_accepted=True)
+        cls.token = Token.objects.create(user=cls.caller)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch.object(views, 'get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send_candidate(self):
+        return self.client.post('/api/signaling/ice-candidate/', {
+            'callId': self.call.id, 'sender': self.caller.id, 'receiver': self.callee.id,
+            'candidate': {'candidate': 'candidate:1', 'sdpMid': '0'}, 'type': 'ice-candidate',
+        }, format='json')
+
+    def test_pushed_to_connected_receiver(self):
+        with mock.patch.object(views.rooms, 'is_member', mock.AsyncMock(return_value=True)):
+            response = self.send_candidate()
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.data['pushed'])
+        self.layer.group_send.assert_awaited_once_with(f'call_{self.call.id}', {
+            'type': 'signaling_message',
+            'message': {'type': 'ice-candidate', 'sender': self.caller.id, 'receiver': self.callee.id,
+                        'callId': self.call.id, 'candidate': {'candidate': 'candidate:1', 'sdpMid': '0'}},
+            'sender_id': self.caller.id,
+            'message_id': SignalingMessage.objects.get(call=self.call).id,
+        })
+        # Marqué traité par le consommateur du destinataire, pas à l'envoi
+        self.assertTrue(SignalingMessage.objects.filter(call=self.call, is_processed=False).exists())
+
+    def test_left_for_polling_when_receiver_offline(self):
+        with mock.patch.object(views.rooms, 'is_member', mock.AsyncMock(return_value=None)):
+            response = self.send_candidate()
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.data['pushed'])
+        self.layer.group_send.assert_not_awaited()
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.callee).key}')
+        response = self.client.get(f'/api/signaling/poll/{self.call.id}/')
+        self.assertEqual([message['type'] for message in response.data], ['ice-candidate'])
+
+    def consumer(self):
+        consumer = SignalingConsumer()
+        consumer.scope = {'user': self.callee}
+        consumer.call_id = self.call.id
+        consumer.delivered_seq = 0
+        consumer.send = mock.AsyncMock()
+        return consumer
+
+    async def pushed_event(self):
+        message = await SignalingMessage.objects.acreate(
+            call=self.call, sender=self.caller, receiver=self.callee, message_type='ice-candidate',
+            content={'candidate': {'candidate': 'candidate:1'}})
+        return {'type': 'signaling_message', 'sender_id': self.caller.id, 'message_id': message.id,
+                'message': views.client_message('ice-candidate', self.caller.id, self.callee.id, self.call.id,
+                                                message.content)}
+
+    # Les connexions de la base de test ne doivent pas être fermées par database_sync_to_async
+    @mock.patch('channels.db.close_old_connections')
+    async def test_pushed_message_delivered_once(self, _):
+        event = await self.pushed_event()
+        first, second = self.consumer(), self.consumer()
+        await first.signaling_message(event)
+        await second.signaling_message(event)
+        first.send.assert_awaited_once()
+        second.send.assert_not_awaited()
+        self.assertFalse(await SignalingMessage.objects.filter(is_processed=False).aexists())
+
+    @mock.patch('channels.db.close_old_connections')
+    async def test_polled_message_not_pushed_again(self, _):
+        event = await self.pushed_event()
+        polled = await views.sync_to_async(views.claim_pending)(self.call.id, self.callee.id)
+        self.assertEqual([message.id for message in polled], [event['message_id']])
+        consumer = self.consumer()
+        await consumer.signaling_message(event)
+        consumer.send.assert_not_awaited()
+
+    def test_forbidden_for_non_participant(self):
+        outsider = seed_users('push_outsider_', 1)[0]
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=outsider).key}')
+        response = self.send_candidate()
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(SignalingMessage.objects.filter(call=self.call).exists())
+
+
+@override_settings(SFU_ENABLED=True)
+class RecordingRequestTests(SimpleTestCase):
+    """Démarrage et arrêt explicites de l'enregistrement réservés à l'initiateur de l'appel"""
+
+    def consumer(self, user_id):
+        consumer = SignalingConsumer()
+        consumer.scope = {'user': mock.Mock(id=user_id)}
+        consumer.call_id = 1
+        consumer.initiator_id = 1
+        consumer.is_group_call = True
+        consumer.call_type = 'video'
+        consumer.send = mock.AsyncMock()
+        consumer.handle_recording_request = mock.AsyncMock()
+        return consumer
+
+    @mock.patch('mediaserver.sfu.get_room')
+    async def test_initiator_starts_and_stops(self, get_room):
+        consumer = self.consumer(1)
+        await consumer.handle_sfu_message({'type': 'start-recording'})
+        await consumer.handle_sfu_message({'type': 'stop-recording'})
+        self.assertEqual(consumer.handle_recording_request.await_args_list,
+                         [mock.call(get_room.return_value, True), mock.call(get_room.return_value, False)])
+
+    @mock.patch('mediaserver.sfu.get_room')
+    async def test_other_participant_refused(self, get_room):
+        consumer = self.consumer(2)
+        for message_type in ('start-recording', 'stop-recording'):
+            await consumer.handle_sfu_message({'type': message_type})
+        consumer.handle_recording_request.assert_not_awaited()
+        self.assertEqual(json.loads(consumer.send.await_args.kwargs['text_data'])['type'], 'error')
+
+
+class RoomRegistryTests(SimpleTestCase):
+    """Registre des salles sur le Redis de signalisation (ignoré s'il est indisponible)"""
+
+    def setUp(self):
+        try:
+            get_sync_client().ping()
+        except REDIS_ERRORS:
+            self.skipTest("Redis de signalisation indisponible")
+        self.call_id = f'test-{uuid.uuid4().hex}'
+        self.addCleanup(get_sync_client().delete, *rooms._keys(self.call_id))
+
+    async def test_join_and_leave(self):
+        self.assertEqual(await rooms.join(self.call_id, 1, 'chan-a'), 1)
+        self.assertEqual(await rooms.join(self.call_id, 1, 'chan-b'), 1)
+        self.assertEqual(await rooms.join(self.call_id, 2, 'chan-c'), 2)
+        # Battement de cœur : la connexion n'est pas comptée deux fois
+        self.assertEqual(await rooms.join(self.call_id, 2, 'chan-c'), 2)
+        state = await rooms.room_state(self.call_id)
+        self.assertEqual([(m['userId'], m['connections']) for m in state['members']], [(1, 2), (2, 1)])
+
+        self.assertEqual(await rooms.leave(self.call_id, 1, 'chan-a'), 2)
+        self.assertEqual(await rooms.leave(self.call_id, 2, 'chan-c'), 1)
+        self.assertFalse(await rooms.is_member(self.call_id, 2))
+        self.assertEqual(await rooms.leave(self.call_id, 1, 'chan-b'), 0)
+        self.assertFalse(get_sync_client().exists(*rooms._keys(self.call_id)))
+
+    async def test_connection_without_heartbeat_expires(self):
+        await rooms.join(self.call_id, 1, 'chan-a')
+        await rooms.join(self.call_id, 2, 'chan-b')
+        self.assertTrue(await rooms.is_member(self.call_id, 1))
+        # Worker arrêté : l'échéance de sa connexion n'est plus prolongée
+        get_sync_client().zadd(rooms.alive_key(self.call_id), {'chan-a': 0})
+
+        self.assertFalse(await rooms.is_member(self.call_id, 1))
+        self.assertEqual(await rooms.member_count(self.call_id), 1)
+        self.assertEqual([c['channel'] for c in rooms.room_state_sync(self.call_id)['connections']], ['chan-b'])
+        # Battement suivant d'une connexion retirée à tort : réinscrite
+        self.assertEqual(await rooms.join(self.call_id, 1, 'chan-a'), 2)
+        self.assertGreater(get_sync_client().ttl(rooms.members_key(self.call_id)), 0)
+
+
+class ReplayTests(SimpleTestCase):
+    """Anneaux de rejeu de la signalisation (ignorés si Redis est indisponible)"""
+
+    def setUp(self):
+        try:
+            get_sync_client().ping()
+        except REDIS_ERRORS:
+            self.skipTest("Redis de signalisation indisponible")
+        self.call_id = f'test-{uuid.uuid4().hex}'
+        self.addCleanup(replay.clear_call, self.call_id)
+
+    def call_keys(self):
+        return get_sync_client().keys(f'{replay.call_prefix(self.call_id)}:*')
+
+    def consumer(self):
+        consumer = SignalingConsumer()
+        consumer.scope = {'user': mock.Mock(id=2)}
+        consumer.call_id = self.call_id
+        consumer.send = mock.AsyncMock()
+        return consumer
+
+    async def append_offers(self, count, user_ids=(2,)):
+        return [await replay.append(self.call_id, user_ids, {'type': 'offer', 'index': index})
+                for index in range(1, count + 1)]
+
+    async def test_append_numbers_each_receiver(self):
+        self.assertEqual(await replay.append(self.call_id, [2, 3], {'type': 'offer'}), {'2': 1, '3': 1})
+        self.assertEqual(await replay.append(self.call_id, [2], {'type': 'ice-candidate'}), {'2': 2})
+        self.assertEqual(await replay.append(self.call_id, [3, 2], {'type': 'ice-candidate'}), {'3': 2, '2': 3})
+        self.assertEqual(await replay.append(self.call_id, [], {'type': 'ice-candidate'}), {})
+
+    async def test_complete_replay(self):
+        await self.append_offers(3)
+        self.assertEqual(await replay.since(self.call_id, 2, 0), (
+            [(1, {'type': 'offer', 'index': 1}), (2, {'type': 'offer', 'index': 2}),
+             (3, {'type': 'offer', 'index': 3})], True))
+        self.assertEqual(await replay.since(self.call_id, 2, 2), ([(3, {'type': 'offer', 'index': 3})], True))
+        self.assertEqual(await replay.since(self.call_id, 2, 3), ([], True))
+        # Destinataire sans message
+        self.assertEqual(await replay.since(self.call_id, 3, 0), ([], True))
+
+    async def test_incomplete_after_overflow(self):
+        with mock.patch.object(replay, 'REPLAY_SIZE', 3):
+            await self.append_offers(5)
+        self.assertEqual(get_sync_client().zcard(replay.ring_key(self.call_id, 2)), 3)
+        messages, complete = await replay.since(self.call_id, 2, 0)
+        self.assertEqual([seq for seq, _ in messages], [3, 4, 5])
+        self.assertFalse(complete)
+        self.assertFalse((await replay.since(self.call_id, 2, 1))[1])
+        # Le plus ancien message conservé suit immédiatement last_seq
+        self.assertEqual(await replay.since(self.call_id, 2, 2),
+                         ([(3, {'type': 'offer', 'index': 3}), (4, {'type': 'offer', 'index': 4}),
+                           (5, {'type': 'offer', 'index': 5})], True))
+
+    async def test_last_seq_ahead_of_counter(self):
+        await self.append_offers(2)
+        # Compteur perdu (clés expirées ou Redis vidé) : séquence du client inconnue
+        self.assertEqual(await replay.since(self.call_id, 2, 5), ([], False))
+        self.assertEqual(await replay.since(self.call_id, 3, 1), ([], False))
+
+    async def test_clear_call(self):
+        await self.append_offers(2, user_ids=(2, 3))
+        self.assertEqual(len(self.call_keys()), 5)
+        await asyncio.to_thread(replay.clear_call, self.call_id)
+        self.assertEqual(self.call_keys(), [])
+
+    async def test_reconnect_replays_then_skips_delivered(self):
+        await self.append_offers(3)
+        consumer = self.consumer()
+
+        await consumer.replay_missed(1)
+        self.assertEqual([json.loads(call.kwargs['text_data']) for call in consumer.send.await_args_list],
+                         [{'type': 'offer', 'index': 2, 'seq': 2}, {'type': 'offer', 'index': 3, 'seq': 3}])
+        self.assertEqual(consumer.delivered_seq, 3)
+
+        # Messages du groupe arrivés pendant le rejeu : seuls les nouveaux sont envoyés
+        consumer.send.reset_mock()
+        for seq in (3, 4):
+            await consumer.signaling_message({'type': 'signaling_message', 'sender_id': 1, 'seqs': {'2': seq},
+                                              'message': {'type': 'offer', 'index': seq}})
+        self.assertEqual([json.loads(call.kwargs['text_data']) for call in consumer.send.await_args_list],
+                         [{'type': 'offer', 'index': 4, 'seq': 4}])
+
+    async def test_reconnect_after_overflow_reports_gap(self):
+        with mock.patch.object(replay, 'REPLAY_SIZE', 2):
+            await self.append_offers(4)
+        consumer = self.consumer()
+
+        await consumer.replay_missed(0)
+        sent = [json.loads(call.kwargs['text_data']) for call in consumer.send.await_args_list]
+        self.assertEqual([message.get('seq') for message in sent], [3, 4, None])
+        self.assertEqual(sent[-1], {'type': 'replay-gap', 'callId': self.call_id, 'lastSeq': 0})
+
+
+# Instance Redis injoignable : toute remise qui passerait par Redis échouerait
+DEAD_REDIS = [('127.0.0.1', 1)]
+
+
+@contextlib.asynccontextmanager
+async def channel_layers(count, hosts=None):
+    """count instances de HybridChannelLayer (autant de processus daphne) sur un préfixe dédié"""
+    prefix = f'test-layer-{uuid.uuid4().hex[:8]}'
+    instances = [layers.HybridChannelLayer(hosts=hosts, prefix=prefix) for _ in range(count)]
+    try:
+        yield instances
+    finally:
+        if hosts is None:
+            await instances[0].flush()
+        for layer in instances:
+            await layer.close_pools()
+
+
+class HybridChannelLayerTests(SimpleTestCase):
+    """Remise locale et repli Redis de la couche de canaux"""
+
+    def require_redis(self):
+        try:
+            get_sync_client().ping()
+        except REDIS_ERRORS:
+            self.skipTest("Redis de la couche de canaux indisponible")
+
+    async def join_locally(self, layer, group, channel):
+        """Appartenance retenue par la couche, sans son écriture dans Redis (injoignable)"""
+        with mock.patch.object(layers.RedisChannelLayer, 'group_add'):
+            await layer.group_add(group, channel)
+
+    def test_pinned_channels_redis(self):
+        self.assertEqual(channels_redis.__version__, layers.CHANNELS_REDIS_VERSION)
+
+    async def test_local_send_without_redis(self):
+        async with channel_layers(1, hosts=DEAD_REDIS) as (layer,):
+            channel = await layer.new_channel()
+            await self.join_locally(layer, 'call_1', channel)
+
+            message = {'type': 'signaling.message', 'payload': {'candidates': ['a']}}
+            await layer.send(channel, message)
+            message['payload']['candidates'].append('b')
+
+            received = await asyncio.wait_for(layer.receive(channel), 2)
+            self.assertEqual(received, {'type': 'signaling.message', 'payload': {'candidates': ['a']}})
+            self.assertIsNot(received['payload'], message['payload'])
+            self.assertNotIn(channel, layer.receive_buffer)
+
+    async def test_remote_send_between_instances(self):
+        self.require_redis()
+        async with channel_layers(2) as (sender, receiver):
+            channel = await receiver.new_channel()
+            await sender.send(channel, {'type': 'signaling.message', 'seq': 1})
+            received = await asyncio.wait_for(receiver.receive(channel), 5)
+            self.assertEqual(received, {'type': 'signaling.message', 'seq': 1})
+
+    async def test_group_send_local_and_remote(self):
+        self.require_redis()
+        async with channel_layers(2) as (local, remote):
+            local_channels = [await local.new_channel(), await local.new_channel()]
+            remote_channel = await remote.new_channel()
+            for channel in local_channels:
+                await local.group_add('call_2', channel)
+            await remote.group_add('call_2', remote_channel)
+
+            with mock.patch.object(local, 'send_remote', wraps=local.send_remote) as send_remote:
+                await local.group_send('call_2', {'type': 'call.ended'})
+            # Seul le membre de l'autre processus passe par Redis
+            self.assertEqual(send_remote.call_args.args[1], [remote_channel])
+
+            for layer, channel in [(local, local_channels[0]), (local, local_channels[1]), (remote, remote_channel)]:
+                self.assertEqual(await asyncio.wait_for(layer.receive(channel), 5), {'type': 'call.ended'})
+
+    async def test_group_discard(self):
+        self.require_redis()
+        async with channel_layers(1) as (layer,):
+            channel = await layer.new_channel()
+            await layer.group_add('call_3', channel)
+            await layer.group_add('user_3', channel)
+
+            await layer.group_discard('call_3', channel)
+            self.assertNotIn('call_3', layer.local_groups)
+            self.assertEqual(layer.local_channels[channel], 1)
+            await layer.group_discard('user_3', channel)
+            self.assertNotIn(channel, layer.local_channels)
+            self.assertFalse(layer.local_groups)
+            connection = layer.connection(layer.consistent_hash('user_3'))
+            self.assertEqual(await connection.zcard(layer._group_key('user_3')), 0)
+            # Canal inconnu : sans effet
+            await layer.group_discard('user_3', channel)
+
+    async def test_pump_error_while_waiting(self):
+        async with channel_layers(1, hosts=DEAD_REDIS) as (layer,):
+            channel = await layer.new_channel()
+
+            async def failing_pump(real_channel):
+                await asyncio.sleep(0.01)
+                raise ValueError("pompe")
+
+            with mock.patch.object(layer, '_run_pump', failing_pump):
+                with self.assertRaisesMessage(ValueError, "pompe"):
+                    await asyncio.wait_for(layer.receive(channel), 2)
+            self.assertNotIn(channel, layer.receive_buffer)
+
+    async def test_pump_exit_while_waiting(self):
+        async with channel_layers(1, hosts=DEAD_REDIS) as (layer,):
+            channel = await layer.new_channel()
+
+            async def stopped_pump(real_channel):
+                await asyncio.sleep(0.01)
+
+            with mock.patch.object(layer, '_run_pump', stopped_pump):
+                with self.assertRaisesMessage(RuntimeError, "Réception Redis arrêtée"):
+                    await asyncio.wait_for(layer.receive(channel), 2)
+            # Pompe relancée au receive suivant ; une remise locale le débloque malgré Redis injoignable
+            await self.join_locally(layer, 'call_1', channel)
+            await layer.send(channel, {'type': 'ping'})
+            self.assertEqual(await asyncio.wait_for(layer.receive(channel), 2), {'type': 'ping'})
+            self.assertFalse(layer._pump.done())
+
+
+SHARDS = ['redis://10.0.0.1:6379', 'redis://10.0.0.2:6379', 'redis://10.0.0.3:6379']
+GROUPS = [f'call_{index}' for index in range(2000)] + [f'user_{index}' for index in range(2000)]
+
+
+class ShardingTests(SimpleTestCase):
+    """Placement des groupes par l'anneau de hachage cohérent"""
+
+    def test_stable_placement(self):
+        ring, rebuilt = sharding.HashRing(SHARDS), sharding.HashRing(SHARDS)
+        self.assertEqual([ring.index(group) for group in GROUPS], [ring.index(group) for group in GROUPS])
+        self.assertEqual([ring.index(group) for group in GROUPS], [rebuilt.index(group) for group in GROUPS])
+        # Identifiée par son adresse, une instance garde ses groupes si la liste est réordonnée
+        reordered = sharding.HashRing(list(reversed(SHARDS)))
+        self.assertTrue(all(ring.node(group) == reordered.node(group) for group in GROUPS))
+
+    def test_groups_spread_over_shards(self):
+        ring = sharding.HashRing(SHARDS)
+        for kind in ('call_', 'user_'):
+            counts = collections.Counter(ring.index(group) for group in GROUPS if group.startswith(kind))
+            self.assertEqual(set(counts), {0, 1, 2})
+            self.assertGreater(min(counts.values()), 2000 / len(SHARDS) * 0.7)
+
+    def test_minimal_remapping(self):
+        before = sharding.HashRing(SHARDS)
+        after = sharding.HashRing(SHARDS + ['redis://10.0.0.4:6379'])
+        moved = sharding.moved_fraction(before.node, after.node, GROUPS)
+        self.assertAlmostEqual(moved, 1 / 4, delta=0.06)
+        # Les groupes déplacés vont tous vers la nouvelle instance
+        self.assertTrue(all(after.node(group) == 'redis://10.0.0.4:6379'
+                            for group in GROUPS if before.node(group) != after.node(group)))
+        self.assertEqual(sharding.moved_fraction(before.node, before.node, GROUPS), 0.0)
+        self.assertEqual(sharding.moved_fraction(before.node, after.node, []), 0.0)
+
+    def test_layer_uses_ring(self):
+        layer = layers.ShardedChannelLayer(hosts=SHARDS)
+        ring = sharding.HashRing([sharding.shard_name(host) for host in layer.hosts])
+        self.assertEqual(ring.nodes, SHARDS)
+        self.assertTrue(all(layer.consistent_hash(group) == ring.index(group) for group in GROUPS))
+        self.assertEqual(layers.ShardedChannelLayer(hosts=SHARDS[:1]).consistent_hash('call_1'), 0)
+
+
+def sender_span(trace_id, message_type, user, start, published=2.0):
+    return {'trace': trace_id, 'role': 'sender', 'user': user, 'type': message_type, 'receiver': None,
+            'start': start, 'stages': {'received': 0.0, 'parsed': 0.1, 'persisted': 1.5, 'buffered': 1.8,
+                                       'published': published}}
+
+
+class TraceTimelineTests(SimpleTestCase):
+
+    def test_setup_timeline(self):
+        spans = [
+            # Le destinataire peut enregistrer son segment avant l'expéditeur
+            {'trace': 'a', 'role': 'recipient', 'user': 2, 'stages': {'delivered': 2.5, 'sent': 3.0}},
+            sender_span('a', 'offer', 1, 1000.0),
+            sender_span('b', 'answer', 2, 1000.25),
+            {'trace': 'b', 'role': 'recipient', 'user': 1, 'stages': {'delivered': 4.0, 'sent': 4.5}},
+            sender_span('c', 'ice-candidate', 1, 1000.5),
+            sender_span('d', 'ice-candidate', 2, 1000.75),
+            {'role': 'media', 'user': 2, 'start': 1001.5},
+            {'role': 'media', 'user': 1, 'start': 1001.0},
+        ]
+        timeline = tracing.build_timeline(spans)
+
+        self.assertEqual([trace['trace'] for trace in timeline['traces']], ['a', 'b', 'c', 'd'])
+        self.assertEqual(timeline['traces'][0]['recipients'],
+                         [{'user': 2, 'stages': {'delivered': 2.5, 'sent': 3.0}}])
+        self.assertEqual(timeline['setup'], {
+            'offer': {'at': 0.0, 'user': 1, 'delivered': 3.0},
+            'answer': {'at': 250.0, 'user': 2, 'delivered': 254.5},
+            'ice-candidate': {'at': 500.0, 'user': 1, 'delivered': None},
+            'connected': {'at': 1000.0, 'user': 1},
+        })
+
+    def test_without_offer(self):
+        timeline = tracing.build_timeline([sender_span('a', 'ice-candidate', 1, 1000.0)])
+        self.assertEqual(timeline['setup'], dict.fromkeys(tracing.SETUP_MILESTONES))
+        self.assertEqual(len(timeline['traces']), 1)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', "profil SQLite")
+class SqliteProfileTests(TestCase):
+    """Réglages appliqués à chaque connexion (la base de test en mémoire ignore le mode WAL)"""
+
+    def test_connection_pragmas(self):
+        with connection.cursor() as cursor:
+            self.assertEqual(cursor.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+            self.assertEqual(cursor.execute('PRAGMA busy_timeout').fetchone()[0], 20000)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
@@ -0,0 +1,179 @@
+"""
+Traces de bout en bout des messages de signalisation relayés par WebSocket
+
+Pour un appel échantillonné (SIGNALING_TRACE_SAMPLE_RATE, tirage déterministe
+sur l'identifiant d'appel : tous les workers prennent la même décision), chaque
+trame reçue par SignalingConsumer porte un identifiant de trace et les instants
+de ses étapes, en millisecondes depuis sa réception :
+
+    received → parsed → persisted → buffered (tampon de rejeu) → published (group_send)
+    puis, chez chaque destinataire : delivered (signaling_message) → sent
+
+Le contexte de trace voyage dans l'événement du groupe. Un destinataire du même
+hôte mesure avec l'horloge monotone de l'émetteur (commune aux processus sous
+Linux) ; sur un autre hôte, avec l'horloge murale (sensible à leur décalage).
+
+Expéditeur et destinataires ajoutent chacun un segment à une liste Redis bornée
+par appel (SIGNALING_TRACE_SIZE), lisible par la vue /api/signaling/trace/<id>/
+qui reconstitue la mise en relation : première offre, réponse, premier candidat
+ICE et premier lot de statistiques de qualité (média établi). Les traces
+survivent à la fin de l'appel (SIGNALING_TRACE_TTL) : les plaintes arrivent
+après. Si Redis est indisponible, les segments sont perdus, pas les messages.
+"""
+import json
+import os
+import socket
+import time
+import zlib
+
+from django.conf import settings
+
+from monitoring.logs import get_logger
+from monitoring.metrics import Histogram
+from .redis_store import REDIS_ERRORS, call_prefix, get_async_client, get_sync_client
+
+logger = get_logger('signaling')
+
+SAMPLE_RATE = getattr(settings, 'SIGNALING_TRACE_SAMPLE_RATE', 0.0)
+TRACE_SIZE = getattr(settings, 'SIGNALING_TRACE_SIZE', 1000)
+TRACE_TTL = getattr(settings, 'SIGNALING_TRACE_TTL', 7 * 24 * 3600)
+
+HOST = socket.gethostname()
+
+# Étapes successives d'une trace ; la durée d'une étape court depuis la précédente
+SENDER_STAGES = ('received', 'parsed', 'persisted', 'buffered', 'published')
+RECIPIENT_STAGES = ('delivered', 'sent')
+# Jalons de la mise en relation, dans l'ordre
+SETUP_MILESTONES = ('offer', 'answer', 'ice-candidate', 'connected')
+
+STAGE_SECONDS = Histogram('toip_signaling_trace_stage_seconds',
+                          "Durée de chaque étape des messages de signalisation tracés", ['stage'])
+
+
+def trace_key(call_id):
+    return f'{call_prefix(call_id)}:trace'
+
+
+def sampled(call_id):
+    """Tirage par appel : un appel est tracé en entier ou pas du tout"""
+    return zlib.crc32(str(call_id).encode()) % 10000 < SAMPLE_RATE * 10000
+
+
+class Trace:
+    """Trace d'une trame, côté expéditeur"""
+
+    def __init__(self, call_id, user_id):
+        self.call_id = call_id
+        self.user_id = user_id
+        self.id = os.urandom(8).hex()
+        self.start = time.time()
+        self.clock = time.monotonic()
+        self.stages = {'received': 0.0}
+
+    def mark(self, stage):
+        self.stages[stage] = round((time.monotonic() - self.clock) * 1000, 3)
+
+    def context(self):
+        """Contexte transmis aux destinataires dans l'événement du groupe"""
+        return {'id': self.id, 'start': self.start, 'clock': self.clock, 'host': HOST,
+                'stages': dict(self.stages)}
+
+    def span(self, message):
+        return {'trace': self.id, 'role': 'sender', 'user': self.user_id, 'type': message.get('type'),
+                'receiver': message.get('receiver'), 'start': self.start, 'stages': self.stages}
+
+
+def elapsed(context):
+    """Millisecondes écoulées depuis la réception de la trame, chez un destinataire"""
+    if context['host'] == HOST:
+        return round((time.monotonic() - context['clock']) * 1000, 3)
+    return round((time.time() - context['start']) * 1000, 3)
+
+
+def recipient_span(context, user_id, delivered, sent):
+    return {'trace': context['id'], 'role': 'recipient', 'user': user_id,
+            'stages': {'delivered': delivered, 'sent': sent}}
+
+
+def media_span(user_id):
+    """Premier lot de statistiques de qualité d'un participant : le média circule"""
+    return {'role': 'media', 'user': user_id, 'start': time.time()}
+
+
+def observe(stages, names, previous=0.0):
+    for name in names:
+        if name in stages:
+            STAGE_SECONDS.labels(name).observe(max(stages[name] - previous, 0.0) / 1000)
+            previous = stages[name]
+
+
+async def record(call_id, span, previous=0.0):
+    """
+    Ajoute un segment à la trace de l'appel et ses durées d'étapes aux métriques
+    (previous : instant de la dernière étape de l'expéditeur, pour un destinataire)
+    """
+    if span['role'] == 'sender':
+        observe(span['stages'], SENDER_STAGES[1:])
+    elif span['role'] == 'recipient':
+        observe(span['stages'], RECIPIENT_STAGES, previous)
+    key = trace_key(call_id)
+    try:
+        async with get_async_client().pipeline(transaction=True) as pipe:
+            pipe.rpush(key, json.dumps(span))
+            pipe.ltrim(key, -TRACE_SIZE, -1)
+            pipe.expire(key, TRACE_TTL)
+            await pipe.execute()
+    except REDIS_ERRORS as e:
+        logger.warning('tracing.unavailable', call_id=call_id, error=e)
+
+
+def load(call_id):
+    """Segments enregistrés pour un appel (appelé depuis les vues synchrones)"""
+    try:
+        entries = get_sync_client().lrange(trace_key(call_id), 0, -1)
+    except REDIS_ERRORS as e:
+        logger.warning('tracing.unavailable', call_id=call_id, error=e)
+        return None
+    return [json.loads(entry) for entry in entries]
+
+
+def build_timeline(spans):
+    """
+    Traces (segment de l'expéditeur et de ses destinataires) et jalons de la mise
+    en relation, en millisecondes depuis la réception de la première offre :
+    'at' à la réception par le serveur, 'delivered' au premier envoi à un destinataire
+    """
+    traces = {}
+    recipients = {}
+    media = []
+    for span in spans:
+        if span['role'] == 'sender':
+            traces[span['trace']] = {key: span[key] for key in ('trace', 'user', 'type', 'receiver', 'start', 'stages')}
+        elif span['role'] == 'recipient':
+            recipients.setdefault(span['trace'], []).append({'user': span['user'], 'stages': span['stages']})
+        else:
+            media.append(span)
+
+    ordered = sorted(traces.values(), key=lambda trace: trace['start'])
+    for trace in ordered:
+        trace['recipients'] = recipients.get(trace['trace'], [])
+
+    setup = dict.fromkeys(SETUP_MILESTONES)
+    offers = [trace for trace in ordered if trace['type'] == 'offer']
+    if offers:
+        origin = offers[0]['start']
+        for trace in ordered:
+            if trace['type'] in setup and setup[trace['type']] is None:
+                sent = [recipient['stages']['sent'] for recipient in trace['recipients']]
+                at = (trace['start'] - origin) * 1000
+                setup[trace['type']] = {
+                    'at': round(at, 3),
+                    'user': trace['user'],
+                    'delivered': round(at + min(sent), 3) if sent else None,
+                }
+        # Sans message 'connected' du client, le premier lot de statistiques en tient lieu
+        connected = [span for span in media if span['start'] >= origin]
+        if connected and setup['connected'] is None:
+            first = min(connected, key=lambda span: span['start'])
+            setup['connected'] = {'at': round((first['start'] - origin) * 1000, 3), 'user': first['user']}
+    return {'setup': setup, 'traces': ordered}
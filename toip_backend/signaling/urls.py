@@ -6,4 +6,5 @@ urlpatterns = [
     path('answer/', views.send_answer, name='send-answer'),
     path('ice-candidate/', views.send_ice_candidate, name='send-ice-candidate'),
     path('poll/<int:call_id>/', views.poll_messages, name='poll-messages'),
+    path('trace/<int:call_id>/', views.call_trace, name='call-trace'),
 ]
\ No newline at end of file
@@ -2,57 +2,137 @@ from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.shortcuts import aget_object_or_404, get_object_or_404
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 
+from . import rooms, tracing
+from .async_views import async_api_view
 from .models import SignalingMessage
+from .redis_store import REDIS_ERRORS
 from calls.models import Call
 from calls.serializers import CallSerializer
-import logging
-logger = logging.getLogger('signaling')
+from monitoring.logs import get_logger
+from monitoring.metrics import Counter
+logger = get_logger('signaling')
 
-@api_view(['POST'])
-@permission_classes([IsAuthenticated])
-@api_view(['POST'])
+CALL_NOTIFICATIONS = Counter('toip_call_notifications_total',
+                             "Notifications d'appel entrant (notify_incoming_call) par résultat", ['result'])
+
+
+def client_message(message_type, sender_id, receiver_id, call_id, content):
+    """Message de signalisation tel que le reçoit le client (relève ou WebSocket)"""
+    message_data = {
+        'type': message_type,
+        'sender': sender_id,
+        'receiver': receiver_id,
+        'callId': call_id
+    }
+
+    # Ajouter le contenu spécifique au type de message
+    if message_type == 'offer' or message_type == 'answer':
+        message_data['sdp'] = content.get('sdp', {})
+    elif message_type == 'ice-candidate':
+        message_data['candidate'] = content.get('candidate', {})
+    return message_data
+
+
+async def is_call_member(call, user_id):
+    return call.initiator_id == user_id or await call.participants.filter(id=user_id).aexists()
+
+
+async def push_to_websocket(message):
+    """
+    Propose un message stocké à la WebSocket de signalisation du destinataire,
+    s'il est connecté à l'appel (registre des salles). Le consommateur du
+    destinataire le marque traité avant de l'envoyer (SignalingConsumer.claim_message) :
+    un message déjà relevé par poll_messages n'est pas remis deux fois, et un
+    message que plus aucun consommateur ne reçoit reste à relever.
+    Retourne False si le destinataire doit relever ses messages.
+    """
+    if not await rooms.is_member(message.call_id, message.receiver_id):
+        return False
+
+    data = client_message(message.message_type, message.sender_id, message.receiver_id, message.call_id,
+                          message.content)
+    try:
+        await get_channel_layer().group_send(f'call_{message.call_id}', {
+            'type': 'signaling_message',
+            'message': data,
+            'sender_id': message.sender_id,
+            'message_id': message.id,
+        })
+    except REDIS_ERRORS as e:
+        logger.warning('push.failed', call_id=message.call_id, receiver_id=message.receiver_id, error=e)
+        return False
+
+    logger.info('push.sent', call_id=message.call_id, receiver_id=message.receiver_id, type=message.message_type)
+    return True
+
+
+def claim_pending(call_id, user_id):
+    """
+    Messages non traités destinés à l'utilisateur, marqués traités dans la même
+    transaction. Les lignes qu'un consommateur WebSocket est en train de marquer
+    (verrouillées) lui sont laissées ; seuls les identifiants de l'expéditeur et
+    du destinataire sont renvoyés : pas de jointure
+    """
+    with transaction.atomic(savepoint=False):
+        messages = list(SignalingMessage.objects.select_for_update(skip_locked=True).filter(
+            call_id=call_id,
+            receiver_id=user_id,
+            is_processed=False
+        ))
+        if messages:
+            SignalingMessage.objects.filter(id__in=[msg.id for msg in messages]).update(is_processed=True)
+    return messages
+
+
+async def store_and_push(call_id, sender_id, receiver_id, message_type, content):
+    message = await SignalingMessage.objects.acreate(
+        call_id=call_id,
+        sender_id=sender_id,
+        receiver_id=receiver_id,
+        message_type=message_type,
+        content=content
+    )
+    return await push_to_websocket(message)
+
+
+@async_api_view(['POST'])
 @permission_classes([IsAuthenticated])
-def send_offer(request):
+async def send_offer(request):
     """Envoie une offre SDP à un autre utilisateur"""
     from .serializers import OfferSerializer  # Import local pour éviter les imports circulaires
     serializer = OfferSerializer(data=request.data)
 
     if serializer.is_valid():
         call_id = serializer.validated_data['call']
-        call = get_object_or_404(Call, id=call_id)
+        call = await aget_object_or_404(Call, id=call_id)
 
         user_id = request.user.id
         receiver_id = serializer.validated_data['receiver']
 
-        logger.info(f"Utilisateur {user_id} envoie une offre SDP à {receiver_id} pour l'appel {call_id}")
+        logger.info('offer.received', call_id=call_id, user_id=user_id, receiver_id=receiver_id)
 
-        if call.initiator.id != user_id and not call.participants.filter(id=user_id).exists():
-            logger.warning(f"Utilisateur {user_id} non autorisé à envoyer une offre pour l'appel {call_id}")
+        if not await is_call_member(call, user_id):
+            logger.warning('offer.forbidden', call_id=call_id, user_id=user_id)
             return Response({"detail": "Vous n'êtes pas autorisé"}, status=status.HTTP_403_FORBIDDEN)
 
-        message = SignalingMessage(
-            call_id=call_id,
-            sender_id=user_id,
-            receiver_id=receiver_id,
-            message_type='offer',
-            content={'sdp': serializer.validated_data['sdp']}
-        )
-        message.save()
+        pushed = await store_and_push(call_id, user_id, receiver_id, 'offer',
+                                      {'sdp': serializer.validated_data['sdp']})
 
-        logger.info(f"Offre SDP enregistrée pour l'appel {call_id} entre {user_id} et {receiver_id}")
-        return Response({"detail": "Offre envoyée"}, status=status.HTTP_201_CREATED)
+        logger.info('offer.saved', call_id=call_id, user_id=user_id, receiver_id=receiver_id, pushed=pushed)
+        return Response({"detail": "Offre envoyée", "pushed": pushed}, status=status.HTTP_201_CREATED)
 
-    logger.error(f"Erreur lors de l'envoi de l'offre SDP: {serializer.errors}")
+    logger.error('offer.invalid', user_id=request.user.id, errors=serializer.errors)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-@api_view(['POST'])
+@async_api_view(['POST'])
 @permission_classes([IsAuthenticated])
-def send_answer(request):
+async def send_answer(request):
     """Envoie une réponse SDP à un autre utilisateur"""
     from .serializers import AnswerSerializer  # Import local
     
@@ -60,37 +140,32 @@ def send_answer(request):
     if serializer.is_valid():
         # Vérifier que l'appel existe et que l'utilisateur est autorisé
         call_id = serializer.validated_data['call']
-        call = get_object_or_404(Call.objects.prefetch_related('participants'), id=call_id)
+        call = await aget_object_or_404(Call, id=call_id)
 
         # Vérifier que l'utilisateur est l'initiateur ou un participant
         user_id = request.user.id
-        if call.initiator.id != user_id and not call.participants.filter(id=user_id).exists():
+        if not await is_call_member(call, user_id):
             return Response({"detail": "Vous n'êtes pas autorisé à envoyer des messages pour cet appel."}, 
                            status=status.HTTP_403_FORBIDDEN)
         
         # Vérifier que le destinataire est un participant
         receiver_id = serializer.validated_data['receiver']
-        if call.initiator.id != receiver_id and not call.participants.filter(id=receiver_id).exists():
+        if not await is_call_member(call, receiver_id):
             return Response({"detail": "Le destinataire n'est pas un participant de cet appel."}, 
                            status=status.HTTP_400_BAD_REQUEST)
         
-        # Créer le message de signalisation
-        message = SignalingMessage(
-            call_id=call_id,
-            sender_id=user_id,
-            receiver_id=receiver_id,
-            message_type='answer',
-            content={'sdp': serializer.validated_data['sdp']}
-        )
-        message.save()
+        # Créer le message de signalisation, remis aussitôt si le destinataire est connecté
+        pushed = await store_and_push(call_id, user_id, receiver_id, 'answer',
+                                      {'sdp': serializer.validated_data['sdp']})
         
-        return Response({"detail": "Réponse envoyée avec succès."}, status=status.HTTP_201_CREATED)
+        return Response({"detail": "Réponse envoyée avec succès.", "pushed": pushed},
+                        status=status.HTTP_201_CREATED)
     
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-@api_view(['POST'])
+@async_api_view(['POST'])
 @permission_classes([IsAuthenticated])
-def send_ice_candidate(request):
+async def send_ice_candidate(request):
     """Envoie un candidat ICE à un autre utilisateur"""
     from .serializers import IceCandidateSerializer  # Import local
     
@@ -98,82 +173,73 @@ def send_ice_candidate(request):
     if serializer.is_valid():
         # Vérifier que l'appel existe et que l'utilisateur est autorisé
         call_id = serializer.validated_data['call']
-        call = get_object_or_404(Call.objects.prefetch_related('participants'), id=call_id)
+        call = await aget_object_or_404(Call, id=call_id)
 
         # Vérifier que l'utilisateur est l'initiateur ou un participant
         user_id = request.user.id
-        if call.initiator.id != user_id and not call.participants.filter(id=user_id).exists():
+        if not await is_call_member(call, user_id):
             return Response({"detail": "Vous n'êtes pas autorisé à envoyer des messages pour cet appel."}, 
                            status=status.HTTP_403_FORBIDDEN)
         
         # Vérifier que le destinataire est un participant
         receiver_id = serializer.validated_data['receiver']
-        if call.initiator.id != receiver_id and not call.participants.filter(id=receiver_id).exists():
+        if not await is_call_member(call, receiver_id):
             return Response({"detail": "Le destinataire n'est pas un participant de cet appel."}, 
                            status=status.HTTP_400_BAD_REQUEST)
         
-        # Créer le message de signalisation
-        message = SignalingMessage(
-            call_id=call_id,
-            sender_id=user_id,
-            receiver_id=receiver_id,
-            message_type='ice-candidate',
-            content={'candidate': serializer.validated_data['candidate']}
-        )
-        message.save()
+        # Créer le message de signalisation, remis aussitôt si le destinataire est connecté
+        pushed = await store_and_push(call_id, user_id, receiver_id, 'ice-candidate',
+                                      {'candidate': serializer.validated_data['candidate']})
         
-        return Response({"detail": "Candidat ICE envoyé avec succès."}, status=status.HTTP_201_CREATED)
+        return Response({"detail": "Candidat ICE envoyé avec succès.", "pushed": pushed},
+                        status=status.HTTP_201_CREATED)
     
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-@api_view(['GET'])
+@async_api_view(['GET'])
 @permission_classes([IsAuthenticated])
-def poll_messages(request, call_id):
+async def poll_messages(request, call_id):
     """Récupère les messages de signalisation non traités destinés à l'utilisateur"""
     # Vérifier que l'appel existe et que l'utilisateur est autorisé
-    call = get_object_or_404(Call.objects.prefetch_related('participants'), id=call_id)
+    call = await aget_object_or_404(Call, id=call_id)
 
     # Vérifier que l'utilisateur est l'initiateur ou un participant
     user_id = request.user.id
-    if call.initiator.id != user_id and not call.participants.filter(id=user_id).exists():
+    if not await is_call_member(call, user_id):
         return Response({"detail": "Vous n'êtes pas autorisé à recevoir des messages pour cet appel."}, 
                        status=status.HTTP_403_FORBIDDEN)
     
-    # Récupérer les messages non traités destinés à l'utilisateur
-    messages = SignalingMessage.objects.filter(
-        call_id=call_id,
-        receiver_id=user_id,
-        is_processed=False
-    ).select_related('sender', 'receiver')
-    
-    # Ajouter des logs
-    print(f"User {user_id} polling for messages for call {call_id}")
-    print(f"Found {messages.count()} unprocessed messages")
+    messages = await sync_to_async(claim_pending)(call_id, user_id)
+
+    logger.info('poll', call_id=call_id, user_id=user_id, messages=len(messages))
     
     # Formater les messages pour le client
-    formatted_messages = []
-    for msg in messages:
-        message_data = {
-            'type': msg.message_type,
-            'sender': msg.sender_id,
-            'receiver': msg.receiver_id,
-            'callId': call_id
-        }
-        
-        # Ajouter le contenu spécifique au type de message
-        if msg.message_type == 'offer' or msg.message_type == 'answer':
-            message_data['sdp'] = msg.content.get('sdp', {})
-        elif msg.message_type == 'ice-candidate':
-            message_data['candidate'] = msg.content.get('candidate', {})
-        
-        formatted_messages.append(message_data)
-        
-        # Marquer le message comme traité
-        msg.is_processed = True
-        msg.save()
-    
+    formatted_messages = [
+        client_message(msg.message_type, msg.sender_id, msg.receiver_id, call_id, msg.content)
+        for msg in messages
+    ]
+
     return Response(formatted_messages)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def call_trace(request, call_id):
+    """Chronologie de mise en relation d'un appel tracé (voir signaling.tracing)"""
+    call = get_object_or_404(Call, id=call_id)
+
+    user_id = request.user.id
+    if (not request.user.is_staff and call.initiator_id != user_id
+            and not call.participants.filter(id=user_id).exists()):
+        return Response({"detail": "Vous n'êtes pas autorisé à consulter la trace de cet appel."},
+                        status=status.HTTP_403_FORBIDDEN)
+
+    spans = tracing.load(call_id)
+    if spans is None:
+        return Response({"detail": "Traces de signalisation indisponibles."},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    return Response({'callId': call_id, 'sampled': tracing.sampled(call_id), **tracing.build_timeline(spans)})
+
 # Nouvelle fonction pour la notification WebSocket
 def notify_incoming_call(call, user_id):
     """
@@ -192,8 +258,10 @@ def notify_incoming_call(call, user_id):
                 'call': serializer.data
             }
         )
-        print(f"Notification d'appel entrant envoyée à l'utilisateur {user_id}")
+        logger.info('call.notified', call_id=call.id, user_id=user_id)
+        CALL_NOTIFICATIONS.labels('success').inc()
         return True
     except Exception as e:
-        print(f"Erreur lors de la notification d'appel entrant: {e}")
+        logger.error('call.notify_failed', call_id=call.id, user_id=user_id, error=e)
+        CALL_NOTIFICATIONS.labels('failure').inc()
         return False
\ No newline at end of file
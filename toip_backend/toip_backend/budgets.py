@@ -0,0 +1,91 @@
+"""
+Budgets de performance des points d'accès REST (tests des applications)
+
+Chaque point d'accès chaud est appelé sur un jeu de données de volume réaliste
+et doit tenir deux budgets :
+  - un nombre maximal de requêtes SQL, indépendant du volume : un sérialiseur
+    imbriqué qui relit une relation par ligne (N+1) le dépasse aussitôt ;
+  - une latence médiane maximale (en ms), mesurée après un appel de chauffe.
+Les latences dépendent de la machine : LATENCY_BUDGET_FACTOR (variable
+d'environnement, 1 par défaut) multiplie tous les budgets de latence, par
+exemple sur un runner d'intégration continue lent.
+"""
+import os
+import statistics
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from users.models import User
+
+LATENCY_BUDGET_FACTOR = float(os.environ.get('LATENCY_BUDGET_FACTOR', '1'))
+# Appels mesurés par point d'accès, après l'appel de chauffe
+MEASURED_RUNS = 5
+# Requêtes reproduites dans le message d'échec d'un budget SQL
+SHOWN_QUERIES = 20
+
+SEED_PASSWORD = 'budget-pass-1'
+
+
+def seed_users(prefix, count):
+    """Crée count utilisateurs en une insertion groupée (mot de passe SEED_PASSWORD, haché une seule fois)"""
+    password = make_password(SEED_PASSWORD)
+    users = []
+    for index in range(count):
+        phone = f'+33 6 {index // 10000:02d} {index % 10000:04d}'
+        user = User(
+            username=f'{prefix}{index:05d}', email=f'{prefix}{index:05d}@example.com', password=password,
+            first_name=f'Prénom{index % 97}', last_name=f'Nom{index % 89}', phone_number=phone,
+            online_status=index % 3 == 0,
+        )
+        user.normalize()
+        users.append(user)
+    User.objects.bulk_create(users)
+    return list(User.objects.filter(username__startswith=prefix).order_by('username'))
+
+
+class EndpointBudgetTestCase(TestCase):
+    client_class = APIClient
+
+    def authenticate(self, user):
+        """Authentification par jeton, comme les clients réels (la lecture du jeton compte dans le budget)"""
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def assertWithinBudget(self, method, url, queries, latency_ms, data=None, status=200, before=None):
+        """
+        Appelle le point d'accès MEASURED_RUNS + 1 fois (before() est appelé avant
+        chaque appel, hors mesure, pour remettre les données en place) et vérifie
+        le pire nombre de requêtes et la latence médiane. Retourne la dernière réponse.
+        """
+        counts, durations = [], []
+        for run in range(MEASURED_RUNS + 1):
+            if before is not None:
+                before()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                if method == 'get':
+                    response = self.client.get(url, data)
+                else:
+                    response = getattr(self.client, method)(url, data, format='json')
+                elapsed = time.perf_counter() - started
+            self.assertEqual(response.status_code, status, f"{method.upper()} {url} : {response.content[:300]}")
+            if run == 0:
+                continue
+            counts.append((len(captured), captured.captured_queries))
+            durations.append(elapsed)
+
+        worst, statements = max(counts, key=lambda count: count[0])
+        self.assertLessEqual(worst, queries,
+                             f"{method.upper()} {url} : {worst} requêtes SQL pour un budget de {queries}\n"
+                             + "\n".join(query['sql'] for query in statements[:SHOWN_QUERIES]))
+        median_ms = statistics.median(durations) * 1000
+        budget_ms = latency_ms * LATENCY_BUDGET_FACTOR
+        self.assertLessEqual(median_ms, budget_ms,
+                             f"{method.upper()} {url} : {median_ms:.1f} ms médians pour un budget de {budget_ms:.0f} ms")
+        return response
@@ -0,0 +1,167 @@
+"""
+Lectures des vues REST sur les répliques de la base
+
+Les listes et historiques (appels, contacts, annuaire) sont lus en masse et
+concurrencent les écritures de la signalisation sur la base principale. Si
+DATABASE_REPLICAS nomme des alias de répliques, ces lectures y sont envoyées :
+
+- seulement pour les actions déclarées par la vue (ReplicaReadMixin, attribut
+  replica_actions) et les méthodes sûres (GET, HEAD, OPTIONS) ;
+- jusqu'à la première écriture de la requête : les lectures suivantes
+  reviennent sur la base principale ;
+- pas pour un utilisateur qui vient d'écrire : une requête non sûre ou qui a
+  écrit l'épingle à la base principale pendant REPLICA_STICKY_SECONDS (clé
+  Redis partagée par les workers), le temps que la réplication rattrape ses
+  propres écritures. Redis indisponible : lecture sur la base principale.
+
+Hors d'une requête HTTP (consommateurs WebSocket, commandes), rien ne change.
+Sans réplique configurée, le routeur ne fait rien et Redis n'est pas consulté.
+"""
+import contextvars
+import random
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+from monitoring.logs import get_logger
+from signaling.redis_store import REDIS_ERRORS, get_sync_client
+
+REPLICAS = list(getattr(settings, 'DATABASE_REPLICAS', []))
+STICKY_SECONDS = getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+
+logger = get_logger('toip_backend')
+
+_state = contextvars.ContextVar('replica_routing', default=None)
+
+
+class RoutingState:
+    """État de routage d'une requête HTTP"""
+    __slots__ = ('replica', 'wrote')
+
+    def __init__(self):
+        # Alias de la réplique autorisée pour les lectures, None : base principale
+        self.replica = None
+        self.wrote = False
+
+
+def pin_key(user_id):
+    return f'replica:pin:{user_id}'
+
+
+def pinned(user_id):
+    """Vrai si l'utilisateur a écrit récemment (ou si Redis ne permet pas de le savoir)"""
+    try:
+        return bool(get_sync_client().exists(pin_key(user_id)))
+    except REDIS_ERRORS as e:
+        logger.warning('replica.pin.unavailable', user_id=user_id, error=e)
+        return True
+
+
+def pin(user_id):
+    try:
+        get_sync_client().set(pin_key(user_id), 1, ex=STICKY_SECONDS)
+    except REDIS_ERRORS as e:
+        logger.warning('replica.pin.unavailable', user_id=user_id, error=e)
+
+
+def use_replica(user):
+    """Autorise les lectures de la requête courante sur une réplique, sauf si l'utilisateur y est épinglé"""
+    state = _state.get()
+    if not REPLICAS or state is None or state.wrote:
+        return None
+    if user.is_authenticated and pinned(user.id):
+        return None
+    state.replica = random.choice(REPLICAS)
+    return state.replica
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.wrote:
+            return None
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        # Objet lu sur une réplique puis modifié : écrit sur la base principale
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in REPLICAS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Schéma des répliques reçu par la réplication
+        if db in REPLICAS:
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+    """Délimite l'état de routage de chaque requête et épingle l'utilisateur qui écrit"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not REPLICAS:
+            return self.get_response(request)
+
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        self.pin_writer(request, state)
+        return response
+
+    async def __acall__(self, request):
+        if not REPLICAS:
+            return await self.get_response(request)
+
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        if request.method not in SAFE_METHODS or state.wrote:
+            # Utilisateur de session chargé à la demande et client Redis synchrone : hors de la boucle
+            await sync_to_async(self.pin_writer)(request, state)
+        return response
+
+    def pin_writer(self, request, state):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated and (request.method not in SAFE_METHODS or state.wrote):
+            pin(user.id)
+
+
+class ReplicaReadMixin:
+    """
+    Viewset dont les actions replica_actions lisent sur une réplique (méthodes sûres),
+    décidé après l'authentification et les permissions, lues sur la base principale
+    """
+    replica_actions = ('list',)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.action in self.replica_actions and request.method in SAFE_METHODS:
+            use_replica(request.user)
@@ -47,10 +47,18 @@ INSTALLED_APPS = [
     'calls',
     'contacts',
     'signaling',
+    'mediaserver',
+    'monitoring',
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # En tête : compte aussi les requêtes SQL des sessions et de l'authentification
+    'monitoring.middleware.ViewMetricsMiddleware',
+    # Profils à la demande (en-tête X-Profile), consultés sur /admin/profiles/
+    'monitoring.profiling.ProfilingMiddleware',
+    # Lectures sur les répliques : état par requête, utilisateur épinglé après une écriture
+    'toip_backend.routers.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',  # Ajouter CORS middleware
     'django.middleware.common.CommonMiddleware',
@@ -77,19 +85,94 @@ REST_FRAMEWORK = {
 # Ajoutez la configuration ASGI
 ASGI_APPLICATION = 'toip_backend.asgi.application'
 
+# Instances Redis de la couche de canaux : les groupes call_* / user_* y sont répartis
+# par hachage cohérent (ajouter une instance ne déplace qu'environ 1/N des groupes).
+# Instances locales de test : docker compose --profile sharding up (ports 6380 à 6382)
+CHANNEL_LAYER_SHARDS = [('127.0.0.1', 6379)]
+
 # Configurez les couches de canaux
+# ShardedChannelLayer : RedisChannelLayer, avec remise directe entre canaux du même processus
+# et répartition sur CHANNEL_LAYER_SHARDS
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'signaling.layers.ShardedChannelLayer',
         'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
+            "hosts": CHANNEL_LAYER_SHARDS,
         },
     },
 }
 
+# Serveur média (SFU) pour les appels de groupe : les flux passent par le serveur
+# au lieu d'un maillage complet entre participants (nécessite aiortc)
+SFU_ENABLED = False
+
+# Enregistrement côté serveur des appels passant par le SFU (fichiers WebM dans
+# MEDIA_ROOT/recordings) : automatique pour tous les appels de groupe ou à la
+# demande de l'initiateur de l'appel (message 'start-recording' adressé au serveur média)
+RECORD_GROUP_CALLS = False
+RECORDING_SEGMENT_SECONDS = 10
+RECORDING_WORKERS = 2
+
+# Appels de groupe audio d'au moins MCU_MIN_PARTICIPANTS participants : le serveur
+# décode et mixe l'audio (un seul flux par participant) au lieu de le retransmettre
+MCU_AUDIO_CALLS = False
+MCU_MIN_PARTICIPANTS = 8
+
+# Statistiques de qualité des appels (getStats) : taille des périodes d'agrégation
+CALL_QUALITY_BUCKET_SECONDS = 10
+
+# Synchronisation incrémentale des répertoires : rétention du journal (purgé par
+# manage.py prune_contact_changes) et âge minimal d'une modification couverte par
+# un jeton (durée maximale supposée d'une transaction qui journalise)
+CONTACT_CHANGE_RETENTION_DAYS = 30
+CONTACT_SYNC_SAFETY_SECONDS = 60
+
+# Redis de l'état de signalisation partagé entre workers (rejeu, registre des salles)
+SIGNALING_REDIS_URL = 'redis://127.0.0.1:6379/0'
+
+# Tampon de rejeu de la signalisation (reconnexion WebSocket avec ?last_seq=) :
+# derniers messages relayés à chaque participant
+SIGNALING_REPLAY_SIZE = 200
+SIGNALING_REPLAY_TTL = 6 * 3600
+
+# Registre des salles (connexions WebSocket par appel) : chaque connexion est
+# prolongée toutes les SIGNALING_ROOM_HEARTBEAT secondes ; celle d'un worker
+# arrêté sans déconnexion propre est retirée SIGNALING_ROOM_TTL secondes après
+# son dernier battement
+SIGNALING_ROOM_TTL = 90
+SIGNALING_ROOM_HEARTBEAT = 30
+
+# Traces de bout en bout des messages de signalisation (GET /api/signaling/trace/<id>/) :
+# part des appels tracés, segments conservés par appel et durée de conservation
+SIGNALING_TRACE_SAMPLE_RATE = 0.05
+SIGNALING_TRACE_SIZE = 1000
+SIGNALING_TRACE_TTL = 7 * 24 * 3600
+
+# Métriques Prometheus de chaque worker sur /metrics/ : si METRICS_TOKEN est défini,
+# l'en-tête "Authorization: Bearer <jeton>" est exigé (bearer_token de la configuration de scrape) ;
+# sans jeton, seules les adresses de METRICS_ALLOWED_NETWORKS y ont accès (REMOTE_ADDR : derrière
+# un proxy inverse, définir le jeton plutôt qu'autoriser l'adresse du proxy)
+METRICS_TOKEN = None
+METRICS_ALLOWED_NETWORKS = ['127.0.0.0/8', '::1/128']
+
+# Profilage des requêtes HTTP et des messages WebSocket (voir monitoring.profiling) :
+# part profilée d'office, jeton de l'en-tête X-Profile (en plus des membres du personnel),
+# période d'échantillonnage de la pile (s) et nombre de profils gardés par processus
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_TOKEN = None
+PROFILING_INTERVAL = 0.005
+PROFILING_STORE_SIZE = 100
+
 # Ajoutez la configuration de journalisation pour faciliter le débogage
 import os
 
+# Journalisation structurée (voir monitoring.logs) : part des événements fréquents
+# effectivement écrits, par nom d'événement (1 par défaut)
+LOG_SAMPLING = {
+    'ws.message.received': 0.01,
+    'ws.message.sent': 0.01,
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -102,17 +185,22 @@ LOGGING = {
             'format': '{levelname} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'monitoring.logs.JsonFormatter',
+        },
     },
+    # Écriture dans un thread dédié : ni les vues ni la boucle asyncio n'attendent le disque
     'handlers': {
         'file': {
             'level': 'WARNING',  # Changé de INFO à WARNING
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(BASE_DIR, 'voip.log'),
-            'formatter': 'verbose',
+            '()': 'monitoring.logs.QueuedHandler',
+            'target': {'class': 'logging.FileHandler', 'filename': os.path.join(BASE_DIR, 'voip.log')},
+            'formatter': 'json',
         },
         'console': {
             'level': 'INFO',  # Changé de DEBUG à INFO
-            'class': 'logging.StreamHandler',
+            '()': 'monitoring.logs.QueuedHandler',
+            'target': {'class': 'logging.StreamHandler'},
             'formatter': 'simple',
         },
     },
@@ -132,6 +220,26 @@ LOGGING = {
             'level': 'INFO',  # Changé de DEBUG à INFO
             'propagate': False,
         },
+        'websocket': {
+            'handlers': ['file', 'console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'calls': {
+            'handlers': ['file', 'console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'users': {
+            'handlers': ['file', 'console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'toip_backend': {
+            'handlers': ['file', 'console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     },
 }
 # Spécifier le modèle utilisateur personnalisé
@@ -161,13 +269,77 @@ WSGI_APPLICATION = 'toip_backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+# SQLite (par défaut), réglé pour les écritures concurrentes des consommateurs :
+# - journal WAL : les lectures ne bloquent plus l'écrivain (et inversement) ;
+# - synchronous=NORMAL : pas de fsync à chaque validation en WAL (durable au point de contrôle) ;
+# - transactions IMMEDIATE : le verrou d'écriture est pris au BEGIN, l'attente (timeout, en
+#   secondes) s'applique au lieu d'un « database is locked » immédiat lors de sa promotion.
+SQLITE_OPTIONS = {
+    'init_command': (
+        'PRAGMA journal_mode=WAL;'
+        'PRAGMA synchronous=NORMAL;'
+        'PRAGMA mmap_size=268435456;'
+        'PRAGMA journal_size_limit=67108864;'
+        'PRAGMA cache_size=-20000;'
+        'PRAGMA temp_store=MEMORY;'
+    ),
+    'transaction_mode': 'IMMEDIATE',
+    'timeout': 20,
 }
 
+# Connexions PostgreSQL par processus : une pour l'exécuteur partagé de database_sync_to_async
+# (tous les consommateurs WebSocket y passent), plus une par vue synchrone servie en parallèle
+# (un thread par requête sous ASGI). Au-delà, les requêtes attendent une connexion libre.
+DATABASE_POOL_SIZE = 1 + int(os.environ.get('SYNC_VIEW_CONCURRENCY', 16))
+
+# Profil de production PostgreSQL si POSTGRES_DB est défini (docker compose --profile postgres)
+if os.environ.get('POSTGRES_DB'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ['POSTGRES_DB'],
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Connexions gardées ouvertes par le pool de psycopg : CONN_MAX_AGE doit rester à 0
+            'OPTIONS': {
+                'pool': {'min_size': 2, 'max_size': DATABASE_POOL_SIZE, 'timeout': 10},
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            # Connexions persistantes : les PRAGMA ne sont pas rejoués à chaque requête
+            'CONN_MAX_AGE': 600,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': SQLITE_OPTIONS,
+        }
+    }
+
+# Répliques en lecture (voir toip_backend.routers) : hôtes PostgreSQL en réplication de
+# POSTGRES_REPLICA_HOSTS (« hôte[:port] » séparés par des virgules), ou fichiers SQLite
+# locaux de SQLITE_REPLICA_FILES tenus à jour par un outil de copie (litestream, sqlite3_rsync).
+# Sous les tests, chaque réplique est un miroir de la base principale.
+if os.environ.get('POSTGRES_DB'):
+    REPLICA_LOCATIONS = [
+        dict(zip(('HOST', 'PORT'), location.strip().split(':', 1)))
+        for location in os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(',') if location.strip()
+    ]
+else:
+    REPLICA_LOCATIONS = [
+        {'NAME': path.strip()} for path in os.environ.get('SQLITE_REPLICA_FILES', '').split(',') if path.strip()
+    ]
+for index, location in enumerate(REPLICA_LOCATIONS, start=1):
+    DATABASES[f'replica_{index}'] = {**DATABASES['default'], **location, 'TEST': {'MIRROR': 'default'}}
+DATABASE_REPLICAS = [f'replica_{index}' for index in range(1, len(REPLICA_LOCATIONS) + 1)]
+DATABASE_ROUTERS = ['toip_backend.routers.ReplicaRouter']
+# Lectures d'un utilisateur sur la base principale après une écriture (délai de réplication)
+REPLICA_STICKY_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
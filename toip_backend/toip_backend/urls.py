@@ -19,12 +19,19 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from monitoring import views as monitoring_views
+
 urlpatterns = [
+    # Avant admin.site.urls, dont la dernière route capture toutes les adresses sous admin/
+    path('admin/profiles/', admin.site.admin_view(monitoring_views.profile_list), name='profile-list'),
+    path('admin/profiles/<str:profile_id>/', admin.site.admin_view(monitoring_views.profile_detail),
+         name='profile-detail'),
     path('admin/', admin.site.urls),
     path('api/users/', include('users.urls')),
     path('api/contacts/', include('contacts.urls')),
     path('api/calls/', include('calls.urls')),
     path('api/signaling/', include('signaling.urls')),  # Nouvelle URL
+    path('metrics/', include('monitoring.urls')),
 ]
 
 # Ajouter la configuration pour servir les fichiers média en développement
@@ -0,0 +1,121 @@
+"""
+Génération des variantes redimensionnées des photos de profil
+
+Chaque photo téléversée est déclinée en tailles fixes (WebP et JPEG). Les
+fichiers sont nommés d'après le hash de leur contenu : une URL ne change
+jamais de contenu et peut donc être mise en cache indéfiniment par les clients.
+Le traitement s'exécute dans un pool de threads, hors du thread de la requête.
+"""
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from monitoring.logs import get_logger
+
+logger = get_logger('users')
+
+AVATAR_SIZES = {
+    'small': 64,
+    'medium': 128,
+    'large': 256,
+}
+AVATAR_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+DEFAULT_AVATAR_FORMAT = 'webp'
+VARIANTS_DIR = 'profile_images/variants'
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='avatars')
+
+
+def _render(image, size, image_format, options):
+    thumbnail = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def build_variants(source):
+    """
+    Produit toutes les variantes d'une image (fichier ouvert) et les enregistre
+    dans le stockage. Retourne {taille: {format: nom de fichier}}.
+    """
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+
+    variants = {}
+    for label, size in AVATAR_SIZES.items():
+        variants[label] = {}
+        for extension, (image_format, options) in AVATAR_FORMATS.items():
+            content = _render(image, size, image_format, options)
+            digest = hashlib.sha256(content).hexdigest()[:20]
+            name = f'{VARIANTS_DIR}/{digest}_{size}.{extension}'
+            if not default_storage.exists(name):
+                name = default_storage.save(name, ContentFile(content))
+            variants[label][extension] = name
+    return variants
+
+
+def generate_avatar_variants(user_id):
+    """Génère les variantes de la photo actuelle d'un utilisateur et les enregistre sur le modèle"""
+    from .models import User
+
+    user = User.objects.filter(pk=user_id).only('id', 'profile_image').first()
+    if user is None or not user.profile_image:
+        return None
+
+    image_name = user.profile_image.name
+    try:
+        with user.profile_image.open('rb') as source:
+            variants = build_variants(source)
+    except (OSError, ValueError) as exc:
+        logger.warning('avatar.invalid', user_id=user_id, image=image_name, error=exc)
+        return None
+
+    # Ne rien écraser si une nouvelle photo a été téléversée entre-temps
+    updated = User.objects.filter(pk=user_id, profile_image=image_name).update(profile_image_variants=variants)
+    if updated:
+        # L'URL d'avatar change dans les répertoires où figure cet utilisateur
+        from contacts.models import Contact, ContactChange
+        ContactChange.record_contacts(Contact.objects.filter(contact_user_id=user_id))
+    return variants
+
+
+def _generate_safely(user_id):
+    try:
+        generate_avatar_variants(user_id)
+    except Exception:
+        logger.exception('avatar.failed', user_id=user_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_avatar_variants(user_id):
+    """Planifie la génération des variantes après la validation de la transaction courante"""
+    transaction.on_commit(lambda: _executor.submit(_generate_safely, user_id))
+
+
+def avatar_url(user, size='small', image_format=DEFAULT_AVATAR_FORMAT):
+    """URL de la variante demandée, ou de la photo originale si elle n'est pas encore prête"""
+    if not user.profile_image:
+        return ""
+    name = (user.profile_image_variants or {}).get(size, {}).get(image_format)
+    if name:
+        return default_storage.url(name)
+    return user.profile_image.url
+
+
+def avatar_urls(user):
+    """Toutes les variantes disponibles : {taille: {format: url}}"""
+    if not user.profile_image:
+        return {}
+    return {
+        size: {image_format: default_storage.url(name) for image_format, name in formats.items()}
+        for size, formats in (user.profile_image_variants or {}).items()
+    }
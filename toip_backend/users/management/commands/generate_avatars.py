@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from users.images import generate_avatar_variants
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = "Génère les variantes redimensionnées des photos de profil existantes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="régénérer aussi les utilisateurs qui ont déjà des variantes")
+
+    def handle(self, *args, **options):
+        users = User.objects.exclude(profile_image='').exclude(profile_image__isnull=True)
+        if not options['all']:
+            users = users.filter(profile_image_variants={})
+
+        done = 0
+        for user_id in users.values_list('id', flat=True).iterator():
+            if generate_avatar_variants(user_id):
+                done += 1
+        self.stdout.write(self.style.SUCCESS(f"{done} photos de profil traitées"))
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.7 on 2026-10-19 16:51
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+def fill_phone_normalized(apps, schema_editor):
+    from users.models import normalize_phone
+    User = apps.get_model('users', 'User')
+    users = list(User.objects.exclude(phone_number__isnull=True).exclude(phone_number='').only('id', 'phone_number'))
+    for user in users:
+        user.phone_normalized = normalize_phone(user.phone_number)
+    User.objects.bulk_update(users, ['phone_normalized'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='phone_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.RunPython(fill_phone_normalized, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('username'), name='user_username_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('first_name'), name='user_first_name_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('last_name'), name='user_last_name_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('email'), name='user_email_lower_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.1.7 on 2026-10-19 18:57
+
+from django.db import migrations, models
+
+
+def fill_search_normalized(apps, schema_editor):
+    from users.models import normalize_search
+    User = apps.get_model('users', 'User')
+    fields = ['username', 'first_name', 'last_name', 'email']
+    users = list(User.objects.only('id', *fields))
+    for user in users:
+        for field in fields:
+            max_length = User._meta.get_field(f'{field}_normalized').max_length
+            setattr(user, f'{field}_normalized', normalize_search(getattr(user, field))[:max_length])
+    User.objects.bulk_update(users, [f'{field}_normalized' for field in fields], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_user_profile_image_variants'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_username_lower_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_first_name_lower_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_last_name_lower_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_email_lower_idx',
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='email_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=254),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='first_name_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=150),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='last_name_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=150),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='username_normalized',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=150),
+        ),
+        migrations.RunPython(fill_search_normalized, migrations.RunPython.noop),
+    ]
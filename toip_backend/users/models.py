@@ -1,14 +1,49 @@
+import re
+
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
 
+_PHONE_SEPARATORS = re.compile(r'[\s\-\.\(\)]')
+
+
+def normalize_phone(phone):
+    """Supprime les séparateurs usuels d'un numéro (espaces, tirets, points, parenthèses)"""
+    return _PHONE_SEPARATORS.sub('', phone or '')
+
+
+def normalize_search(value):
+    """Forme de recherche d'un champ de l'annuaire : minuscules Unicode (casefold, « ß » -> « ss »)"""
+    return (value or '').casefold()
+
+
+# Champ saisi -> colonne normalisée maintenue par User.save() pour la recherche par préfixe
+NORMALIZED_FIELDS = {
+    'phone_number': 'phone_normalized',
+    'username': 'username_normalized',
+    'first_name': 'first_name_normalized',
+    'last_name': 'last_name_normalized',
+    'email': 'email_normalized',
+}
+
+
 class User(AbstractUser):
     """
     Modèle utilisateur personnalisé avec des champs supplémentaires 
     pour les fonctionnalités VoIP
     """
     phone_number = models.CharField(max_length=20, blank=True, null=True)
+    # Numéro sans séparateurs, maintenu par save() pour la recherche par préfixe
+    phone_normalized = models.CharField(max_length=20, blank=True, default='', db_index=True, editable=False)
+    # Formes normalisées (normalize_search) des champs de l'annuaire, maintenues par save() ;
+    # sous PostgreSQL, db_index ajoute un index varchar_pattern_ops servant LIKE 'préfixe%'
+    username_normalized = models.CharField(max_length=150, blank=True, default='', db_index=True, editable=False)
+    first_name_normalized = models.CharField(max_length=150, blank=True, default='', db_index=True, editable=False)
+    last_name_normalized = models.CharField(max_length=150, blank=True, default='', db_index=True, editable=False)
+    email_normalized = models.CharField(max_length=254, blank=True, default='', db_index=True, editable=False)
     profile_image = models.ImageField(upload_to='profile_images/', blank=True, null=True)
+    # Variantes redimensionnées de profile_image : {taille: {format: nom de fichier}} (voir users.images)
+    profile_image_variants = models.JSONField(default=dict, blank=True, editable=False)
     online_status = models.BooleanField(default=False)
     last_seen = models.DateTimeField(blank=True, null=True)
     
@@ -18,6 +53,22 @@ class User(AbstractUser):
     
     def __str__(self):
         return self.username
+
+    def normalize(self):
+        """Recalcule les colonnes normalisées (à appeler avant un bulk_create, qui n'appelle pas save())"""
+        self.phone_normalized = normalize_phone(self.phone_number)
+        for field, normalized in NORMALIZED_FIELDS.items():
+            if field != 'phone_number':
+                max_length = self._meta.get_field(normalized).max_length
+                setattr(self, normalized, normalize_search(getattr(self, field))[:max_length])
+
+    def save(self, *args, **kwargs):
+        self.normalize()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {
+                NORMALIZED_FIELDS[field] for field in update_fields if field in NORMALIZED_FIELDS}
+        super().save(*args, **kwargs)
         
 class UserStatus(models.Model):
     """
@@ -1,17 +1,30 @@
 from rest_framework import serializers
 from django.contrib.auth import authenticate
+from monitoring.logs import get_logger
 from .models import User, UserStatus
+from .images import avatar_url, avatar_urls
+
+logger = get_logger('users')
 
 
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=False)
+    avatar = serializers.SerializerMethodField()
+    avatars = serializers.SerializerMethodField()
 
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name',
-                  'phone_number', 'profile_image', 'online_status', 'last_seen', 'password']
+                  'phone_number', 'profile_image', 'avatar', 'avatars',
+                  'online_status', 'last_seen', 'password']
         read_only_fields = ['id', 'online_status', 'last_seen']
 
+    def get_avatar(self, obj):
+        return avatar_url(obj, 'medium')
+
+    def get_avatars(self, obj):
+        return avatar_urls(obj)
+
     def create(self, validated_data):
         password = validated_data.pop('password', None)
         user = User.objects.create(**validated_data)
@@ -35,6 +48,19 @@ class UserSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
+class UserDirectorySerializer(serializers.ModelSerializer):
+    """Représentation allégée d'un utilisateur pour la recherche dans l'annuaire"""
+    avatar = serializers.SerializerMethodField()
+
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'first_name', 'last_name', 'online_status', 'avatar']
+        read_only_fields = fields
+
+    def get_avatar(self, obj):
+        return avatar_url(obj, 'small')
+
+
 class UserStatusSerializer(serializers.ModelSerializer):
     username = serializers.CharField(source='user.username', read_only=True)
 
@@ -53,33 +79,28 @@ class LoginSerializer(serializers.Serializer):
         password = attrs.get('password')
 
         if username_or_email and password:
-            # Ajouter des prints pour déboguer
-            print(f"Tentative de connexion pour: {username_or_email}")
-
             # Vérifier si l'entrée est un email ou un username
             if '@' in username_or_email:
                 # C'est probablement un email, on cherche l'utilisateur par email
                 try:
                     user_obj = User.objects.get(email=username_or_email)
-                    print(f"Utilisateur trouvé par email: {user_obj.username}")
                     # Si on trouve l'utilisateur par email, on utilise son username pour l'authentification
                     user = authenticate(request=self.context.get('request'),
                                         username=user_obj.username, password=password)
                 except User.DoesNotExist:
-                    print(f"Aucun utilisateur trouvé avec l'email: {username_or_email}")
                     user = None
             else:
                 # C'est probablement un username
-                print(f"Tentative d'authentification avec username: {username_or_email}")
                 user = authenticate(request=self.context.get('request'),
                                     username=username_or_email, password=password)
 
             if not user:
-                print(f"Échec d'authentification pour {username_or_email}")
+                # Ni l'identifiant saisi ni le mot de passe ne sont journalisés
+                logger.warning('login.failed', by_email='@' in username_or_email)
                 msg = 'Impossible de se connecter avec les identifiants fournis.'
                 raise serializers.ValidationError(msg, code='authorization')
             else:
-                print(f"Authentification réussie pour {user.username}")
+                logger.info('login.succeeded', user_id=user.id)
         else:
             msg = 'Les champs "username" et "password" sont requis.'
             raise serializers.ValidationError(msg, code='authorization')
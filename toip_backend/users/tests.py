@@ -1,3 +1,208 @@
-from django.test import TestCase
+import hashlib
+import io
+import re
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from PIL import Image
+
+from toip_backend.budgets import SEED_PASSWORD, EndpointBudgetTestCase, seed_users
+from contacts.models import Contact, ContactChange
+from contacts.serializers import ContactSerializer
+from . import images
+from .models import User
+from .serializers import UserDirectorySerializer, UserSerializer
+
+USERS = 5000           # taille de l'annuaire
+
+
+# Le hachage PBKDF2 (volontairement lent) masquerait le coût propre de la vue de connexion
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class UserEndpointBudgetTests(EndpointBudgetTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_users('budget_user_', USERS)
+        cls.user = cls.users[0]
+
+    def test_search(self):
+        self.authenticate(self.user)
+        response = self.assertWithinBudget('get', '/api/users/users/', data={'q': 'prénom4 nom1'},
+                                           queries=2, latency_ms=40)
+        results = response.data['results']
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(user['first_name'].startswith('Prénom4') and user['last_name'].startswith('Nom1')
+                            for user in results))
+
+    def test_search_by_phone(self):
+        self.authenticate(self.user)
+        # Numéros +33 6 00 0010 à +33 6 00 0019
+        response = self.assertWithinBudget('get', '/api/users/users/', data={'q': '+33600001'},
+                                           queries=2, latency_ms=40)
+        self.assertEqual([user['username'] for user in response.data['results']],
+                         [f'budget_user_{index:05d}' for index in range(10, 20)])
+
+    def test_search_accented_case(self):
+        self.authenticate(self.user)
+        elodie = User.objects.create_user(username='elodie', first_name='Élodie', last_name='Straße')
+        response = self.client.get('/api/users/users/', data={'q': 'éLODIE STRASS'})
+        self.assertEqual([user['id'] for user in response.data['results']], [elodie.id])
+
+        # Colonnes normalisées suivies lors d'une sauvegarde partielle
+        elodie.last_name = 'Œuvray'
+        elodie.save(update_fields=['last_name'])
+        response = self.client.get('/api/users/users/', data={'q': 'élodie œu'})
+        self.assertEqual([user['id'] for user in response.data['results']], [elodie.id])
+
+    def test_login(self):
+        response = self.assertWithinBudget('post', '/api/users/login/',
+                                           data={'username': self.user.username, 'password': SEED_PASSWORD},
+                                           queries=10, latency_ms=40)
+        self.assertEqual(response.data['user_id'], self.user.id)
+
+    def test_login_by_email(self):
+        response = self.assertWithinBudget('post', '/api/users/login/',
+                                           data={'username': self.user.email, 'password': SEED_PASSWORD},
+                                           queries=11, latency_ms=40)
+        self.assertEqual(response.data['user_id'], self.user.id)
+
+
+def png(width=300, height=200, color=(200, 40, 40)):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class AvatarVariantTests(TestCase):
+    """Variantes des photos de profil, dans un MEDIA_ROOT temporaire"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp(prefix='avatars_')
+        cls.media = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def user_with_photo(self, username, content=None):
+        user = User.objects.create_user(username=username)
+        user.profile_image = SimpleUploadedFile(f'{username}.png', content or png(), content_type='image/png')
+        user.save()
+        return user
+
+    def test_build_variants(self):
+        variants = images.build_variants(io.BytesIO(png()))
+        self.assertEqual(set(variants), set(images.AVATAR_SIZES))
+        for label, size in images.AVATAR_SIZES.items():
+            self.assertEqual(set(variants[label]), {'webp', 'jpeg'})
+            for extension, name in variants[label].items():
+                digest = re.fullmatch(rf'profile_images/variants/([0-9a-f]{{20}})_{size}\.{extension}', name).group(1)
+                with default_storage.open(name) as stored:
+                    content = stored.read()
+                # Nom dérivé du contenu : une URL ne change jamais de contenu
+                self.assertEqual(hashlib.sha256(content).hexdigest()[:20], digest)
+                with Image.open(io.BytesIO(content)) as image:
+                    self.assertEqual(image.size, (size, size))
+                    self.assertEqual(image.format, images.AVATAR_FORMATS[extension][0])
+
+        # Même image : mêmes fichiers, rien de réécrit
+        _, files = default_storage.listdir(images.VARIANTS_DIR)
+        self.assertEqual(images.build_variants(io.BytesIO(png())), variants)
+        self.assertEqual(default_storage.listdir(images.VARIANTS_DIR)[1], files)
+
+    def test_generate_saves_variants_and_records_contacts(self):
+        user = self.user_with_photo('avatar_owner')
+        owner = User.objects.create_user(username='avatar_contact_owner')
+        contact = Contact.objects.create(owner=owner, contact_user=user)
+
+        variants = images.generate_avatar_variants(user.id)
+        user.refresh_from_db()
+        self.assertEqual(user.profile_image_variants, variants)
+        self.assertEqual(list(ContactChange.objects.filter(owner_id=owner.id).values_list('object_id', flat=True)),
+                         [contact.id])
+
+    def test_generate_skips_replaced_photo(self):
+        user = self.user_with_photo('avatar_replaced')
+        build_variants = images.build_variants
+
+        def replaced_during_build(source):
+            User.objects.filter(pk=user.id).update(profile_image='profile_images/newer.png')
+            return build_variants(source)
+
+        with mock.patch.object(images, 'build_variants', replaced_during_build):
+            self.assertTrue(images.generate_avatar_variants(user.id))
+        user.refresh_from_db()
+        self.assertEqual(user.profile_image_variants, {})
+        self.assertFalse(ContactChange.objects.exists())
+
+    def test_generate_without_usable_photo(self):
+        self.assertIsNone(images.generate_avatar_variants(User.objects.create_user(username='avatar_none').id))
+        user = self.user_with_photo('avatar_corrupt', content=b'pas une image')
+        with self.assertLogs('users', 'WARNING') as logs:
+            self.assertIsNone(images.generate_avatar_variants(user.id))
+        self.assertEqual([(record.msg.name, record.msg.fields['user_id']) for record in logs.records],
+                         [('avatar.invalid', user.id)])
+        user.refresh_from_db()
+        self.assertEqual(user.profile_image_variants, {})
+
+    def test_avatar_url_falls_back_to_original(self):
+        self.assertEqual(images.avatar_url(User(username='avatar_empty')), '')
+        user = self.user_with_photo('avatar_pending')
+        self.assertEqual(images.avatar_url(user), user.profile_image.url)
+
+        user.profile_image_variants = images.generate_avatar_variants(user.id)
+        self.assertEqual(images.avatar_url(user, 'large', 'jpeg'),
+                         default_storage.url(user.profile_image_variants['large']['jpeg']))
+        # Format inconnu : photo originale
+        self.assertEqual(images.avatar_url(user, 'small', 'avif'), user.profile_image.url)
+
+    def test_serializers_expose_variants(self):
+        user = self.user_with_photo('avatar_serialized')
+        images.generate_avatar_variants(user.id)
+        user.refresh_from_db()
+        variants = user.profile_image_variants
+
+        def url(size, image_format='webp'):
+            return default_storage.url(variants[size][image_format])
+
+        data = UserSerializer(user).data
+        self.assertEqual(data['avatar'], url('medium'))
+        self.assertEqual(data['avatars']['large'], {'webp': url('large'), 'jpeg': url('large', 'jpeg')})
+        self.assertEqual(UserDirectorySerializer(user).data['avatar'], url('small'))
+        contact = Contact.objects.create(owner=User.objects.create_user(username='avatar_viewer'), contact_user=user)
+        self.assertEqual(ContactSerializer(contact).data['avatar'], url('small'))
+
+    def test_scheduled_after_commit(self):
+        with mock.patch.object(images, '_executor') as executor:
+            with self.captureOnCommitCallbacks() as callbacks:
+                images.schedule_avatar_variants(42)
+                executor.submit.assert_not_called()
+            self.assertEqual(len(callbacks), 1)
+            callbacks[0]()
+        executor.submit.assert_called_once_with(images._generate_safely, 42)
+
+    def test_generate_avatars_command(self):
+        done = self.user_with_photo('avatar_done')
+        images.generate_avatar_variants(done.id)
+        pending = self.user_with_photo('avatar_todo')
+        User.objects.create_user(username='avatar_without_photo')
+
+        output = io.StringIO()
+        call_command('generate_avatars', stdout=output)
+        self.assertIn('1 photos de profil traitées', output.getvalue())
+        pending.refresh_from_db()
+        self.assertEqual(set(pending.profile_image_variants), set(images.AVATAR_SIZES))
+
+        output = io.StringIO()
+        call_command('generate_avatars', '--all', stdout=output)
+        self.assertIn('2 photos de profil traitées', output.getvalue())
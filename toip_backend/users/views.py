@@ -3,16 +3,68 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import login, logout
+from django.db import connections
+from django.db.models import Q
 from django.utils import timezone
 from rest_framework.decorators import action
-
-from .models import User, UserStatus
-from .serializers import UserSerializer, UserStatusSerializer, LoginSerializer
-
-
-class UserViewSet(viewsets.ModelViewSet):
+from rest_framework.pagination import CursorPagination
+
+from .models import User, UserStatus, normalize_phone, normalize_search
+from .serializers import UserSerializer, UserDirectorySerializer, UserStatusSerializer, LoginSerializer
+from .images import schedule_avatar_variants
+from contacts.models import Contact, ContactChange
+from toip_backend.routers import ReplicaReadMixin
+
+
+class DirectoryPagination(CursorPagination):
+    """Pagination par curseur (pas de COUNT(*) sur la table des utilisateurs)"""
+    ordering = 'username'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+# Champs de l'annuaire comparés par préfixe, sur leur colonne normalisée (<champ>_normalized, voir User.normalize)
+DIRECTORY_SEARCH_FIELDS = ['username', 'first_name', 'last_name', 'email']
+DIRECTORY_FIELDS = ['id', 'username', 'first_name', 'last_name', 'online_status',
+                    'profile_image', 'profile_image_variants']
+
+
+def _prefix_condition(vendor, column, prefix):
+    """
+    Condition « column commence par prefix » servie par l'index de la colonne :
+    LIKE 'prefix%' sous PostgreSQL (index varchar_pattern_ops), intervalle
+    [prefix, prefix + U+10FFFF) ailleurs (SQLite compare les octets UTF-8, où
+    U+10FFFF suit tout autre caractère ; son LIKE ignore la casse et l'index)
+    """
+    if vendor == 'postgresql':
+        return Q(**{f'{column}__startswith': prefix})
+    return Q(**{f'{column}__gte': prefix, f'{column}__lt': prefix + '\U0010ffff'})
+
+
+def directory_search(queryset, query):
+    """
+    Filtre les utilisateurs dont chaque terme de la recherche est le préfixe
+    du username, du prénom, du nom, de l'email ou du téléphone normalisé
+    """
+    vendor = connections[queryset.db].vendor
+    for term in normalize_search(query).split():
+        condition = Q()
+        for field in DIRECTORY_SEARCH_FIELDS:
+            condition |= _prefix_condition(vendor, f'{field}_normalized', term)
+        phone = normalize_phone(term)
+        if phone:
+            condition |= _prefix_condition(vendor, 'phone_normalized', phone)
+        queryset = queryset.filter(condition)
+    return queryset
+
+
+class UserViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    pagination_class = DirectoryPagination
+    # Recherches de l'annuaire (list) lues sur une réplique (voir toip_backend.routers)
+    replica_actions = ('list',)
 
     @action(detail=False, methods=['put', 'patch'])
     def update_profile(self, request):
@@ -26,7 +78,15 @@ class UserViewSet(viewsets.ModelViewSet):
             serializer = self.get_serializer(user, data=request.data)
 
         if serializer.is_valid():
-            serializer.save()
+            image_changed = 'profile_image' in serializer.validated_data
+            if image_changed:
+                serializer.validated_data['profile_image_variants'] = {}
+            user = serializer.save()
+            if image_changed and user.profile_image:
+                # Miniatures générées hors du thread de la requête
+                schedule_avatar_variants(user.id)
+            # Les contacts pointant vers cet utilisateur changent dans le répertoire de leurs propriétaires
+            ContactChange.record_contacts(Contact.objects.filter(contact_user=user))
             return Response(serializer.data)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)    # Méthode pour définir les permissions selon l'action
@@ -37,11 +97,26 @@ class UserViewSet(viewsets.ModelViewSet):
             permission_classes = [permissions.IsAuthenticated]
         return [permission() for permission in permission_classes]
 
+    def perform_create(self, serializer):
+        user = serializer.save()
+        if user.profile_image:
+            schedule_avatar_variants(user.id)
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return UserDirectorySerializer
+        return UserSerializer
+
     def get_queryset(self):
         queryset = User.objects.all()
-        username = self.request.query_params.get('username', None)
-        if username:
-            queryset = queryset.filter(username__icontains=username)
+        if self.action != 'list':
+            return queryset
+
+        # Annuaire : recherche par préfixe sur les colonnes indexées, résultats paginés
+        queryset = queryset.only(*DIRECTORY_FIELDS)
+        query = self.request.query_params.get('q') or self.request.query_params.get('username')
+        if query:
+            queryset = directory_search(queryset, query)
         return queryset
 
 